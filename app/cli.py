@@ -0,0 +1,286 @@
+"""
+Offline maintenance commands: ``python -m app.cli <command>``.
+
+``stamp`` regenerates stamped copies without the HTTP stack::
+
+    python -m app.cli stamp SOURCE BUYERS OUT [--jobs N] [--product-id ID]
+
+SOURCE is a PDF or a directory of PDFs (the product id is the file stem),
+BUYERS a CSV or NDJSON buyer list as accepted by ``/api/creator/tokens/bulk``
+(rows without a product_id get every source), and copies are written to
+``OUT/{product_id}/{shard}/{sale_id or email}.pdf`` (the stamped layout)
+with each product's saved stamp settings from STORAGE_DIR. Work is spread
+over a process pool; copies that already exist are skipped, so an
+interrupted run resumes where it stopped.
+
+``trace FILE`` resolves a leaked copy to its buyer: the fingerprint is read
+from the file's metadata and looked up in the fingerprint index; if the
+metadata was stripped, emails found in the visible stamp text are looked up
+instead. Prints the matching copies as JSON.
+
+``migrate-stamped`` moves copies from the old flat
+``stamped/{product_id}/{key}.pdf`` layout into hash-prefix shards and updates
+the stamped and fingerprint indexes. It is safe to run while serving.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from . import startup
+from .utils.buyers import read_buyers
+from .utils.fingerprints import copies_for_email, record_fingerprint, resolve_fingerprint
+from .utils.storage import copy_key, stamped_pdf_path
+from .utils.tokens import SALE_DETAIL_FIELDS, buyer_fingerprint
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 1.0
+
+
+def _sources(path: Path, product_id: Optional[str]) -> Dict[str, Path]:
+    if path.is_dir():
+        # A STORAGE_DIR/source directory also holds logo assets and bases
+        return {
+            p.stem: p
+            for p in sorted(path.glob("*.pdf"))
+            if not p.name.endswith((".base.pdf", ".logo.pdf"))
+        }
+    return {product_id or path.stem: path}
+
+
+def _base_task(product_id: str, source: str, base: str) -> Optional[str]:
+    from .stamping import ensure_base
+
+    Path(base).parent.mkdir(parents=True, exist_ok=True)
+    built = ensure_base(product_id, Path(source), Path(base))
+    return str(built) if built else None
+
+
+def _stamp_task(task: dict) -> Optional[str]:
+    """Render one copy; returns an error message or None."""
+    from .stamping import render
+
+    out = Path(task["out"])
+    # Rendered under a temporary name so a killed run never leaves a
+    # truncated copy that the next run would skip
+    partial = out.with_name(out.name + ".partial")
+    try:
+        out.parent.mkdir(parents=True, exist_ok=True)
+        render(
+            Path(task["source"]),
+            partial,
+            task["product_id"],
+            task["email"],
+            task["sale_id"],
+            task["details"],
+            Path(task["base"]) if task["base"] else None,
+        )
+        partial.replace(out)
+        record_fingerprint(
+            buyer_fingerprint(task["product_id"], task["email"], task["sale_id"]),
+            task["product_id"], task["email"], task["sale_id"], out,
+        )
+    except Exception as e:
+        partial.unlink(missing_ok=True)
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def _plan(args, sources: Dict[str, Path]) -> Tuple[List[dict], List[str], int]:
+    """Copies to render, rejected rows and the number already present."""
+    tasks: List[dict] = []
+    errors: List[str] = []
+    seen = set()
+    skipped = 0
+    for line, row in read_buyers(args.buyers.read_bytes()):
+        if isinstance(row, str):
+            errors.append(f"line {line}: {row}")
+            continue
+        email = row.get("email", "")
+        if "@" not in email or len(email) > 254:
+            errors.append(f"line {line}: Invalid email")
+            continue
+        product_ids = [row["product_id"]] if row.get("product_id") else list(sources)
+        for product_id in product_ids:
+            if product_id not in sources:
+                errors.append(f"line {line}: Unknown product {product_id!r}")
+                continue
+            out = stamped_pdf_path(product_id, copy_key(email, row.get("sale_id")), root=args.out)
+            if out in seen:
+                continue
+            seen.add(out)
+            if out.exists():
+                skipped += 1
+                continue
+            tasks.append({
+                "source": str(sources[product_id]),
+                "out": str(out),
+                "product_id": product_id,
+                "email": email,
+                "sale_id": row.get("sale_id"),
+                "details": {k: row[k] for k in SALE_DETAIL_FIELDS if row.get(k)},
+                "base": None,
+            })
+    return tasks, errors, skipped
+
+
+def stamp(args) -> int:
+    sources = _sources(args.source, args.product_id)
+    if not sources:
+        print(f"No source PDFs found in {args.source}", file=sys.stderr)
+        return 2
+    tasks, errors, skipped = _plan(args, sources)
+    for error in errors:
+        print(error, file=sys.stderr)
+    print(f"{len(tasks)} copies to stamp, {skipped} already present, {len(errors)} rows rejected", file=sys.stderr)
+    if not tasks:
+        return 1 if errors else 0
+
+    # Workers are forked with the PDF stack already imported
+    startup.preload(startup.PDF_MODULES)
+    start = time.monotonic()
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        # Buyer-independent layers are merged once per product first
+        products = {task["product_id"] for task in tasks}
+        bases = {
+            product_id: pool.submit(
+                _base_task, product_id, str(sources[product_id]), str(args.out / ".base" / f"{product_id}.pdf")
+            )
+            for product_id in products
+        }
+        broken = set()
+        for product_id, future in bases.items():
+            try:
+                base = future.result()
+            except Exception as e:
+                print(f"{product_id}: base PDF failed: {type(e).__name__}: {e}", file=sys.stderr)
+                broken.add(product_id)
+                continue
+            for task in tasks:
+                if task["product_id"] == product_id:
+                    task["base"] = base
+
+        futures = {pool.submit(_stamp_task, task): task for task in tasks if task["product_id"] not in broken}
+        failed = len(tasks) - len(futures)
+        last_report = start
+        for future in as_completed(futures):
+            error = future.result()
+            if error:
+                failed += 1
+                print(f"{futures[future]['out']}: {error}", file=sys.stderr)
+            else:
+                done += 1
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                rate = done / (now - start)
+                remaining = len(tasks) - done - failed
+                eta = f"{remaining / rate:.0f}s" if rate else "?"
+                print(f"{done}/{len(tasks)} stamped, {failed} failed, {rate:.1f}/s, ETA {eta}", file=sys.stderr)
+
+    elapsed = time.monotonic() - start
+    print(f"Stamped {done} copies in {elapsed:.1f}s ({failed} failed, {skipped} skipped)", file=sys.stderr)
+    return 1 if failed or errors else 0
+
+
+def trace(args) -> int:
+    """Resolve a leaked copy to the buyer it was stamped for."""
+    from .utils.pdf import read_fingerprint, stamped_emails
+
+    result = {"file": str(args.file), "fingerprint": read_fingerprint(args.file), "found_in": None, "copies": []}
+    if result["fingerprint"]:
+        copy = resolve_fingerprint(result["fingerprint"])
+        if copy:
+            result.update(found_in="metadata", copies=[copy])
+    if not result["copies"]:
+        # Metadata stripped or unknown: fall back to the visible footer text
+        for email in stamped_emails(args.file):
+            copies = copies_for_email(email)
+            if copies:
+                result["found_in"] = "content"
+                result["copies"].extend(copies)
+    print(json.dumps(result, indent=2))
+    return 0 if result["copies"] else 1
+
+
+def _reindex(moved: List[Tuple[Path, Path]], dropped: List[Path]) -> None:
+    from .utils import cache_index
+    from .utils.fingerprints import move_paths
+
+    cache_index.move_stamped(moved)
+    cache_index.forget_stamped(dropped)
+    move_paths(moved)
+
+
+def migrate_stamped(args) -> int:
+    """Move copies from the flat ``stamped/{product_id}/`` layout into shards."""
+    from .settings import settings
+    from .utils.locks import file_lock
+
+    root = settings.storage_dir / "stamped"
+    moved: List[Tuple[Path, Path]] = []
+    dropped: List[Path] = []
+    total_moved = total_dropped = 0
+    for product_dir in sorted(p for p in root.iterdir() if p.is_dir()):
+        # Copies in the old layout sit directly in the product directory
+        with os.scandir(product_dir) as entries:
+            legacy = [Path(e.path) for e in entries if e.is_file() and e.name.endswith(".pdf")]
+        for old in legacy:
+            new = stamped_pdf_path(product_dir.name, old.stem)
+            if args.dry_run:
+                total_moved += 1
+                continue
+            new.parent.mkdir(parents=True, exist_ok=True)
+            # Same lock as render_copy, so a download stamping this copy in
+            # the new location meanwhile is never overwritten
+            with file_lock(str(new)):
+                if new.exists():
+                    old.unlink()
+                    dropped.append(old)
+                else:
+                    os.replace(old, new)
+                    moved.append((old, new))
+            if len(moved) + len(dropped) >= 1000:
+                _reindex(moved, dropped)
+                total_moved, total_dropped = total_moved + len(moved), total_dropped + len(dropped)
+                moved, dropped = [], []
+                print(f"{total_moved} moved, {total_dropped} already re-stamped", file=sys.stderr)
+    if moved or dropped:
+        _reindex(moved, dropped)
+        total_moved, total_dropped = total_moved + len(moved), total_dropped + len(dropped)
+    verb = "Would move" if args.dry_run else "Moved"
+    print(f"{verb} {total_moved} copies ({total_dropped} already re-stamped in the new layout)", file=sys.stderr)
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="Gumstamp offline tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    stamp_cmd = commands.add_parser("stamp", help="stamp copies for a buyer list with a process pool")
+    stamp_cmd.add_argument("source", type=Path, help="source PDF, or a directory of {product_id}.pdf files")
+    stamp_cmd.add_argument("buyers", type=Path, help="CSV (with header) or NDJSON buyer list")
+    stamp_cmd.add_argument("out", type=Path, help="output directory")
+    stamp_cmd.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes (default: CPU count)")
+    stamp_cmd.add_argument("--product-id", help="product id for a single source file (default: its file name)")
+    stamp_cmd.set_defaults(func=stamp)
+
+    trace_cmd = commands.add_parser("trace", help="find the buyer a leaked PDF was stamped for")
+    trace_cmd.add_argument("file", type=Path, help="the leaked PDF")
+    trace_cmd.set_defaults(func=trace)
+
+    migrate_cmd = commands.add_parser("migrate-stamped", help="move stamped copies into the sharded layout")
+    migrate_cmd.add_argument("--dry-run", action="store_true", help="only count the copies to move")
+    migrate_cmd.set_defaults(func=migrate_stamped)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+from . import startup
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -6,6 +7,7 @@ from .routes import gumroad, creator, download
 from .settings import settings
 from .monitoring import (
     setup_monitoring,
+    init_backends,
     MonitoringMiddleware,
     get_health_status,
     config as monitoring_config,
@@ -14,11 +16,33 @@ import os
 import structlog
 from contextlib import asynccontextmanager
 
+startup.mark("imports_done")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Initialize monitoring on startup
-    async with setup_monitoring():
+    # Exporters and PDF libraries are loaded off the request path; in the
+    # default "background" mode the app starts serving before they are ready.
+    steps = [
+        ("monitoring", init_backends),
+        ("pdf", lambda: startup.preload(startup.PDF_MODULES)),
+    ]
+    eager = settings.warmup_mode == "eager"
+    async with setup_monitoring(defer_backends=True):
+        if eager:
+            startup.warm_up(steps)
+        else:
+            startup.start_warm_up(steps)
+        startup.mark("serving")
+        from .utils.storage_gc import get_collector
+        get_collector().start()
         yield
+        get_collector().stop()
+        # Write pings that were acknowledged but not yet batched to disk
+        from .utils.sales import current_sale_log
+        sale_log = current_sale_log()
+        if sale_log is not None:
+            sale_log.close()
 
 
 app = FastAPI(
@@ -52,6 +76,8 @@ app.include_router(gumroad.router, prefix="/api/gumroad", tags=["gumroad"])
 app.include_router(creator.router, prefix="/api/creator", tags=["creator"])
 app.include_router(download.router, tags=["download"])
 
+startup.mark("app_created")
+
 @app.get("/", response_class=HTMLResponse)
 def landing():
         return """
@@ -641,7 +667,7 @@ def privacy():
 
 
 @app.get("/healthz")
-def healthz():
+async def healthz():
         """Simple health check for load balancers"""
         return {"status": "ok"}
 
@@ -652,6 +678,40 @@ def health():
         return JSONResponse(content=get_health_status())
 
 
+@app.get("/metrics/startup")
+def startup_metrics():
+        """Startup phases and import-time breakdown for cold-start tuning"""
+        return startup.get_startup_report()
+
+
+@app.get("/metrics/scheduler")
+def scheduler_metrics():
+        """Stamping scheduler queue depth, running jobs and wait times per priority class"""
+        from .utils.scheduler import get_scheduler
+        return get_scheduler().stats()
+
+
+@app.get("/metrics/pings")
+def ping_metrics():
+        """Gumroad ping ingestion: new and duplicate sales, batch writes and pending backlog"""
+        from .utils.sales import get_sale_log
+        return get_sale_log().stats()
+
+
+@app.get("/metrics/gc")
+def gc_metrics():
+        """Storage GC: whether this worker is the collector, passes, files removed and bytes reclaimed per reason"""
+        from .utils.storage_gc import get_collector
+        return get_collector().stats()
+
+
+@app.get("/metrics/memory-cache")
+def memory_cache_metrics():
+        """Memory tier for small stamped copies: hit rate, entries, bytes used and evictions"""
+        from .utils.memcache import get_memory_cache
+        return get_memory_cache().stats()
+
+
 @app.get("/metrics/business")
 def business_metrics():
         """Business-specific metrics endpoint"""
@@ -663,16 +723,20 @@ def business_metrics():
             stamped_dir = settings.storage_dir / "stamped"
             
             source_count = len(list(source_dir.glob("*.pdf"))) if source_dir.exists() else 0
-            stamped_count = len(list(stamped_dir.glob("*.pdf"))) if stamped_dir.exists() else 0
+            # Stamped copies are counted from the shared index rather than
+            # by walking the per-product directories
+            from .utils.cache_index import stamped_totals
+            stamped = stamped_totals()
             
             return {
                 "products": {
                     "source_files": source_count,
-                    "stamped_files": stamped_count
+                    "stamped_files": stamped["files"]
                 },
                 "storage": {
                     "source_dir": str(source_dir),
                     "stamped_dir": str(stamped_dir),
+                    "stamped_size_bytes": stamped["bytes"],
                     "total_size_bytes": sum(f.stat().st_size for f in source_dir.rglob("*") if f.is_file()) if source_dir.exists() else 0
                 }
             }
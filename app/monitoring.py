@@ -5,32 +5,33 @@ Includes OpenTelemetry, structured logging, business metrics, and health checks.
 
 import os
 import time
-import psutil
 import structlog
-import sentry_sdk
 from typing import Dict, Any, Optional
 from pathlib import Path
 from contextlib import asynccontextmanager
 
+# Only the lightweight OpenTelemetry API is imported eagerly. The SDK, OTLP/gRPC
+# exporters, instrumentors, Sentry and psutil are imported inside the setup
+# functions below so they stay off the cold-start path (see app.startup).
 from opentelemetry import trace, metrics
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.instrumentation.logging import LoggingInstrumentor
-from opentelemetry.metrics import Observation
-
-from sentry_sdk.integrations.fastapi import FastApiIntegration
-from sentry_sdk.integrations.starlette import StarletteIntegration
-
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
+
+from starlette.datastructures import Headers
 
 from .settings import settings
+from . import startup
+
+# Heavy modules loaded by init_backends(), in the order they are needed
+BACKEND_MODULES = (
+    "psutil",
+    "sentry_sdk",
+    "opentelemetry.sdk.trace",
+    "opentelemetry.sdk.metrics",
+    "opentelemetry.exporter.otlp.proto.grpc.trace_exporter",
+    "opentelemetry.exporter.otlp.proto.grpc.metric_exporter",
+    "opentelemetry.instrumentation.fastapi",
+    "opentelemetry.instrumentation.requests",
+    "opentelemetry.instrumentation.logging",
+)
 
 
 class MonitoringConfig:
@@ -70,6 +71,15 @@ pdf_processing_time = None
 upload_file_size = None
 download_counter = None
 token_operations_counter = None
+stamp_output_size = None
+stamp_peak_rss = None
+stamp_queue_wait = None
+rate_limited_counter = None
+ping_counter = None
+gc_reclaimed_counter = None
+memory_cache_counter = None
+stamp_quota_rejected_counter = None
+stamp_timeout_counter = None
 
 # Observable gauges are registered during setup
 _observable_registered = False
@@ -99,7 +109,11 @@ def setup_sentry():
     """Initialize Sentry for error tracking and performance monitoring"""
     if not config.enable_sentry:
         return
-        
+
+    import sentry_sdk
+    from sentry_sdk.integrations.fastapi import FastApiIntegration
+    from sentry_sdk.integrations.starlette import StarletteIntegration
+
     sentry_sdk.init(
         dsn=config.sentry_dsn,
         environment=config.environment,
@@ -119,7 +133,16 @@ def setup_opentelemetry():
     """Initialize OpenTelemetry tracing and metrics"""
     if not (config.enable_tracing or config.enable_metrics):
         return
-        
+
+    import psutil
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+    from opentelemetry.metrics import Observation
+
     # Set up tracing
     if config.enable_tracing:
         trace.set_tracer_provider(TracerProvider())
@@ -153,7 +176,7 @@ def setup_opentelemetry():
         ))
 
         # Create meter and instruments AFTER provider is set
-        global _meter, pdf_operations_counter, pdf_processing_time, upload_file_size, download_counter, token_operations_counter, _observable_registered
+        global _meter, pdf_operations_counter, pdf_processing_time, upload_file_size, download_counter, token_operations_counter, stamp_output_size, stamp_peak_rss, stamp_queue_wait, rate_limited_counter, ping_counter, gc_reclaimed_counter, memory_cache_counter, stamp_quota_rejected_counter, stamp_timeout_counter, _observable_registered
         _meter = metrics.get_meter("gumstamp")
 
         # Business instruments
@@ -182,6 +205,51 @@ def setup_opentelemetry():
             description="Total number of token operations",
             unit="1"
         )
+        stamp_output_size = _meter.create_histogram(
+            name="gumstamp_stamp_output_bytes",
+            description="Size of stamped output files",
+            unit="bytes"
+        )
+        stamp_peak_rss = _meter.create_histogram(
+            name="gumstamp_stamp_peak_rss_bytes",
+            description="Peak resident memory of isolated stamping jobs",
+            unit="bytes"
+        )
+        stamp_queue_wait = _meter.create_histogram(
+            name="gumstamp_stamp_queue_wait_seconds",
+            description="Time stamping jobs waited for a scheduler slot",
+            unit="s"
+        )
+        rate_limited_counter = _meter.create_counter(
+            name="gumstamp_rate_limited_total",
+            description="Requests rejected by rate limiting",
+            unit="1"
+        )
+        ping_counter = _meter.create_counter(
+            name="gumstamp_pings_total",
+            description="Gumroad sale pings by result (new or duplicate)",
+            unit="1"
+        )
+        gc_reclaimed_counter = _meter.create_counter(
+            name="gumstamp_gc_reclaimed_bytes_total",
+            description="Bytes freed by storage garbage collection, by reason",
+            unit="bytes"
+        )
+        memory_cache_counter = _meter.create_counter(
+            name="gumstamp_memory_cache_lookups_total",
+            description="Download lookups in the in-process memory tier, by result (hit or miss)",
+            unit="1"
+        )
+        stamp_quota_rejected_counter = _meter.create_counter(
+            name="gumstamp_stamp_quota_rejected_total",
+            description="Stamping jobs refused because a product reached its scheduler queue quota",
+            unit="1"
+        )
+        stamp_timeout_counter = _meter.create_counter(
+            name="gumstamp_stamp_timeouts_total",
+            description="Stamping jobs stopped at their deadline, by outcome (stopped or killed)",
+            unit="1"
+        )
 
         # Observable gauges for system metrics
         def _observe_cpu(options):
@@ -213,6 +281,18 @@ def setup_opentelemetry():
             except Exception:
                 return []
 
+        def _observe_stamp_queue(options):
+            from .utils.scheduler import current_scheduler
+
+            scheduler = current_scheduler()
+            if scheduler is None:
+                return []
+            observations = []
+            for name, stats in scheduler.stats()["classes"].items():
+                observations.append(Observation(stats["queued"], {"priority": name, "state": "queued"}))
+                observations.append(Observation(stats["running"], {"priority": name, "state": "running"}))
+            return observations
+
         _meter.create_observable_gauge(
             name="gumstamp_system_cpu_percent",
             callbacks=[_observe_cpu],
@@ -231,11 +311,21 @@ def setup_opentelemetry():
             description="Storage disk usage in bytes",
             unit="bytes",
         )
+        _meter.create_observable_gauge(
+            name="gumstamp_stamp_queue_depth",
+            callbacks=[_observe_stamp_queue],
+            description="Stamping jobs queued and running per priority class",
+            unit="1",
+        )
         _observable_registered = True
 
 
 def setup_auto_instrumentation():
     """Set up automatic instrumentation for FastAPI and requests"""
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+    from opentelemetry.instrumentation.requests import RequestsInstrumentor
+    from opentelemetry.instrumentation.logging import LoggingInstrumentor
+
     if config.enable_tracing:
         # Auto-instrument FastAPI
         # Instantiate the instrumentor; instrument() patches FastAPI globally
@@ -256,34 +346,53 @@ def setup_auto_instrumentation():
     LoggingInstrumentor().instrument(set_logging_format=False)
 
 
-class MonitoringMiddleware(BaseHTTPMiddleware):
-    """Custom middleware for detailed request/response monitoring"""
+class MonitoringMiddleware:
+    """Custom middleware for detailed request/response monitoring
+
+    Plain ASGI rather than BaseHTTPMiddleware: the response is passed through
+    untouched instead of being re-streamed through a task group, so file
+    downloads (including zero-copy sends) are not copied chunk by chunk.
+    """
     
     def __init__(self, app, logger=None):
-        super().__init__(app)
+        self.app = app
         self.logger = logger or structlog.get_logger("gumstamp.middleware")
         self.start_time = time.time()
         
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
         start_time = time.time()
         
         # Extract request details
-        method = request.method
-        path = request.url.path
-        user_agent = request.headers.get("user-agent", "")
-        content_length = request.headers.get("content-length", 0)
+        headers = Headers(scope=scope)
+        method = scope["method"]
+        path = scope["path"]
+        user_agent = headers.get("user-agent", "")
+        content_length = headers.get("content-length", 0)
         
         try:
             content_length = int(content_length) if content_length else 0
         except (ValueError, TypeError):
             content_length = 0
+
+        status_code = 500
+        response_started = 0.0
+
+        async def send_wrapper(message):
+            nonlocal status_code, response_started
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                response_started = time.time()
+            await send(message)
             
         # Process request
-        response = await call_next(request)
+        await self.app(scope, receive, send_wrapper)
         
-        # Calculate metrics
-        duration = time.time() - start_time
-        status_code = response.status_code
+        # Calculate metrics (time to response headers, as before)
+        duration = (response_started or time.time()) - start_time
         
         # Log request details
         log_data = {
@@ -301,8 +410,6 @@ class MonitoringMiddleware(BaseHTTPMiddleware):
             self.logger.warning("Error response", **log_data)
         else:
             self.logger.info("Request processed", **log_data)
-            
-        return response
 
 
 class BusinessMetrics:
@@ -331,6 +438,78 @@ class BusinessMetrics:
         if success and pdf_processing_time:
             pdf_processing_time.record(processing_time, labels)
     
+    @staticmethod
+    def track_stamp_output(output_bytes: int, mode: str, profile: Optional[str] = None):
+        """Track stamped output size per stamping mode and output profile"""
+        labels = {"mode": mode, "profile": profile or "none"}
+
+        if stamp_output_size:
+            stamp_output_size.record(output_bytes, labels)
+    
+    @staticmethod
+    def track_stamp_memory(peak_rss_bytes: int, success: bool):
+        """Track peak RSS of a stamping job run in its own process"""
+        labels = {"success": str(success).lower()}
+
+        if stamp_peak_rss:
+            stamp_peak_rss.record(peak_rss_bytes, labels)
+    
+    @staticmethod
+    def track_stamp_wait(wait_seconds: float, priority: str):
+        """Track how long a stamping job waited for a scheduler slot"""
+        labels = {"priority": priority}
+
+        if stamp_queue_wait:
+            stamp_queue_wait.record(wait_seconds, labels)
+    
+    @staticmethod
+    def track_stamp_quota_rejected(priority: str):
+        """Track a stamping job refused by a product's queue quota"""
+        labels = {"priority": priority}
+
+        if stamp_quota_rejected_counter:
+            stamp_quota_rejected_counter.add(1, labels)
+
+    @staticmethod
+    def track_stamp_timeout(killed: bool):
+        """Track a stamping job stopped at its deadline"""
+        labels = {"outcome": "killed" if killed else "stopped"}
+
+        if stamp_timeout_counter:
+            stamp_timeout_counter.add(1, labels)
+
+    @staticmethod
+    def track_rate_limited(scope: str):
+        """Track a request rejected by a rate-limit scope"""
+        labels = {"scope": scope}
+
+        if rate_limited_counter:
+            rate_limited_counter.add(1, labels)
+    
+    @staticmethod
+    def track_ping(duplicate: bool):
+        """Track a Gumroad ping, counting retried deliveries separately"""
+        labels = {"result": "duplicate" if duplicate else "new"}
+
+        if ping_counter:
+            ping_counter.add(1, labels)
+
+    @staticmethod
+    def track_gc_reclaimed(reason: str, size_bytes: int):
+        """Track a file removed by storage garbage collection"""
+        labels = {"reason": reason}
+
+        if gc_reclaimed_counter:
+            gc_reclaimed_counter.add(size_bytes, labels)
+
+    @staticmethod
+    def track_memory_cache(hit: bool):
+        """Track a download lookup in the memory tier"""
+        labels = {"result": "hit" if hit else "miss"}
+
+        if memory_cache_counter:
+            memory_cache_counter.add(1, labels)
+
     @staticmethod
     def track_download(success: bool, file_size: Optional[int] = None):
         """Track download metrics"""
@@ -360,6 +539,8 @@ class SystemMetrics:
 def get_health_status() -> Dict[str, Any]:
     """Get comprehensive health status"""
     try:
+        import psutil
+
         # System metrics
         cpu_percent = psutil.cpu_percent(interval=0.1)
         memory = psutil.virtual_memory()
@@ -415,14 +596,18 @@ def get_health_status() -> Dict[str, Any]:
         }
 
 
-@asynccontextmanager
-async def setup_monitoring():
-    """Context manager for monitoring setup and cleanup"""
-    setup_logging()
+def init_backends():
+    """Import and initialize Sentry, OpenTelemetry and auto-instrumentation.
+
+    This is the expensive part of monitoring setup; it is safe to run from the
+    background warm-up thread because instruments stay ``None`` (and are
+    skipped by BusinessMetrics) until they have been created.
+    """
+    startup.preload(BACKEND_MODULES)
     setup_sentry()
     setup_opentelemetry()
     setup_auto_instrumentation()
-    
+
     logger = structlog.get_logger("gumstamp.monitoring")
     logger.info(
         "Monitoring initialized",
@@ -433,7 +618,21 @@ async def setup_monitoring():
         tracing_enabled=config.enable_tracing,
         metrics_enabled=config.enable_metrics
     )
-    
+
+
+@asynccontextmanager
+async def setup_monitoring(defer_backends: bool = False):
+    """Context manager for monitoring setup and cleanup
+
+    With ``defer_backends`` only logging is configured here and the caller is
+    responsible for running init_backends() (typically in the warm-up task).
+    """
+    setup_logging()
+    if not defer_backends:
+        init_backends()
+
+    logger = structlog.get_logger("gumstamp.monitoring")
+
     yield
     
     logger.info("Monitoring shutdown")
@@ -447,5 +646,6 @@ __all__ = [
     "SystemMetrics",
     "get_health_status",
     "setup_monitoring",
+    "init_backends",
     "config"
 ]
\ No newline at end of file
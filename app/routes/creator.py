@@ -1,14 +1,34 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from pydantic import BaseModel, Field
-from typing import Optional
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
 from ..settings import settings
-from ..utils.tokens import sign_token
-from ..utils.gumroad import verify_license
+from ..utils.buyers import read_buyers
+from ..utils.tokens import sale_details, sign_token
+from ..utils import ratelimit
+from ..utils.gumroad import verify_license_cached
+from ..utils.product_config import ProductConfig, product_configs
+from ..utils.templates import TemplateError, compile_template
+from ..utils.watermarks import (
+    DEFAULT_OUTPUT_PROFILE,
+    OUTPUT_PROFILES,
+    STAMP_MODES,
+    DiagonalStyle,
+    FooterStyle,
+    LogoSpec,
+    PatternSpec,
+)
+from ..utils.memcache import get_memory_cache
+from ..utils.scheduler import QueueFull, get_scheduler
+from ..utils.storage import font_path, logo_asset_path
 from ..monitoring import BusinessMetrics, tracer
 from opentelemetry.trace import Status, StatusCode
 from pathlib import Path
+import asyncio
+import csv
+import io
 import re
-import json
+import hashlib
 import time
 import structlog
 
@@ -29,6 +49,25 @@ async def upload_source_pdf(
     file: UploadFile = File(...),
     footer_text: Optional[str] = Form(default="Purchased by {email} on {date}"),
     license_key: Optional[str] = Form(default=None),
+    pattern_text: Optional[str] = Form(default=None),
+    pattern_spacing: Optional[float] = Form(default=None),
+    pattern_angle: Optional[float] = Form(default=None),
+    pattern_opacity: Optional[float] = Form(default=None),
+    logo: Optional[UploadFile] = File(default=None),
+    logo_position: Optional[str] = Form(default=None),
+    logo_width: Optional[float] = Form(default=None),
+    logo_opacity: Optional[float] = Form(default=None),
+    font: Optional[UploadFile] = File(default=None),
+    mode: str = Form(default="visible"),
+    marker: bool = Form(default=False),
+    profile: str = Form(default=DEFAULT_OUTPUT_PROFILE),
+    footer_position: Optional[str] = Form(default=None),
+    footer_font_size: Optional[float] = Form(default=None),
+    footer_opacity: Optional[float] = Form(default=None),
+    diagonal_text: Optional[str] = Form(default=None),
+    diagonal_font_size: Optional[float] = Form(default=None),
+    diagonal_opacity: Optional[float] = Form(default=None),
+    diagonal_angle: Optional[float] = Form(default=None),
 ):
     logger = structlog.get_logger("gumstamp.creator")
     start_time = time.time()
@@ -48,10 +87,97 @@ async def upload_source_pdf(
                 if not license_key:
                     BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
                     raise HTTPException(status_code=402, detail="License required")
-                if not verify_license(license_key, settings.gumroad_product_id):
+                if not verify_license_cached(license_key, settings.gumroad_product_id):
                     BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
                     raise HTTPException(status_code=403, detail="Invalid license")
             
+            if mode not in STAMP_MODES:
+                BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                raise HTTPException(status_code=400, detail="Invalid mode")
+            if profile not in OUTPUT_PROFILES:
+                BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                raise HTTPException(status_code=400, detail="Invalid output profile")
+
+            # Optional repeated diagonal watermark
+            pattern = None
+            if pattern_text:
+                overrides = {
+                    "spacing": pattern_spacing,
+                    "angle": pattern_angle,
+                    "opacity": pattern_opacity,
+                }
+                try:
+                    pattern = PatternSpec(
+                        text=pattern_text,
+                        **{k: v for k, v in overrides.items() if v is not None},
+                    )
+                except ValidationError:
+                    BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                    raise HTTPException(status_code=400, detail="Invalid pattern settings")
+
+            # Optional brand image watermark
+            logo_spec = None
+            logo_bytes = b""
+            if logo is not None and logo.filename:
+                overrides = {
+                    "position": logo_position,
+                    "width": logo_width,
+                    "opacity": logo_opacity,
+                }
+                try:
+                    logo_spec = LogoSpec(**{k: v for k, v in overrides.items() if v is not None})
+                except ValidationError:
+                    BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                    raise HTTPException(status_code=400, detail="Invalid logo settings")
+                logo_bytes = await logo.read()
+                if not logo_bytes or len(logo_bytes) > 2 * 1024 * 1024:
+                    BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                    raise HTTPException(status_code=400, detail="Invalid logo size")
+
+            # Footer and diagonal text placement/look; validated up front so a
+            # bad setting rejects the upload before anything is written
+            footer_overrides = {
+                "position": footer_position,
+                "font_size": footer_font_size,
+                "opacity": footer_opacity,
+            }
+            diagonal_overrides = {
+                "font_size": diagonal_font_size,
+                "opacity": diagonal_opacity,
+                "angle": diagonal_angle,
+            }
+            # Templates are compiled here once; stamping only joins segments
+            for template in (footer_text, diagonal_text):
+                if template:
+                    try:
+                        compile_template(template)
+                    except TemplateError as e:
+                        BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                        raise HTTPException(status_code=400, detail=f"Invalid template: {e}")
+            try:
+                config = ProductConfig(
+                    footer_text=footer_text,
+                    footer=FooterStyle(**{k: v for k, v in footer_overrides.items() if v is not None}),
+                    diagonal_text=diagonal_text or None,
+                    diagonal=DiagonalStyle(**{k: v for k, v in diagonal_overrides.items() if v is not None}),
+                    mode=mode,
+                    marker=marker,
+                    profile=profile,
+                    pattern=pattern,
+                    logo=logo_spec,
+                )
+            except ValidationError:
+                BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                raise HTTPException(status_code=400, detail="Invalid stamp settings")
+
+            # Optional brand font (TrueType-outline TTF/OTF)
+            font_bytes = b""
+            if font is not None and font.filename:
+                font_bytes = await font.read()
+                if not font_bytes or len(font_bytes) > 8 * 1024 * 1024:
+                    BusinessMetrics.track_pdf_upload(0, time.time() - start_time, False)
+                    raise HTTPException(status_code=400, detail="Invalid font size")
+
             # Read and validate file
             contents = await file.read()
             file_size = len(contents)
@@ -66,20 +192,79 @@ async def upload_source_pdf(
             
             span.set_attribute("file_size_bytes", file_size)
             
-            # Save file to storage/source/{product_id}.pdf
+            # Every asset is validated before anything live is replaced, so a
+            # rejected upload never leaves a new source with the old config
+
+            # Decode and compress the logo once; every stamped copy reuses it.
+            # Built beside the live asset and swapped in below.
+            logo_path = logo_asset_path(product_id)
+            logo_staged = logo_path.with_name(logo_path.name + ".partial")
+            if logo_spec:
+                from ..utils.pdf import build_logo_asset
+
+                logo_path.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    build_logo_asset(logo_bytes, logo_staged)
+                except ValueError:
+                    logo_staged.unlink(missing_ok=True)
+                    BusinessMetrics.track_pdf_upload(file_size, time.time() - start_time, False)
+                    raise HTTPException(status_code=400, detail="Logo must be a PNG or JPEG image")
+
+            # Fonts are stored by content hash, so products sharing a font share
+            # one file and one reportlab registration per process
+            font_id = None
+            if font_bytes:
+                from ..utils.pdf import register_font
+
+                font_id = hashlib.sha256(font_bytes).hexdigest()[:16]
+                font_file = font_path(font_id)
+                if not font_file.exists():
+                    font_file.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = font_file.with_suffix(".tmp")
+                    tmp.write_bytes(font_bytes)
+                    tmp.replace(font_file)
+                try:
+                    register_font(font_file)
+                except ValueError:
+                    font_file.unlink(missing_ok=True)
+                    logo_staged.unlink(missing_ok=True)
+                    BusinessMetrics.track_pdf_upload(file_size, time.time() - start_time, False)
+                    raise HTTPException(status_code=400, detail="Font must be a TrueType TTF/OTF file")
+
+            # Save file to storage/source/{product_id}.pdf, written beside it
+            # and swapped in so readers never see a partial source
             dest = settings.storage_dir / "source" / f"{product_id}.pdf"
             dest.parent.mkdir(parents=True, exist_ok=True)
-            dest.write_bytes(contents)
+            staged = dest.with_name(dest.name + ".partial")
+            staged.write_bytes(contents)
+            if logo_spec:
+                logo_staged.replace(logo_path)
+            else:
+                logo_path.unlink(missing_ok=True)
+            staged.replace(dest)
+
+            # Persist the config next to the source; the store writes through
+            # so this process serves it from memory immediately
+            config.font = font_id
+            product_configs.put(product_id, config)
+            # Copies of the previous upload are no longer served from memory
+            get_memory_cache().discard_product(product_id)
+
+            # Merge the buyer-independent layers into the product's base PDF
+            # in the background; downloads arriving first wait for it
+            from ..stamping import ensure_base
+
+            def _base_done(job) -> None:
+                if job.exception() is not None:
+                    logger.warning("Base PDF build failed", product_id=product_id, error=str(job.exception()))
 
-            # Persist simple config alongside source to influence stamping (demo-friendly)
-            cfg_path = settings.storage_dir / "source" / f"{product_id}.json"
             try:
-                cfg = {"footer_text": footer_text}
-                cfg_path.write_text(json.dumps(cfg))
-            except Exception as e:
-                logger.warning("Failed to save config", product_id=product_id, error=str(e))
-                # Non-fatal; proceed without saved config
-                span.record_exception(e)
+                get_scheduler().submit(
+                    ensure_base, product_id, dest, priority="prewarm", tenant=product_id
+                ).add_done_callback(_base_done)
+            except QueueFull:
+                # Built by the first download instead
+                BusinessMetrics.track_stamp_quota_rejected("prewarm")
 
             processing_time = time.time() - start_time
             BusinessMetrics.track_pdf_upload(file_size, processing_time, True)
@@ -117,15 +302,75 @@ class TokenRequest(BaseModel):
     product_id: str
     email: str
     sale_id: Optional[str] = None
+    full_name: Optional[str] = Field(default=None, max_length=120)
+    price: Optional[str] = Field(default=None, max_length=40)
+    date: Optional[str] = Field(default=None, pattern=r"^\d{4}-\d{2}-\d{2}$")
+    # Stamp the copy in the background now, so the first download is a cache hit
+    prestamp: bool = False
 
 
 class TokenResponse(BaseModel):
     token: str
     download_url: str
+    # Whether background stamping was started (False if the copy already exists)
+    prestamped: bool = False
+
+
+def _buyer_error(body: TokenRequest) -> Optional[str]:
+    if not SAFE_ID.match(body.product_id):
+        return "Invalid product_id"
+    if "@" not in body.email or len(body.email) > 254:
+        return "Invalid email"
+    return None
+
+
+def _buyer_details(body: TokenRequest) -> Dict[str, str]:
+    details = sale_details(full_name=body.full_name, sold_at=body.date)
+    if body.price:
+        details["price"] = body.price
+    return details
+
+
+def _buyer_token(body: TokenRequest, details: Dict[str, str]) -> str:
+    return sign_token({
+        "product_id": body.product_id,
+        "email": body.email,
+        "sale_id": body.sale_id,
+        **details,
+    })
+
+
+def _prestamp(body: TokenRequest, details: Dict[str, str], priority: str) -> bool:
+    """Start stamping the buyer's copy in the background; never fails the request."""
+    from ..stamping import prestamp
+
+    try:
+        return prestamp(body.product_id, body.email, body.sale_id, details, priority=priority)
+    except Exception as e:
+        structlog.get_logger("gumstamp.creator").warning(
+            "Pre-stamp not started", product_id=body.product_id, error=str(e)
+        )
+        return False
+
+
+def _license_error(license_key: Optional[str]) -> Optional[HTTPException]:
+    """Monetization gate shared by the token endpoints."""
+    if not settings.gumroad_product_id:
+        return None
+    if not license_key:
+        return HTTPException(status_code=402, detail="License required")
+    if not verify_license_cached(license_key, settings.gumroad_product_id):
+        return HTTPException(status_code=403, detail="Invalid license")
+    return None
 
 
 @router.post("/token", response_model=TokenResponse)
-def create_token(body: TokenRequest, license_key: Optional[str] = None):
+def create_token(body: TokenRequest, request: Request, license_key: Optional[str] = None):
+    # Admission control before the (possibly remote) licence check
+    retry_after = ratelimit.check("creator_token.ip", request.client.host if request.client else None)
+    if retry_after:
+        raise ratelimit.too_many_requests(retry_after)
+
     logger = structlog.get_logger("gumstamp.creator")
     
     with tracer.start_as_current_span("create_token") as span:
@@ -135,37 +380,40 @@ def create_token(body: TokenRequest, license_key: Optional[str] = None):
         
         try:
             # Validate inputs
-            if not SAFE_ID.match(body.product_id):
+            error = _buyer_error(body)
+            if error:
                 BusinessMetrics.track_token_operation("create", False)
-                raise HTTPException(status_code=400, detail="Invalid product_id")
-            if not isinstance(body.email, str) or "@" not in body.email or len(body.email) > 254:
-                BusinessMetrics.track_token_operation("create", False)
-                raise HTTPException(status_code=400, detail="Invalid email")
+                raise HTTPException(status_code=400, detail=error)
 
             # Monetization gate
-            if settings.gumroad_product_id:
-                if not license_key:
-                    BusinessMetrics.track_token_operation("create", False)
-                    raise HTTPException(status_code=402, detail="License required")
-                if not verify_license(license_key, settings.gumroad_product_id):
-                    BusinessMetrics.track_token_operation("create", False)
-                    raise HTTPException(status_code=403, detail="Invalid license")
+            denied = _license_error(license_key)
+            if denied:
+                BusinessMetrics.track_token_operation("create", False)
+                raise denied
+
+            # Charged after the licence check so unlicensed callers cannot
+            # exhaust a product's budget
+            retry_after = ratelimit.check("creator_token.product", body.product_id)
+            if retry_after:
+                BusinessMetrics.track_token_operation("create", False)
+                raise ratelimit.too_many_requests(retry_after)
             
-            token = sign_token({
-                "product_id": body.product_id,
-                "email": body.email,
-                "sale_id": body.sale_id,
-            })
+            details = _buyer_details(body)
+            token = _buyer_token(body, details)
+            prestamped = body.prestamp and _prestamp(body, details, "prewarm")
             
             BusinessMetrics.track_token_operation("create", True)
             
             logger.info(
                 "Token created successfully",
                 product_id=body.product_id,
-                has_sale_id=body.sale_id is not None
+                has_sale_id=body.sale_id is not None,
+                prestamped=prestamped
             )
             
-            return TokenResponse(token=token, download_url=f"{settings.base_url}/download/{token}")
+            return TokenResponse(
+                token=token, download_url=f"{settings.base_url}/download/{token}", prestamped=prestamped
+            )
             
         except HTTPException:
             # Re-raise HTTP exceptions as-is
@@ -182,3 +430,120 @@ def create_token(body: TokenRequest, license_key: Optional[str] = None):
             span.record_exception(e)
             span.set_status(Status(status_code=StatusCode.ERROR, description=str(e)))
             raise HTTPException(status_code=500, detail="Token creation failed")
+
+
+# Bulk minting: largest accepted buyer list, and rows per streamed chunk
+BULK_MAX_BYTES = 50 * 1024 * 1024
+BULK_CHUNK_ROWS = 500
+BULK_COLUMNS = ("line", "product_id", "email", "sale_id", "token", "download_url", "prestamped", "error")
+
+
+def _bulk_tokens(
+    rows: Iterator[Tuple[int, Union[Dict[str, Any], str]]],
+    product_id: Optional[str],
+    prestamp: bool = False,
+) -> Iterator[str]:
+    """Sign a token per row and yield the CSV result in chunks.
+
+    With ``prestamp`` each copy is also queued for stamping in the ``bulk``
+    class, behind interactive downloads and pre-warming. The ``prestamped``
+    column says whether it was: copies that already exist, products without
+    a source and copies over the product's queue quota are skipped and
+    stamped on first download instead.
+    """
+    logger = structlog.get_logger("gumstamp.creator")
+    start = time.time()
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    out.writerow(BULK_COLUMNS)
+    # The per-product budget is charged once per product and batch
+    limited: Dict[str, bool] = {}
+    created = failed = skipped = 0
+
+    for number, row in rows:
+        body, token, prestamped, error = None, "", "", row if isinstance(row, str) else None
+        if error is None:
+            try:
+                body = TokenRequest(**{"product_id": product_id, **row})
+            except (ValidationError, TypeError):
+                error = "Invalid row"
+        if body is not None:
+            error = _buyer_error(body)
+            if error is None:
+                if body.product_id not in limited:
+                    limited[body.product_id] = bool(ratelimit.check("creator_token.product", body.product_id))
+                if limited[body.product_id]:
+                    error = "Rate limited"
+        if error is None:
+            details = _buyer_details(body)
+            token = _buyer_token(body, details)
+            if prestamp or body.prestamp:
+                started = _prestamp(body, details, "bulk")
+                skipped += not started
+                prestamped = "true" if started else "false"
+            created += 1
+        else:
+            failed += 1
+        BusinessMetrics.track_token_operation("bulk_create", error is None)
+        out.writerow((
+            number,
+            body.product_id if body else "",
+            body.email if body else "",
+            (body.sale_id or "") if body else "",
+            token,
+            f"{settings.base_url}/download/{token}" if token else "",
+            prestamped,
+            error or "",
+        ))
+        if (created + failed) % BULK_CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    yield buf.getvalue()
+    logger.info(
+        "Bulk tokens created", created=created, failed=failed, prestamp_skipped=skipped, seconds=time.time() - start
+    )
+
+
+@router.post("/tokens/bulk")
+async def create_tokens_bulk(
+    request: Request,
+    file: UploadFile = File(...),
+    product_id: Optional[str] = Form(default=None),
+    license_key: Optional[str] = Form(default=None),
+    prestamp: bool = Form(default=False),
+):
+    """Mint download tokens for a CSV or NDJSON list of buyers.
+
+    Rows carry the TokenRequest fields (``product_id`` defaults to the form
+    field). The licence is checked once for the whole batch and results are
+    streamed back as CSV, one line per input row, with an ``error`` column for
+    rows that were rejected. With ``prestamp`` copies are also queued for
+    stamping in the background; the ``prestamped`` column says which were.
+    Copies over the product's queue quota (STAMP_TENANT_MAX_QUEUED) are
+    skipped and stamped on first download.
+    """
+    retry_after = ratelimit.check("creator_token.ip", request.client.host if request.client else None)
+    if retry_after:
+        raise ratelimit.too_many_requests(retry_after)
+
+    with tracer.start_as_current_span("create_tokens_bulk") as span:
+        span.set_attribute("has_license_key", license_key is not None)
+        denied = await asyncio.to_thread(_license_error, license_key)
+        if denied:
+            BusinessMetrics.track_token_operation("bulk_create", False)
+            raise denied
+
+        # Read up front: the upload is closed once this handler returns, while
+        # rows are parsed and signed lazily as the response streams
+        data = await file.read(BULK_MAX_BYTES + 1)
+        if not data or len(data) > BULK_MAX_BYTES:
+            raise HTTPException(status_code=400, detail="Invalid file size")
+        span.set_attribute("file_size_bytes", len(data))
+
+    return StreamingResponse(
+        _bulk_tokens(read_buyers(data), product_id, prestamp),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="tokens.csv"'},
+    )
@@ -1,21 +1,187 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
-from ..utils.tokens import verify_token
+from fastapi import APIRouter, HTTPException, Request, Response
+from ..utils.tokens import SALE_DETAIL_FIELDS, verify_token
 from ..settings import settings
-from ..utils.pdf import stamp_pdf
+from ..stamping import render_copy, stamp_job
+from ..utils import ratelimit
+from ..utils.jobqueue import get_queue
+from ..utils.deadline import StampTimeout
+from ..utils.memcache import get_memory_cache
+from ..utils.product_config import ProductConfigError
+from ..utils.scheduler import QueueFull, get_scheduler
+from ..utils.sendfile import CachedFileResponse, StampedFileResponse
+from ..utils.storage import copy_key, source_pdf_path, stamped_pdf_path
 from ..monitoring import BusinessMetrics, tracer
 from opentelemetry.trace import Status, StatusCode
-import json
+from concurrent.futures import Future
+from pathlib import Path
+from email.utils import formatdate
+from typing import Optional, Tuple
+import asyncio
+import os
 import time
 import structlog
-import re
-import hashlib
 
 router = APIRouter()
 
+# Seconds between checks for a buyer who left while their copy is stamped
+DISCONNECT_POLL_SECONDS = 1.0
+
+
+def _record_stamp(result, stamping_time: float, product_id: str, logger, span) -> None:
+    BusinessMetrics.track_pdf_processing(stamping_time, True, "fingerprint" if result.mode == "metadata" else "stamp")
+    BusinessMetrics.track_stamp_output(result.output_bytes, result.mode, result.profile)
+    if result.peak_rss_bytes:
+        BusinessMetrics.track_stamp_memory(result.peak_rss_bytes, True)
+    logger.info(
+        "PDF stamped",
+        product_id=product_id,
+        mode=result.mode,
+        profile=result.profile,
+        pages=result.pages,
+        input_bytes=result.input_bytes,
+        output_bytes=result.output_bytes,
+        stamp_seconds=result.seconds,
+        peak_rss_bytes=result.peak_rss_bytes,
+    )
+
+    span.set_attribute("pdf_stamped", True)
+    span.set_attribute("stamp_mode", result.mode)
+    span.set_attribute("output_bytes", result.output_bytes)
+    span.set_attribute("stamping_time", stamping_time)
+
+
+def _stamp_inline(source: Path, out_file: Path, product_id: str, email: str, sale_id, details, logger, span) -> bool:
+    """Stamp in this process; returns False if another worker already had."""
+    from ..utils.isolation import MemoryLimitExceeded
+
+    stamping_start = time.time()
+    try:
+        result = render_copy(source, out_file, product_id, email, sale_id, details)
+    except MemoryLimitExceeded as e:
+        BusinessMetrics.track_download(False)
+        logger.error("Stamping exceeded memory limit", product_id=product_id, error=str(e))
+        span.record_exception(e)
+        raise HTTPException(status_code=503, detail="Document too large to stamp")
+    except ProductConfigError as e:
+        BusinessMetrics.track_download(False)
+        logger.error("Invalid product config", product_id=product_id, error=str(e))
+        span.record_exception(e)
+        raise HTTPException(status_code=500, detail="Product configuration invalid")
+    except StampTimeout as e:
+        BusinessMetrics.track_download(False)
+        logger.error("Stamping deadline exceeded", product_id=product_id, error=str(e))
+        span.record_exception(e)
+        raise HTTPException(status_code=503, detail="Document took too long to stamp") from e
+    if result is None:
+        return False
+    _record_stamp(result, time.time() - stamping_start, product_id, logger, span)
+    return True
+
+
+async def _stamp_queued(queue, source: Path, out_file: Path, product_id: str, email: str, sale_id, details, logger, span) -> bool:
+    """Hand the job to ``app.worker`` and wait for it; metrics are recorded by the worker."""
+    job_id, payload = stamp_job(source, out_file, product_id, email, sale_id, details)
+    await asyncio.to_thread(queue.enqueue, job_id, payload, "interactive")
+    span.set_attribute("stamp_job_id", job_id)
+    result = await queue.wait_async(job_id, settings.stamp_queue_wait_seconds)
+    if result is None:
+        BusinessMetrics.track_download(False)
+        logger.warning("Stamping job still pending", product_id=product_id, job_id=job_id)
+        raise HTTPException(status_code=503, detail="Stamping in progress, retry shortly", headers={"Retry-After": "5"})
+    if not result["ok"]:
+        BusinessMetrics.track_download(False)
+        logger.error("Stamping job failed", product_id=product_id, job_id=job_id, error=result.get("error"))
+        if result.get("reason") == "memory":
+            raise HTTPException(status_code=503, detail="Document too large to stamp")
+        if result.get("reason") == "timeout":
+            raise HTTPException(status_code=503, detail="Document took too long to stamp")
+        raise HTTPException(status_code=500, detail="Download failed")
+    return bool(result.get("stamped"))
+
+
+async def _await_stamp(job: Future, request: Request, product_id: str, logger) -> bool:
+    """Wait for an in-process stamping job while the buyer is still connected.
+
+    If they leave, a job that has not started is cancelled. One that is
+    running is left to finish: the copy is cached for their next attempt,
+    and the stamping deadline still bounds it.
+    """
+    waiting = asyncio.wrap_future(job)
+    while True:
+        done, _ = await asyncio.wait({waiting}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            return waiting.result()
+        if await request.is_disconnected():
+            cancelled = job.cancel()
+            # Nobody awaits the outcome any more
+            waiting.add_done_callback(lambda f: f.cancelled() or f.exception())
+            logger.info("Buyer disconnected during stamping", product_id=product_id, job_cancelled=cancelled)
+            raise HTTPException(status_code=499, detail="Client closed request")
+
+
+def _probe(source: Path, out_file: Path) -> Tuple[bool, Optional[os.stat_result]]:
+    """Source existence and stamped-copy stat in a single thread hop."""
+    if not source.exists():
+        return False, None
+    try:
+        return True, out_file.stat()
+    except FileNotFoundError:
+        return True, None
+
+
+async def _copy_status(token: str, request: Request) -> Optional[os.stat_result]:
+    """Stat of the token's stamped copy, None while it is not stamped yet.
+
+    Never stamps. Only the per-IP download budget is charged, so polling does
+    not use up the buyer's downloads.
+    """
+    retry_after = ratelimit.check("download.ip", request.client.host if request.client else None)
+    if retry_after:
+        raise ratelimit.too_many_requests(retry_after)
+    data = verify_token(token)
+    if not data:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    product_id, email = data.get("product_id"), data.get("email")
+    if not isinstance(product_id, str) or not isinstance(email, str):
+        raise HTTPException(status_code=400, detail="Token missing required fields")
+    source_exists, out_stat = await asyncio.to_thread(
+        _probe, source_pdf_path(product_id), stamped_pdf_path(product_id, copy_key(email, data.get("sale_id")))
+    )
+    if not source_exists:
+        raise HTTPException(status_code=404, detail="Source PDF not found")
+    return out_stat
+
+
+@router.head("/download/{token}")
+async def download_ready(token: str, request: Request):
+    """200 with the copy's size when it is stamped, 202 while it is not."""
+    out_stat = await _copy_status(token, request)
+    if out_stat is None:
+        return Response(status_code=202, headers={"Retry-After": "2"})
+    return Response(
+        status_code=200,
+        media_type="application/pdf",
+        headers={
+            "Content-Length": str(out_stat.st_size),
+            "Last-Modified": formatdate(out_stat.st_mtime, usegmt=True),
+        },
+    )
+
+
+@router.get("/download/{token}/status")
+async def download_status(token: str, request: Request):
+    out_stat = await _copy_status(token, request)
+    return {"ready": out_stat is not None, "size_bytes": out_stat.st_size if out_stat else None}
+
 
 @router.get("/download/{token}")
-def download_token(token: str):
+async def download_token(token: str, request: Request):
+    # Admission control before any signature check or disk access
+    client_ip = request.client.host if request.client else None
+    retry_after = ratelimit.check("download.ip", client_ip) or ratelimit.check("download.token", token)
+    if retry_after:
+        raise ratelimit.too_many_requests(retry_after)
+
     logger = structlog.get_logger("gumstamp.download")
     start_time = time.time()
     
@@ -33,6 +199,8 @@ def download_token(token: str):
             product_id = data.get("product_id")
             email = data.get("email")
             sale_id = data.get("sale_id")
+            # Optional sale fields for footer templates (full_name, price, date)
+            details = {k: data[k] for k in SALE_DETAIL_FIELDS if isinstance(data.get(k), str)}
             
             span.set_attribute("product_id", product_id or "")
             span.set_attribute("has_sale_id", sale_id is not None)
@@ -42,52 +210,73 @@ def download_token(token: str):
                 BusinessMetrics.track_download(False)
                 raise HTTPException(status_code=400, detail="Token missing required fields")
 
-            source = settings.storage_dir / "source" / f"{product_id}.pdf"
-            if not source.exists():
+            # Per-product budget is charged only for genuine tokens, so forged
+            # ones cannot exhaust a product's downloads
+            retry_after = ratelimit.check("download.product", product_id)
+            if retry_after:
                 BusinessMetrics.track_download(False)
-                raise HTTPException(status_code=404, detail="Source PDF not found")
+                raise ratelimit.too_many_requests(retry_after)
 
-            out_dir = settings.storage_dir / "stamped" / product_id
-            out_dir.mkdir(parents=True, exist_ok=True)
-            # Sanitize filename component
-            def _safe_name(val: str) -> str:
-                base = re.sub(r"[^A-Za-z0-9._-]", "_", val)[:120]
-                return base or hashlib.sha1(val.encode()).hexdigest()[:12]
+            source = source_pdf_path(product_id)
+            out_file = stamped_pdf_path(product_id, copy_key(email, sale_id))
 
-            name_part = _safe_name(sale_id) if isinstance(sale_id, str) and sale_id else _safe_name(email)
-            out_file = out_dir / f"{name_part}.pdf"
+            # Small popular copies are answered from memory without touching disk
+            memory = get_memory_cache()
+            cached = memory.get(out_file)
+            if memory.enabled:
+                BusinessMetrics.track_memory_cache(cached is not None)
+            if cached is not None:
+                BusinessMetrics.track_download(True, len(cached.body))
+                logger.info(
+                    "Download successful",
+                    product_id=product_id,
+                    file_size=len(cached.body),
+                    needs_stamping=False,
+                    memory_cache=True,
+                    total_time=time.time() - start_time
+                )
+                span.set_attribute("memory_cache_hit", True)
+                return CachedFileResponse(cached.body, cached.headers)
+
+            # Filesystem work runs off the event loop; a cache hit costs one
+            # thread hop here and none while sending
+            source_exists, out_stat = await asyncio.to_thread(_probe, source, out_file)
+            if not source_exists:
+                BusinessMetrics.track_download(False)
+                raise HTTPException(status_code=404, detail="Source PDF not found")
 
             # Check if we need to stamp the PDF
-            needs_stamping = not out_file.exists()
+            needs_stamping = out_stat is None
             
             if needs_stamping:
-                stamping_start = time.time()
-                
-                # Create stamped PDF on demand
-                footer = f"Purchased by {email}"
-                cfg_path = settings.storage_dir / "source" / f"{product_id}.json"
-                if cfg_path.exists():
+                # With a queue configured, stamping happens in app.worker
+                queue = get_queue()
+                if queue is None:
+                    # Buyer-facing work goes ahead of pre-warm and bulk jobs
                     try:
-                        cfg = json.loads(cfg_path.read_text())
-                        ft = cfg.get("footer_text")
-                        if isinstance(ft, str) and "{email}" in ft:
-                            footer = ft.replace("{email}", email)
-                    except Exception as e:
-                        logger.warning("Failed to load config", product_id=product_id, error=str(e))
-                        span.record_exception(e)
-                
-                stamp_pdf(input_path=source, output_path=out_file, footer_text=footer, diagonal_text=None)
-                
-                stamping_time = time.time() - stamping_start
-                BusinessMetrics.track_pdf_processing(stamping_time, True, "stamp")
-                
-                span.set_attribute("pdf_stamped", True)
-                span.set_attribute("stamping_time", stamping_time)
-            else:
+                        job = get_scheduler().submit(
+                            _stamp_inline, source, out_file, product_id, email, sale_id, details, logger, span,
+                            priority="interactive", tenant=product_id,
+                        )
+                    except QueueFull:
+                        BusinessMetrics.track_download(False)
+                        BusinessMetrics.track_stamp_quota_rejected("interactive")
+                        logger.warning("Stamping queue quota reached", product_id=product_id)
+                        raise HTTPException(
+                            status_code=503, detail="Too many downloads in progress, retry shortly",
+                            headers={"Retry-After": "5"},
+                        )
+                    needs_stamping = await _await_stamp(job, request, product_id, logger)
+                else:
+                    needs_stamping = await _stamp_queued(
+                        queue, source, out_file, product_id, email, sale_id, details, logger, span
+                    )
+                out_stat = await asyncio.to_thread(out_file.stat)
+            if not needs_stamping:
                 span.set_attribute("pdf_stamped", False)
 
             # Get file size for metrics
-            file_size = out_file.stat().st_size if out_file.exists() else 0
+            file_size = out_stat.st_size
             
             BusinessMetrics.track_download(True, file_size)
             
@@ -103,7 +292,14 @@ def download_token(token: str):
             span.set_attribute("file_size_bytes", file_size)
             span.set_attribute("total_time", total_time)
 
-            return FileResponse(path=out_file, media_type="application/pdf", filename=out_file.name)
+            response = StampedFileResponse(out_file, out_stat, filename=out_file.name)
+            if memory.accepts(file_size):
+                # Read once here and kept, instead of read by the response
+                body = await asyncio.to_thread(out_file.read_bytes)
+                if len(body) == file_size:
+                    memory.put(out_file, body, response.raw_headers)
+                    return CachedFileResponse(body, response.raw_headers)
+            return response
             
         except HTTPException:
             # Re-raise HTTP exceptions as-is
@@ -1,12 +1,17 @@
-from fastapi import APIRouter, Form
+import asyncio
+from fastapi import APIRouter, Form, HTTPException, Request
 from typing import Optional
-from ..utils.tokens import sign_token
+from ..monitoring import BusinessMetrics
+from ..utils import ratelimit
+from ..utils.sales import get_sale_log
+from ..utils.tokens import sale_details
 from ..settings import settings
 
 router = APIRouter()
 
 @router.post("/ping")
 async def gumroad_ping(
+    request: Request,
     sale_id: Optional[str] = Form(default=None),
     product_id: Optional[str] = Form(default=None),
     product_name: Optional[str] = Form(default=None),
@@ -16,20 +21,31 @@ async def gumroad_ping(
     currency: Optional[str] = Form(default=None),
     quantity: Optional[int] = Form(default=None),
     license_key: Optional[str] = Form(default=None),
+    sale_timestamp: Optional[str] = Form(default=None),
 ):
-    # Minimal: accept ping and return a signed download token. Future: enqueue pre-stamp task.
-    payload = {
-        "sale_id": sale_id,
-        "product_id": product_id,
-        "email": email,
-    }
-    token = sign_token(payload)
+    retry_after = ratelimit.check("ping.ip", request.client.host if request.client else None) or ratelimit.check(
+        "ping.product", product_id
+    )
+    if retry_after:
+        raise ratelimit.too_many_requests(retry_after)
+
+    if not (sale_id and product_id and email) or max(len(sale_id), len(product_id), len(email)) > 200:
+        raise HTTPException(status_code=400, detail="Ping must include sale_id, product_id and email")
+
+    # Retried deliveries of a sale get the token minted for the first one; the
+    # sale itself is written to the sales table in the background. A sale id
+    # not seen recently is looked up in SQLite, so ingest runs off the loop
+    token, duplicate = await asyncio.to_thread(
+        get_sale_log().ingest, sale_id, product_id, email, sale_details(full_name, price, currency, sale_timestamp)
+    )
+    BusinessMetrics.track_ping(duplicate)
     download_url = f"{settings.base_url}/download/{token}"
     return {
         "ok": True,
         "sale_id": sale_id,
         "product_id": product_id,
         "email": email,
+        "duplicate": duplicate,
         "token": token,
         "download_url": download_url,
     }
@@ -0,0 +1,196 @@
+"""
+Preforking server entry point: ``python -m app.serve``.
+
+The master process imports the application and the PDF stack once, binds the
+listening socket and forks ``WEB_CONCURRENCY`` Uvicorn workers that share it.
+Workers inherit the preloaded modules copy-on-write, so adding a worker costs
+a fork rather than a cold import. Exporters, the Sentry client and the
+stamping forkserver are started per worker by the application lifespan, never
+in the master, since their threads and sockets do not survive a fork.
+
+Workers coordinate through the shared storage volume: stamping is serialized
+per output file with ``app.utils.locks`` and indexes/caches live in the SQLite
+state database (``app.utils.db``).
+"""
+import argparse
+import ipaddress
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from typing import Dict, List, Optional
+
+from . import startup
+from .settings import settings
+
+# A worker that exits sooner than this after being spawned is considered to be
+# crash-looping; respawns are then delayed to avoid a fork storm.
+MIN_WORKER_LIFETIME = 1.0
+# Workers exiting within FAILED_START_SECONDS of being spawned count as failed
+# starts (bad settings, import errors, a failing lifespan: no respawn fixes
+# them); after MAX_FAILED_STARTS in a row the master gives up. The window is
+# wider than MIN_WORKER_LIFETIME because exits are reaped late while the
+# master sleeps.
+FAILED_START_SECONDS = 10.0
+MAX_FAILED_STARTS = 5
+# Matches the Dockerfile's EXPOSE and healthcheck.py
+DEFAULT_PORT = "10000"
+
+
+class ForwardedFor:
+    """Take the client address and scheme from proxy headers of trusted peers.
+
+    ``trusted`` is a comma-separated list of proxy addresses and networks
+    (``127.0.0.1,10.0.0.0/8``), or ``*`` to trust any peer. X-Forwarded-For is
+    read right to left and the first entry that is not a trusted proxy is the
+    client: each proxy appends the address it saw, so entries further left are
+    whatever the client sent and are never used.
+    """
+
+    def __init__(self, app, trusted: str):
+        self.app = app
+        items = [item.strip() for item in trusted.split(",") if item.strip()]
+        self.trust_any_peer = "*" in items
+        self.networks = [ipaddress.ip_network(item, strict=False) for item in items if item != "*"]
+
+    def _trusted(self, host: Optional[str]) -> bool:
+        try:
+            address = ipaddress.ip_address(host or "")
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+    def _client(self, forwarded: List[str]) -> Optional[str]:
+        for host in reversed(forwarded):
+            if not self._trusted(host):
+                return host
+        return forwarded[0] if forwarded else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            peer = scope.get("client")
+            if self.trust_any_peer or self._trusted(peer[0] if peer else None):
+                headers = dict(scope["headers"])
+                proto = headers.get(b"x-forwarded-proto")
+                forwarded = headers.get(b"x-forwarded-for")
+                if proto or forwarded:
+                    scope = dict(scope)
+                if proto:
+                    proto = proto.decode("latin-1").strip()
+                    scope["scheme"] = proto.replace("http", "ws") if scope["type"] == "websocket" else proto
+                if forwarded:
+                    client = self._client([h.strip() for h in forwarded.decode("latin-1").split(",") if h.strip()])
+                    if client:
+                        scope["client"] = (client, 0)
+        return await self.app(scope, receive, send)
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, sock: socket.socket) -> None:
+    import uvicorn
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # uvicorn's own proxy header handling takes the leftmost X-Forwarded-For
+    # entry when every peer is trusted, which the client controls
+    config = uvicorn.Config(ForwardedFor(app, settings.forwarded_allowed_ips), proxy_headers=False)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _spawn(app, sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _run_worker(app, sock)
+        except BaseException:
+            traceback.print_exc()
+            sys.stderr.flush()
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve(host: str, port: int, workers: int) -> int:
+    """Run the master until stopped; returns the process exit code."""
+    # Preload in the master so workers start warm
+    from .main import app
+    startup.preload(startup.PDF_MODULES)
+
+    sock = _bind(host, port)
+    print(f"gumstamp: listening on {host}:{port} with {workers} workers", file=sys.stderr)
+
+    children: Dict[int, float] = {}
+    stopping = False
+    exit_code = 0
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    for _ in range(workers):
+        children[_spawn(app, sock)] = time.monotonic()
+
+    failed_starts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        lifetime = time.monotonic() - started
+        if lifetime < FAILED_START_SECONDS:
+            failed_starts += 1
+            if failed_starts >= MAX_FAILED_STARTS:
+                print(
+                    f"gumstamp: workers exited right after start {failed_starts} times in a row, giving up",
+                    file=sys.stderr,
+                )
+                _stop(None, None)
+                exit_code = 1
+                continue
+        else:
+            failed_starts = 0
+        print(f"gumstamp: worker {pid} exited ({code}) after {lifetime:.1f}s, respawning", file=sys.stderr)
+        if lifetime < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+        children[_spawn(app, sock)] = time.monotonic()
+
+    sock.close()
+    return exit_code
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.serve", description="Run Gumstamp with preforked workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", DEFAULT_PORT)))
+    parser.add_argument("--workers", type=int, default=settings.web_concurrency)
+    args = parser.parse_args(argv)
+    return serve(args.host, args.port, max(1, args.workers))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
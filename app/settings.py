@@ -1,8 +1,39 @@
 from pydantic import BaseModel
 from pathlib import Path
+import math
 import os
 
 
+def _cgroup_cpu_quota() -> float | None:
+    """CPU quota of this process's cgroup in CPUs, None when unlimited."""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            quota = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text().strip()
+            period = Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            return None
+    try:
+        return int(quota) / int(period) if quota not in ("max", "-1") else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def available_cpus() -> int:
+    """CPUs this process can use: its affinity mask, capped by the cgroup CPU
+    quota (a container's share of the host; 0.5 CPU counts as 1)."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
 class Settings(BaseModel):
     secret_key: str = os.getenv("SECRET_KEY", "dev_secret")
     storage_dir: Path = Path(os.getenv("STORAGE_DIR", "./storage")).resolve()
@@ -20,6 +51,74 @@ class Settings(BaseModel):
     enable_tracing: bool = os.getenv("ENABLE_TRACING", "true").lower() == "true"
     enable_metrics: bool = os.getenv("ENABLE_METRICS", "true").lower() == "true"
 
+    # Startup: "background" loads exporters and PDF libraries after the app is
+    # serving; "eager" loads everything before the first request is accepted.
+    warmup_mode: str = os.getenv("WARMUP_MODE", "background").lower()
+
+    # Stamping: sources at or above the threshold use the low-memory streaming
+    # path in a child process capped at the per-job memory ceiling. Uploads
+    # are capped at 10 MB, so by default only the largest take that path (an
+    # extra fork per copy, and no object dedupe for the "small" profile).
+    low_memory_threshold_mb: int = int(os.getenv("LOW_MEMORY_THRESHOLD_MB", "8"))
+    stamp_memory_limit_mb: int = int(os.getenv("STAMP_MEMORY_LIMIT_MB", "512"))
+    # Deadline per stamping job (0 disables): checked between pages, and
+    # child processes still running shortly after it are killed
+    stamp_timeout_seconds: float = float(os.getenv("STAMP_TIMEOUT_SECONDS", "120"))
+
+    # Serving: number of worker processes forked by ``python -m app.serve``
+    # (default: available CPUs, see available_cpus)
+    web_concurrency: int = int(os.getenv("WEB_CONCURRENCY", str(available_cpus())))
+    # Peers trusted to set X-Forwarded-For/-Proto: addresses and networks,
+    # comma-separated ("*" trusts any peer); the client is the rightmost
+    # forwarded address that is not one of them
+    forwarded_allowed_ips: str = os.getenv("FORWARDED_ALLOWED_IPS", "127.0.0.1")
+
+    # Stamping queue: empty stamps inline in the web process; "sqlite" or a
+    # redis://host:port/db URL hands jobs to ``python -m app.worker``
+    stamp_queue: str = os.getenv("STAMP_QUEUE", "")
+    stamp_queue_wait_seconds: float = float(os.getenv("STAMP_QUEUE_WAIT_SECONDS", "30"))
+
+    # Stamping scheduler: parallel stamping jobs per process (default: this
+    # worker's share of the CPUs), per-class caps ("interactive=4,prewarm=2,
+    # bulk=1") and seconds of waiting that promote a job by one priority class
+    stamp_concurrency: int = int(os.getenv("STAMP_CONCURRENCY", str(max(1, available_cpus() // web_concurrency))))
+    stamp_class_caps: str = os.getenv("STAMP_CLASS_CAPS", "")
+    stamp_aging_seconds: float = float(os.getenv("STAMP_AGING_SECONDS", "30"))
+    # Fair share between products within a class: weights
+    # ("launch-product=2,backfill=0.5", default 1), and per-product limits on
+    # running jobs (across classes) and queued jobs per class; 0 means no limit
+    stamp_tenant_weights: str = os.getenv("STAMP_TENANT_WEIGHTS", "")
+    stamp_tenant_max_running: int = int(os.getenv("STAMP_TENANT_MAX_RUNNING", "0"))
+    stamp_tenant_max_queued: int = int(os.getenv("STAMP_TENANT_MAX_QUEUED", "1000"))
+
+    # Rate limits per scope, e.g. "download.ip=30/60,ping.ip=600/60"; "off"
+    # disables all (see app.utils.ratelimit for scopes and defaults)
+    rate_limits: str = os.getenv("RATE_LIMITS", "")
+
+    # Downloads: let a reverse proxy send stamped files (zero-copy). Set to
+    # "X-Accel-Redirect" (nginx, files mapped under SENDFILE_PREFIX) or
+    # "X-Sendfile" (Apache/lighttpd, absolute path); empty serves in-process.
+    sendfile_header: str = os.getenv("SENDFILE_HEADER", "")
+    sendfile_prefix: str = os.getenv("SENDFILE_PREFIX", "/_stamped")
+    # Gumroad pings are acknowledged immediately and new sales written to the
+    # sales table in batches of up to this size, at least this often
+    ping_batch_size: int = int(os.getenv("PING_BATCH_SIZE", "200"))
+    ping_flush_seconds: float = float(os.getenv("PING_FLUSH_SECONDS", "0.2"))
+    # Background storage GC: one slice of at most GC_SLICE_MS every
+    # GC_INTERVAL_SECONDS (0 disables). Above GC_DISK_TARGET_PERCENT disk usage
+    # the oldest copies are evicted; /health fails at 90%.
+    gc_interval_seconds: float = float(os.getenv("GC_INTERVAL_SECONDS", "2"))
+    gc_slice_ms: float = float(os.getenv("GC_SLICE_MS", "50"))
+    gc_disk_target_percent: float = float(os.getenv("GC_DISK_TARGET_PERCENT", "80"))
+    # Half-written files older than this are left over from crashed jobs
+    gc_temp_max_age_seconds: float = float(os.getenv("GC_TEMP_MAX_AGE_SECONDS", "3600"))
+    # Memory tier for small stamped copies, per worker process: total byte
+    # budget (0 disables; also off with SENDFILE_HEADER), largest copy kept and
+    # seconds before an entry is re-read from disk
+    memory_cache_max_bytes: int = int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    memory_cache_max_item_bytes: int = int(os.getenv("MEMORY_CACHE_MAX_ITEM_BYTES", str(1024 * 1024)))
+    memory_cache_ttl_seconds: float = float(os.getenv("MEMORY_CACHE_TTL_SECONDS", "30"))
+
 
 settings = Settings()
 settings.storage_dir.mkdir(parents=True, exist_ok=True)
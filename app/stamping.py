@@ -0,0 +1,319 @@
+"""
+Rendering of buyer copies, shared by the web tier and ``app.worker``.
+
+``render_copy`` loads the product's stamping settings, renders the copy with
+the configured mode and records it in the stamped index. Layers that are the
+same for every buyer (pattern, logo, a diagonal without variables) are merged
+once into a per-product base PDF by ``ensure_base``; buyer copies are stamped
+from that base and only add their own footer. ``render_copy`` holds the
+per-output lock, so concurrent callers on any process or node sharing the
+storage volume render a given copy once. Metrics, logging and HTTP concerns
+stay with the caller.
+"""
+import hashlib
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import structlog
+
+from .settings import settings
+from .utils import cache_index
+from .utils.deadline import StampTimeout, check_deadline, remaining, stamp_deadline
+from .utils.fingerprints import record_fingerprint
+from .utils.locks import file_lock
+from .utils.product_config import ProductConfig, product_configs
+from .utils.storage import base_pdf_path, copy_key, font_path, logo_asset_path, source_pdf_path, stamped_pdf_path
+from .utils.templates import TEMPLATE_VARIABLES
+from .utils.tokens import buyer_fingerprint
+
+logger = structlog.get_logger("gumstamp.stamping")
+
+
+def template_values(email: str, sale_id: Optional[str], details: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    """Variables for footer/diagonal templates.
+
+    ``details`` carries the optional sale fields stored in the download token
+    (full_name, price, date); ``date`` defaults to today (UTC).
+    """
+    values = {"email": email, "sale_id": sale_id or "", "date": time.strftime("%Y-%m-%d", time.gmtime())}
+    for name, value in (details or {}).items():
+        if name in TEMPLATE_VARIABLES and isinstance(value, str) and value:
+            values[name] = value
+    return values
+
+
+def render_copy(
+    source: Path,
+    out_file: Path,
+    product_id: str,
+    email: str,
+    sale_id: Optional[str] = None,
+    details: Optional[Dict[str, Any]] = None,
+):
+    """Render the buyer's copy of ``source`` into ``out_file``.
+
+    Returns the StampResult, or None when the copy already existed (for
+    example because another worker finished it while this one waited for the
+    lock). Raises MemoryLimitExceeded when a large document exceeds the
+    per-job memory ceiling.
+    """
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    # Outside the output lock: lock stripes are not reentrant, and the base
+    # and the copy may hash to the same stripe
+    base = ensure_base(product_id, source)
+    with file_lock(str(out_file)):
+        if out_file.exists():
+            return None
+        result = render(source, out_file, product_id, email, sale_id, details, base)
+        cache_index.record_stamped(out_file, product_id, result.output_bytes, source.stat().st_mtime)
+        record_fingerprint(buyer_fingerprint(product_id, email, sale_id), product_id, email, sale_id, out_file)
+        return result
+
+
+def stamp_job(
+    source: Path,
+    out_file: Path,
+    product_id: str,
+    email: str,
+    sale_id: Optional[str] = None,
+    details: Optional[Dict[str, Any]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """Describe a render_copy call as a queue job: ``(job_id, payload)``.
+
+    Paths are stored relative to STORAGE_DIR so workers may mount the shared
+    volume elsewhere. The id is derived from the output path, so repeated
+    requests for the same copy map to the same job.
+    """
+    rel_out = str(out_file.relative_to(settings.storage_dir))
+    payload = {
+        "source": str(source.relative_to(settings.storage_dir)),
+        "out_file": rel_out,
+        "product_id": product_id,
+        "email": email,
+        "sale_id": sale_id,
+        "details": details or {},
+    }
+    return hashlib.sha1(rel_out.encode("utf-8")).hexdigest()[:24], payload
+
+
+def prestamp(
+    product_id: str,
+    email: str,
+    sale_id: Optional[str] = None,
+    details: Optional[Dict[str, Any]] = None,
+    priority: str = "prewarm",
+) -> bool:
+    """Start stamping a buyer's copy in the background, ahead of the download.
+
+    Uses the job queue when one is configured, else this process's scheduler.
+    A later download of the same copy joins the job (the queue promotes it to
+    interactive). Returns False when nothing was started: the copy already
+    exists, the product has no source, or its scheduler queue quota is full.
+    """
+    source = source_pdf_path(product_id)
+    out_file = stamped_pdf_path(product_id, copy_key(email, sale_id))
+    if not source.exists() or out_file.exists():
+        return False
+    from .utils.jobqueue import get_queue
+
+    queue = get_queue()
+    if queue is not None:
+        job_id, payload = stamp_job(source, out_file, product_id, email, sale_id, details)
+        queue.enqueue(job_id, payload, priority=priority)
+        return True
+
+    from .monitoring import BusinessMetrics
+    from .utils.scheduler import QueueFull, get_scheduler
+
+    def _done(job) -> None:
+        if job.exception() is not None:
+            logger.warning("Pre-stamp failed", product_id=product_id, error=str(job.exception()))
+
+    try:
+        job = get_scheduler().submit(
+            render_copy, source, out_file, product_id, email, sale_id, details, priority=priority, tenant=product_id
+        )
+    except QueueFull:
+        # Over the product's queue quota: stamped on first download instead
+        BusinessMetrics.track_stamp_quota_rejected(priority)
+        return False
+    job.add_done_callback(_done)
+    return True
+
+
+def run_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Execute a queued job; the returned dict is the job's result."""
+    from .utils.isolation import MemoryLimitExceeded
+
+    start = time.time()
+    try:
+        result = render_copy(
+            settings.storage_dir / payload["source"],
+            settings.storage_dir / payload["out_file"],
+            payload["product_id"],
+            payload["email"],
+            payload.get("sale_id"),
+            payload.get("details"),
+        )
+    except MemoryLimitExceeded as e:
+        return {"ok": False, "reason": "memory", "error": str(e)}
+    except StampTimeout as e:
+        return {"ok": False, "reason": "timeout", "error": str(e)}
+    except Exception as e:
+        return {"ok": False, "reason": "error", "error": f"{type(e).__name__}: {e}"}
+    if result is None:
+        return {"ok": True, "stamped": False}
+    return {"ok": True, "stamped": True, "seconds": time.time() - start, **result.model_dump()}
+
+
+def _static_diagonal(cfg: ProductConfig) -> bool:
+    """Whether the diagonal text is the same for every buyer."""
+    return cfg.diagonal_template is not None and not cfg.diagonal_template.variables
+
+
+def _has_base_layers(cfg: ProductConfig) -> bool:
+    return cfg.mode != "metadata" and bool(cfg.pattern or cfg.logo or _static_diagonal(cfg))
+
+
+def _base_inputs(product_id: str, source: Path, cfg: ProductConfig) -> int:
+    """Newest mtime (ns) of everything the base PDF is built from.
+
+    Raises FileNotFoundError when the source is gone, e.g. removed by storage
+    GC or a new upload between the caller's check and this one.
+    """
+    try:
+        newest = source.stat().st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Source PDF for product {product_id} not found: {source}") from None
+    paths = [product_configs.path(product_id)]
+    if cfg.logo:
+        paths.append(logo_asset_path(product_id))
+    if cfg.font:
+        paths.append(font_path(cfg.font))
+    return max([newest] + [p.stat().st_mtime_ns for p in paths if p.exists()])
+
+
+def ensure_base(product_id: str, source: Path, base: Optional[Path] = None) -> Optional[Path]:
+    """Return the product's base PDF, building it when missing or stale.
+
+    ``base`` defaults to the product's base in STORAGE_DIR. Returns None when
+    the product has no buyer-independent layers, in which case copies are
+    stamped straight from the source. The base's mtime is set to the newest
+    mtime of its inputs as they were when the build started, so an upload
+    landing mid-build leaves it stale rather than silently wrong. Raises
+    FileNotFoundError when the source is missing.
+    """
+    cfg = product_configs.get(product_id)
+    if not _has_base_layers(cfg):
+        return None
+    base = base or base_pdf_path(product_id)
+    inputs = _base_inputs(product_id, source, cfg)
+    if base.exists() and base.stat().st_mtime_ns == inputs:
+        return base
+
+    with file_lock(str(base)):
+        cfg = product_configs.get(product_id)
+        inputs = _base_inputs(product_id, source, cfg)
+        if base.exists() and base.stat().st_mtime_ns == inputs:
+            return base
+        tmp = base.with_suffix(".building.pdf")
+        _stamp(dict(
+            input_path=source,
+            output_path=tmp,
+            footer_text=None,
+            diagonal_text=cfg.diagonal_for({}) if _static_diagonal(cfg) else None,
+            pattern=cfg.pattern,
+            logo=cfg.logo,
+            logo_asset=logo_asset_path(product_id) if cfg.logo else None,
+            font=font_path(cfg.font) if cfg.font else None,
+            profile=cfg.profile,
+            diagonal_style=cfg.diagonal,
+        ))
+        os.utime(tmp, ns=(inputs, inputs))
+        tmp.replace(base)
+    return base
+
+
+def _stamp(stamp_kwargs: Dict[str, Any]):
+    """Run one stamp under the STAMP_TIMEOUT_SECONDS deadline.
+
+    Raises StampTimeout when it is exceeded; the deadline applies from when
+    the job starts running, not from when it was queued.
+    """
+    from .monitoring import BusinessMetrics
+    from .utils.pdf import stamp_pdf, stamp_pdf_streaming
+    from .utils.isolation import run_isolated
+
+    try:
+        with stamp_deadline(settings.stamp_timeout_seconds):
+            check_deadline()
+            if stamp_kwargs["input_path"].stat().st_size >= settings.low_memory_threshold_mb * 1024 * 1024:
+                # Large sources: page-by-page writer in a child process with a
+                # hard memory ceiling, killed if it hangs past the deadline
+                result, peak_rss = run_isolated(
+                    stamp_pdf_streaming,
+                    memory_limit=settings.stamp_memory_limit_mb * 1024 * 1024,
+                    timeout=remaining(),
+                    **stamp_kwargs,
+                )
+                result.peak_rss_bytes = peak_rss
+                return result
+            return stamp_pdf(**stamp_kwargs)
+    except StampTimeout as e:
+        # A killed child had no chance to remove its partial output
+        out = stamp_kwargs["output_path"]
+        out.with_suffix(out.suffix + ".tmp").unlink(missing_ok=True)
+        BusinessMetrics.track_stamp_timeout(e.killed)
+        logger.warning("Stamping deadline exceeded", input_path=str(stamp_kwargs["input_path"]), killed=e.killed)
+        raise
+
+
+def render(
+    source: Path,
+    out_file: Path,
+    product_id: str,
+    email: str,
+    sale_id: Optional[str] = None,
+    details: Optional[Dict[str, Any]] = None,
+    base: Optional[Path] = None,
+):
+    """Stamp one copy with the product's settings; no locking or indexing.
+
+    ``base`` is the product's base PDF from ``ensure_base``, if it has one.
+    """
+    # Raises ProductConfigError for a corrupt config instead of stamping with
+    # defaults the creator never chose
+    cfg = product_configs.get(product_id)
+    values = template_values(email, sale_id, details)
+
+    # Imported lazily: pypdf/reportlab are preloaded by the startup
+    # warm-up and are not needed to serve cached copies.
+    from .utils.pdf import fingerprint_pdf
+
+    fingerprint = buyer_fingerprint(product_id, email, sale_id)
+    if cfg.mode == "metadata":
+        # Silent tracing: metadata-only incremental update, no page rewriting
+        return fingerprint_pdf(source, out_file, fingerprint, marker=cfg.marker)
+
+    stamp_kwargs = dict(
+        input_path=source,
+        output_path=out_file,
+        footer_text=cfg.footer_for(values),
+        diagonal_text=cfg.diagonal_for(values),
+        pattern=cfg.pattern,
+        logo=cfg.logo,
+        logo_asset=logo_asset_path(product_id) if cfg.logo else None,
+        font=font_path(cfg.font) if cfg.font else None,
+        fingerprint=fingerprint,
+        profile=cfg.profile,
+        footer_style=cfg.footer,
+        diagonal_style=cfg.diagonal,
+    )
+    if base is not None:
+        # Pattern, logo and a static diagonal are already in the base
+        stamp_kwargs.update(input_path=base, pattern=None, logo=None, logo_asset=None)
+        if _static_diagonal(cfg):
+            stamp_kwargs["diagonal_text"] = None
+    return _stamp(stamp_kwargs)
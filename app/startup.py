@@ -0,0 +1,116 @@
+"""
+Startup timing and background warm-up for Gumstamp.
+
+Heavy dependencies (OpenTelemetry SDK and exporters, Sentry, psutil, pypdf,
+reportlab) are kept off the import path of ``app.main`` so a cold instance can
+answer ``/healthz`` as early as possible. They are loaded on first use or by the
+warm-up task scheduled from the application lifespan, and every phase is timed
+so the breakdown can be inspected at ``/metrics/startup``.
+"""
+
+import asyncio
+import importlib
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Reference point for all startup timings: the moment this module is imported,
+# which is the first thing app.main does.
+_t0 = time.perf_counter()
+_started_at = time.time()
+
+_lock = threading.Lock()
+_phases: Dict[str, float] = {}
+_imports: Dict[str, Dict[str, Any]] = {}
+_warmup: Dict[str, Any] = {"state": "pending", "steps": {}}
+_warmup_task: Optional["asyncio.Task[None]"] = None
+
+# Modules that make up the bulk of the PDF stamping import cost
+PDF_MODULES = (
+    "pypdf",
+    "reportlab.pdfgen.canvas",
+    "reportlab.lib.colors",
+    "app.utils.pdf",
+)
+
+
+def _elapsed_ms() -> float:
+    return round((time.perf_counter() - _t0) * 1000, 2)
+
+
+def mark(phase: str) -> None:
+    """Record when a startup phase was reached (first occurrence wins)."""
+    with _lock:
+        _phases.setdefault(phase, _elapsed_ms())
+
+
+def timed_import(name: str) -> Any:
+    """Import a module and record how long it took.
+
+    Modules that were already loaded are recorded with ``cached=True`` so the
+    report shows which imports actually paid the cost.
+    """
+    cached = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    duration = round((time.perf_counter() - start) * 1000, 2)
+    with _lock:
+        _imports.setdefault(name, {"ms": duration, "cached": cached, "at_ms": _elapsed_ms()})
+    return module
+
+
+def preload(modules: Sequence[str]) -> None:
+    """Import each module in order, recording per-module timings."""
+    for name in modules:
+        timed_import(name)
+
+
+def _run_steps(steps: List[Tuple[str, Callable[[], None]]]) -> None:
+    _warmup["state"] = "running"
+    for name, fn in steps:
+        start = time.perf_counter()
+        error = None
+        try:
+            fn()
+        except Exception as e:  # warm-up must never take the process down
+            error = str(e)
+        _warmup["steps"][name] = {
+            "ms": round((time.perf_counter() - start) * 1000, 2),
+            "error": error,
+        }
+    _warmup["state"] = "done"
+    mark("warmup_complete")
+
+
+def warm_up(steps: List[Tuple[str, Callable[[], None]]]) -> None:
+    """Run warm-up steps synchronously (used for eager startup)."""
+    _run_steps(steps)
+
+
+def start_warm_up(steps: List[Tuple[str, Callable[[], None]]]) -> "asyncio.Task[None]":
+    """Schedule warm-up steps in a worker thread without blocking startup."""
+    global _warmup_task
+    _warmup_task = asyncio.create_task(asyncio.to_thread(_run_steps, steps))
+    return _warmup_task
+
+
+def warm_up_complete() -> bool:
+    return _warmup["state"] == "done"
+
+
+def get_startup_report() -> Dict[str, Any]:
+    """Startup phases and import-time breakdown, slowest imports first."""
+    with _lock:
+        imports = sorted(
+            ({"module": k, **v} for k, v in _imports.items()),
+            key=lambda item: item["ms"],
+            reverse=True,
+        )
+        return {
+            "started_at": _started_at,
+            "uptime_ms": _elapsed_ms(),
+            "phases_ms": dict(_phases),
+            "imports": imports,
+            "warmup": {"state": _warmup["state"], "steps": dict(_warmup["steps"])},
+        }
@@ -0,0 +1,28 @@
+"""Buyer lists for bulk token minting and offline stamping.
+
+A list is either CSV with a header row or NDJSON (one object per line); the
+format is detected from the first non-blank character. Columns/keys are the
+token fields: product_id, email, sale_id, full_name, price, date.
+"""
+import csv
+import io
+import json
+from typing import Any, Dict, Iterator, Tuple, Union
+
+
+def read_buyers(data: bytes) -> Iterator[Tuple[int, Union[Dict[str, Any], str]]]:
+    """``(line number, row or error message)`` for each buyer in ``data``."""
+    text = data.decode("utf-8-sig", errors="replace")
+    if text.lstrip().startswith("{"):
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else "Invalid JSON"
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        for row in reader:
+            yield reader.line_num, {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
@@ -0,0 +1,68 @@
+"""Index of stamped copies shared by all worker processes.
+
+Each finished stamp is recorded with its size and the source's mtime at the
+time of stamping, so maintenance and metrics can work from the index instead
+of walking the stamped directory tree.
+"""
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .db import connect, register_schema
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS stamped (
+    path TEXT PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    source_mtime REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stamped_product ON stamped (product_id);
+CREATE INDEX IF NOT EXISTS stamped_created ON stamped (created_at);
+""")
+
+
+def record_stamped(path: Path, product_id: str, size: int, source_mtime: float) -> None:
+    connect().execute(
+        "INSERT OR REPLACE INTO stamped (path, product_id, size, source_mtime, created_at) VALUES (?, ?, ?, ?, ?)",
+        (str(path), product_id, size, source_mtime, time.time()),
+    )
+
+
+def lookup_stamped(path: Path) -> Optional[Dict[str, Any]]:
+    row = connect().execute(
+        "SELECT product_id, size, source_mtime, created_at FROM stamped WHERE path = ?", (str(path),)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"product_id": row[0], "size": row[1], "source_mtime": row[2], "created_at": row[3]}
+
+
+def move_stamped(moves: Iterable[Tuple[Path, Path]]) -> None:
+    """Re-key entries of copies that were moved (``app.cli migrate-stamped``)."""
+    conn = connect()
+    conn.execute("BEGIN")
+    conn.executemany(
+        "UPDATE OR REPLACE stamped SET path = ? WHERE path = ?", [(str(new), str(old)) for old, new in moves]
+    )
+    conn.execute("COMMIT")
+
+
+def forget_stamped(paths: Iterable[Path]) -> None:
+    conn = connect()
+    conn.execute("BEGIN")
+    conn.executemany("DELETE FROM stamped WHERE path = ?", [(str(path),) for path in paths])
+    conn.execute("COMMIT")
+
+
+def oldest_stamped(limit: int, offset: int = 0) -> List[Tuple[Path, int]]:
+    """``(path, size)`` of the least recently stamped copies, skipping the first ``offset``."""
+    rows = connect().execute(
+        "SELECT path, size FROM stamped ORDER BY created_at LIMIT ? OFFSET ?", (limit, offset)
+    ).fetchall()
+    return [(Path(path), size) for path, size in rows]
+
+
+def stamped_totals() -> Dict[str, int]:
+    count, size = connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM stamped").fetchone()
+    return {"files": count, "bytes": size}
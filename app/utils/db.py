@@ -0,0 +1,42 @@
+"""SQLite state shared by every worker process on an instance.
+
+One database file under STORAGE_DIR holds small indexes and caches (stamped
+copies, licence checks, ...). SQLite's own file locking makes it safe across
+the preforked workers started by ``app.serve``; WAL mode keeps readers from
+blocking the single writer. Connections are per thread and re-opened after a
+fork, since SQLite handles must not cross process boundaries.
+"""
+import os
+import sqlite3
+import threading
+from typing import List
+from ..settings import settings
+
+_local = threading.local()
+_schemas: List[str] = []
+
+
+def register_schema(ddl: str) -> None:
+    """Register ``CREATE ... IF NOT EXISTS`` statements run on every new connection."""
+    _schemas.append(ddl)
+
+
+def connect() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.schemas == len(_schemas):
+        return conn
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(
+            str(settings.storage_dir / "state.sqlite3"),
+            timeout=10.0,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    for ddl in _schemas:
+        conn.executescript(ddl)
+    _local.conn = conn
+    _local.pid = os.getpid()
+    _local.schemas = len(_schemas)
+    return conn
@@ -0,0 +1,52 @@
+"""Deadlines for stamping jobs.
+
+Work runs under ``stamp_deadline(seconds)`` and long loops call
+``check_deadline()`` between pages, so a pathological document stops with
+``StampTimeout`` instead of holding a core indefinitely. The deadline lives in
+a context variable: it follows a job into the scheduler's pool threads, and
+nested deadlines can only shorten it. Work in a child process is bounded by
+``run_isolated(timeout=...)``, which kills the process if it does not stop on
+its own.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+
+class StampTimeout(RuntimeError):
+    """The job ran past its deadline; ``killed`` if its process was killed."""
+
+    def __init__(self, message: str, killed: bool = False):
+        super().__init__(message)
+        self.killed = killed
+
+
+_expires_at: ContextVar[Optional[float]] = ContextVar("stamp_deadline", default=None)
+
+
+@contextmanager
+def stamp_deadline(seconds: Optional[float]) -> Iterator[None]:
+    """Bound the enclosed work to ``seconds`` (None or 0: no new limit)."""
+    if not seconds:
+        yield
+        return
+    expires = time.monotonic() + seconds
+    current = _expires_at.get()
+    token = _expires_at.set(expires if current is None else min(current, expires))
+    try:
+        yield
+    finally:
+        _expires_at.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, None without one."""
+    expires = _expires_at.get()
+    return None if expires is None else max(0.0, expires - time.monotonic())
+
+
+def check_deadline() -> None:
+    expires = _expires_at.get()
+    if expires is not None and time.monotonic() >= expires:
+        raise StampTimeout("Stamping deadline exceeded")
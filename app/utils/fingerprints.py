@@ -0,0 +1,65 @@
+"""Leak-tracing index: buyer fingerprint -> who the copy was stamped for.
+
+Every stamped copy carries ``buyer_fingerprint(product_id, email, sale_id)``
+in its metadata (Info dictionary, plus XMP and an optional marker object in
+metadata mode). The fingerprint is a keyed hash and cannot be reversed, so
+each stamping job records it here; resolving a leaked file is then a primary
+key lookup instead of a scan of the stamped tree.
+"""
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .db import connect, register_schema
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS fingerprints (
+    fingerprint TEXT PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    email TEXT NOT NULL,
+    sale_id TEXT,
+    path TEXT,
+    stamped_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS fingerprints_email ON fingerprints (email);
+""")
+
+_COLUMNS = ("fingerprint", "product_id", "email", "sale_id", "path", "stamped_at")
+
+
+def record_fingerprint(
+    fingerprint: str, product_id: str, email: str, sale_id: Optional[str], path: Optional[Path] = None
+) -> None:
+    connect().execute(
+        "INSERT OR REPLACE INTO fingerprints (fingerprint, product_id, email, sale_id, path, stamped_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        (fingerprint, product_id, email, sale_id, str(path) if path else None, time.time()),
+    )
+
+
+def resolve_fingerprint(fingerprint: str) -> Optional[Dict[str, Any]]:
+    row = connect().execute(
+        f"SELECT {', '.join(_COLUMNS)} FROM fingerprints WHERE fingerprint = ?", (fingerprint,)
+    ).fetchone()
+    return dict(zip(_COLUMNS, row)) if row else None
+
+
+def copies_for_email(email: str) -> List[Dict[str, Any]]:
+    """Every recorded copy stamped for ``email`` (used when metadata was stripped)."""
+    rows = connect().execute(
+        f"SELECT {', '.join(_COLUMNS)} FROM fingerprints WHERE email = ? ORDER BY stamped_at", (email,)
+    ).fetchall()
+    return [dict(zip(_COLUMNS, row)) for row in rows]
+
+
+def move_paths(moves: Iterable[Tuple[Path, Path]]) -> None:
+    """Point entries at copies that were moved, in one pass over the index."""
+    conn = connect()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS moved_paths (old TEXT PRIMARY KEY, new TEXT NOT NULL)")
+    conn.execute("BEGIN")
+    conn.execute("DELETE FROM moved_paths")
+    conn.executemany("INSERT OR REPLACE INTO moved_paths VALUES (?, ?)", [(str(old), str(new)) for old, new in moves])
+    conn.execute(
+        "UPDATE fingerprints SET path = (SELECT new FROM moved_paths WHERE old = fingerprints.path)"
+        " WHERE path IN (SELECT old FROM moved_paths)"
+    )
+    conn.execute("COMMIT")
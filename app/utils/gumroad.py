@@ -1,6 +1,9 @@
+import hashlib
 import http.client
+import time
 import urllib.parse
 from typing import Optional
+from .db import connect, register_schema
 
 
 def verify_license(license_key: str, product_permalink: str) -> Optional[dict]:
@@ -31,3 +34,37 @@ def verify_license(license_key: str, product_permalink: str) -> Optional[dict]:
         return None
     finally:
         conn.close()
+
+
+# Results of licence checks are cached in the shared state database so every
+# worker process benefits from a verification done by any other. Only the
+# outcome is stored, keyed by a hash of the key; failures expire quickly so a
+# newly bought licence is not locked out.
+LICENSE_CACHE_TTL = 3600
+LICENSE_NEGATIVE_TTL = 60
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS license_cache (
+    key TEXT PRIMARY KEY,
+    ok INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+""")
+
+
+def verify_license_cached(license_key: str, product_permalink: str) -> bool:
+    """Like verify_license, but cached across requests and worker processes."""
+    key = hashlib.sha256(f"{product_permalink}\0{license_key}".encode("utf-8")).hexdigest()
+    conn = connect()
+    now = time.time()
+    row = conn.execute("SELECT ok, expires_at FROM license_cache WHERE key = ?", (key,)).fetchone()
+    if row is not None and row[1] > now:
+        return bool(row[0])
+
+    ok = verify_license(license_key, product_permalink) is not None
+    ttl = LICENSE_CACHE_TTL if ok else LICENSE_NEGATIVE_TTL
+    conn.execute(
+        "INSERT OR REPLACE INTO license_cache (key, ok, expires_at) VALUES (?, ?, ?)",
+        (key, int(ok), now + ttl),
+    )
+    return ok
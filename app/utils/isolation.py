@@ -0,0 +1,135 @@
+"""Run stamping work in a child process with a memory ceiling.
+
+Children are forked from a multiprocessing forkserver that has the PDF stack
+preloaded, so starting one costs a fork rather than a fresh interpreter, and a
+runaway job can only exhaust its own address space. Each child reports its
+peak RSS so per-job memory use is observable. With a timeout the child stops
+cooperatively at its deadline and is killed if it is still running shortly
+after.
+"""
+import multiprocessing as mp
+import resource
+from typing import Any, Callable, Optional, Tuple
+
+from .deadline import StampTimeout, stamp_deadline
+
+# Seconds past the deadline before a child that has not stopped is killed
+KILL_GRACE_SECONDS = 5.0
+
+
+class MemoryLimitExceeded(RuntimeError):
+    """The job needed more memory than its configured ceiling."""
+
+
+class IsolatedJobFailed(RuntimeError):
+    """The job raised an error or its process died unexpectedly."""
+
+
+_ctx = None
+
+
+def _context():
+    global _ctx
+    if _ctx is None:
+        _ctx = mp.get_context("forkserver")
+        _ctx.set_forkserver_preload(["app.utils.pdf"])
+    return _ctx
+
+
+def _status_bytes(field: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss() -> int:
+    peak = _status_bytes("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+
+def _child(
+    conn, fn: Callable[..., Any], args: tuple, kwargs: dict, memory_limit: Optional[int], timeout: Optional[float]
+) -> None:
+    ceiling = None
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if memory_limit:
+        # The ceiling applies to what the job allocates on top of the
+        # interpreter and preloaded modules inherited from the forkserver.
+        ceiling = (_status_bytes("VmSize") or 0) + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (ceiling, hard))
+    try:
+        # Reset VmHWM so the reported peak belongs to this job (Linux >= 4.0)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+    try:
+        with stamp_deadline(timeout):
+            value = fn(*args, **kwargs)
+        report = ("ok", value)
+    except StampTimeout:
+        report = ("timeout", None)
+    except MemoryError:
+        report = ("memory", None)
+    except Exception as e:
+        report = ("error", f"{type(e).__name__}: {e}")
+        # Parsers sometimes wrap allocation failures in their own errors
+        if ceiling and (_status_bytes("VmPeak") or 0) >= ceiling - (1 << 20):
+            report = ("memory", None)
+    # Lift the ceiling so the report itself can always be sent
+    resource.setrlimit(resource.RLIMIT_AS, (hard, hard))
+    try:
+        conn.send((*report, _peak_rss()))
+    finally:
+        conn.close()
+
+
+def run_isolated(
+    fn: Callable[..., Any],
+    *args: Any,
+    memory_limit: Optional[int] = None,
+    timeout: Optional[float] = None,
+    **kwargs: Any,
+) -> Tuple[Any, int]:
+    """Call ``fn(*args, **kwargs)`` in a child process.
+
+    ``fn`` and its arguments must be picklable. ``memory_limit`` is in bytes.
+    Returns ``(value, peak_rss_bytes)``; raises MemoryLimitExceeded when the
+    ceiling was hit, StampTimeout when ``timeout`` seconds passed (``killed``
+    if the child had to be killed) and IsolatedJobFailed for any other
+    failure.
+    """
+    ctx = _context()
+    receiver, sender = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(sender, fn, args, kwargs, memory_limit, timeout), daemon=True)
+    proc.start()
+    sender.close()
+    try:
+        if timeout is not None and not receiver.poll(timeout + KILL_GRACE_SECONDS):
+            # Hung outside the page loop (e.g. parsing): take the core back
+            proc.kill()
+            proc.join()
+            raise StampTimeout(f"Stamping process killed after {timeout:.0f}s", killed=True)
+        status, value, peak = receiver.recv()
+    except EOFError:
+        proc.join()
+        raise IsolatedJobFailed(f"Stamping process exited with code {proc.exitcode}")
+    finally:
+        receiver.close()
+    proc.join()
+
+    if status == "timeout":
+        raise StampTimeout(f"Stamping deadline of {timeout:.0f}s exceeded")
+    if status == "memory":
+        raise MemoryLimitExceeded(f"Job exceeded memory limit of {memory_limit} bytes (peak {peak})")
+    if status == "error":
+        raise IsolatedJobFailed(value)
+    return value, peak
@@ -0,0 +1,390 @@
+"""Stamping job queue shared by the web tier and ``app.worker``.
+
+Two backends implement the same small interface:
+
+- ``SqliteJobQueue``: a table in the SQLite state database. Suitable when
+  workers share the storage volume with the web tier (same host or a network
+  filesystem with working locks).
+- ``RespJobQueue``: any server speaking the Redis protocol (Redis, Valkey,
+  KeyDB, or a local stand-in). Talks RESP directly over a socket, so no client
+  library is required.
+
+Job ids are chosen by the caller and enqueueing is idempotent: a job that is
+already queued or running is not queued again, though re-enqueueing at a
+higher priority promotes it. Jobs are claimed by the same aged priority order
+as the in-process scheduler (see ``app.utils.scheduler``). Claimed jobs are
+leased; if a worker dies mid-job the job becomes claimable again once the
+lease expires.
+"""
+import abc
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..settings import settings
+from .db import connect, register_schema
+from .scheduler import DEFAULT_PRIORITY, PRIORITY_CLASSES
+
+# How long a claimed job may run before another worker may take it over
+JOB_LEASE_SECONDS = 300
+# How long finished results are kept for waiters to pick up
+RESULT_TTL_SECONDS = 3600
+# Result polling starts at POLL_INTERVAL and backs off to POLL_MAX_INTERVAL:
+# quick jobs are picked up promptly, long waits cost few lookups
+POLL_INTERVAL = 0.05
+POLL_MAX_INTERVAL = 1.0
+POLL_BACKOFF = 1.5
+
+
+class QueueError(RuntimeError):
+    pass
+
+
+class JobQueue(abc.ABC):
+    """Interface implemented by the queue backends."""
+
+    @abc.abstractmethod
+    def enqueue(self, job_id: str, payload: Dict[str, Any], priority: str = DEFAULT_PRIORITY) -> None:
+        ...
+
+    @abc.abstractmethod
+    def claim(self, timeout: float) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Take the next job by aged priority, waiting up to ``timeout`` seconds."""
+
+    @abc.abstractmethod
+    def finish(self, job_id: str, result: Dict[str, Any]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Block until the job has a result or ``timeout`` elapses."""
+        deadline = time.monotonic() + timeout
+        interval = POLL_INTERVAL
+        while True:
+            result = self.result(job_id)
+            now = time.monotonic()
+            if result is not None or now >= deadline:
+                return result
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+    async def wait_async(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """wait() for the event loop: polls without holding a thread while idle."""
+        deadline = time.monotonic() + timeout
+        interval = POLL_INTERVAL
+        while True:
+            result = await asyncio.to_thread(self.result, job_id)
+            now = time.monotonic()
+            if result is not None or now >= deadline:
+                return result
+            await asyncio.sleep(min(interval, deadline - now))
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    enqueued_at REAL NOT NULL,
+    claimed_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, enqueued_at);
+""")
+
+
+def _rank(priority: str) -> int:
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority class: {priority!r}")
+    return PRIORITY_CLASSES.index(priority)
+
+
+class SqliteJobQueue(JobQueue):
+    def enqueue(self, job_id: str, payload: Dict[str, Any], priority: str = DEFAULT_PRIORITY) -> None:
+        rank = _rank(priority)
+        conn = connect()
+        conn.execute(
+            """
+            INSERT INTO jobs (id, payload, status, priority, enqueued_at) VALUES (?, ?, 'queued', ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                payload = excluded.payload, status = 'queued', priority = excluded.priority,
+                result = NULL, enqueued_at = excluded.enqueued_at, claimed_at = NULL, finished_at = NULL
+            WHERE jobs.status = 'done'
+            """,
+            (job_id, json.dumps(payload), rank, time.time()),
+        )
+        # A buyer waiting on a copy queued by a backfill promotes it
+        conn.execute(
+            "UPDATE jobs SET priority = ? WHERE id = ? AND status = 'queued' AND priority > ?",
+            (rank, job_id, rank),
+        )
+
+    def _claim_one(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        conn = connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT id, payload FROM jobs
+                WHERE status = 'queued' OR (status = 'running' AND claimed_at < ?)
+                ORDER BY enqueued_at + priority * ? LIMIT 1
+                """,
+                (now - JOB_LEASE_SECONDS, settings.stamp_aging_seconds),
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', claimed_at = ? WHERE id = ?", (now, row[0]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return (row[0], json.loads(row[1])) if row else None
+
+    def claim(self, timeout: float) -> Optional[Tuple[str, Dict[str, Any]]]:
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim_one()
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(0.25, max(0.0, deadline - time.monotonic())))
+
+    def finish(self, job_id: str, result: Dict[str, Any]) -> None:
+        now = time.time()
+        conn = connect()
+        conn.execute(
+            "UPDATE jobs SET status = 'done', result = ?, finished_at = ? WHERE id = ?",
+            (json.dumps(result), now, job_id),
+        )
+        conn.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?", (now - RESULT_TTL_SECONDS,))
+
+    def result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = connect().execute("SELECT result FROM jobs WHERE id = ? AND status = 'done'", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class _RespConnection:
+    """Minimal RESP2 client: enough commands for the queue, nothing more."""
+
+    def __init__(self, host: str, port: int, db: int, password: Optional[str], timeout: float = 10.0):
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+        if password:
+            self.command("AUTH", password)
+        if db:
+            self.command("SELECT", db)
+
+    def command(self, *args: Any, blocking: Optional[float] = None) -> Any:
+        """Send one command; ``blocking`` is the server-side wait of a blocking
+        command, which the socket timeout is extended by."""
+        parts: List[bytes] = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self.sock.sendall(b"".join(parts))
+        if blocking is None:
+            return self._read()
+        self.sock.settimeout(blocking + self.timeout)
+        try:
+            return self._read()
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def _read(self) -> Any:
+        line = self.file.readline()
+        if not line:
+            raise QueueError("Connection closed by queue server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise QueueError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self.file.read(size + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(rest)
+            return None if count < 0 else [self._read() for _ in range(count)]
+        raise QueueError(f"Unexpected reply from queue server: {line!r}")
+
+    def close(self) -> None:
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RespJobQueue(JobQueue):
+    """Queue on a Redis-protocol server, e.g. ``redis://localhost:6379/0``.
+
+    Keys (all under ``prefix``): ``queue:{priority}`` holds the jobs of each
+    class, ``job:{id}`` records the class a job is queued at or ``running``
+    (expires with the lease) and ``result:{id}`` holds the result for RESULT_TTL_SECONDS.
+
+    Claims move a job atomically (RPOPLPUSH) into the claiming thread's
+    ``processing:{worker}`` list, and ``leases`` scores each worker by when its
+    lease expires. Any claimer requeues the jobs of expired workers, so a job
+    whose worker died runs again after JOB_LEASE_SECONDS, as with the SQLite
+    backend. Idle claimers block on ``wakeup``, which enqueue pushes to.
+    """
+
+    # Pending wakeups kept while no worker is waiting
+    MAX_WAKEUPS = 100
+
+    def __init__(self, url: str, prefix: str = "gumstamp:"):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def _conn(self) -> _RespConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = _RespConnection(self.host, self.port, self.db, self.password)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            # One processing list per worker thread
+            self._local.worker = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+            self._local.claimed = {}
+        return conn
+
+    def _command(self, *args: Any, blocking: Optional[float] = None) -> Any:
+        try:
+            return self._conn().command(*args, blocking=blocking)
+        except (OSError, QueueError) as e:
+            # Drop the connection so the next call reconnects
+            conn = getattr(self._local, "conn", None)
+            if conn is not None:
+                conn.close()
+                self._local.conn = None
+            if isinstance(e, QueueError):
+                raise
+            raise QueueError(f"Queue server unavailable: {e}") from e
+
+    def _processing(self, worker: str) -> str:
+        return f"{self.prefix}processing:{worker}"
+
+    def enqueue(self, job_id: str, payload: Dict[str, Any], priority: str = DEFAULT_PRIORITY) -> None:
+        rank = _rank(priority)
+        marker = f"{self.prefix}job:{job_id}"
+        if self._command("SET", marker, priority, "NX", "EX", JOB_LEASE_SECONDS) is None:
+            current = self._command("GET", marker)
+            current = current.decode("utf-8") if current else "running"
+            if current not in PRIORITY_CLASSES or _rank(current) <= rank:
+                return
+            # Promote by queueing again at the higher class; whichever copy of
+            # the job runs second finds the output already rendered
+            self._command("SET", marker, priority, "EX", JOB_LEASE_SECONDS)
+        else:
+            self._command("DEL", f"{self.prefix}result:{job_id}")
+        job = {"id": job_id, "payload": payload, "priority": priority, "enqueued_at": time.time()}
+        self._command("LPUSH", f"{self.prefix}queue:{priority}", json.dumps(job))
+        self._command("LPUSH", f"{self.prefix}wakeup", 1)
+        self._command("LTRIM", f"{self.prefix}wakeup", 0, self.MAX_WAKEUPS - 1)
+
+    def _requeue_expired(self) -> None:
+        """Put the jobs of workers whose lease expired back at the head of their class."""
+        expired = self._command("ZRANGEBYSCORE", f"{self.prefix}leases", "-inf", time.time())
+        for worker in expired or []:
+            # Only the claimer that removes the lease requeues its jobs
+            if not self._command("ZREM", f"{self.prefix}leases", worker):
+                continue
+            worker = worker.decode("utf-8")
+            while (data := self._command("RPOP", self._processing(worker))) is not None:
+                job = json.loads(data)
+                priority = job.get("priority", DEFAULT_PRIORITY)
+                self._command("SET", f"{self.prefix}job:{job['id']}", priority, "EX", JOB_LEASE_SECONDS)
+                self._command("RPUSH", f"{self.prefix}queue:{priority}", data)
+
+    def _move_aged(self) -> Optional[bytes]:
+        """Move the head with the earliest aged deadline across classes into
+        this worker's processing list."""
+        best: Optional[Tuple[float, str]] = None
+        for rank, name in enumerate(PRIORITY_CLASSES):
+            head = self._command("LINDEX", f"{self.prefix}queue:{name}", -1)
+            if head is None:
+                continue
+            deadline = json.loads(head)["enqueued_at"] + rank * settings.stamp_aging_seconds
+            if best is None or deadline < best[0]:
+                best = (deadline, name)
+        if best is None:
+            return None
+        return self._command("RPOPLPUSH", f"{self.prefix}queue:{best[1]}", self._processing(self._local.worker))
+
+    def claim(self, timeout: float) -> Optional[Tuple[str, Dict[str, Any]]]:
+        self._conn()
+        deadline = time.monotonic() + timeout
+        while True:
+            self._requeue_expired()
+            data = self._move_aged()
+            if data is not None:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # Nothing queued: wait for an enqueue. BRPOP takes whole seconds
+            # on older servers; 0 would block forever
+            wait = max(1, int(remaining))
+            if self._command("BRPOP", f"{self.prefix}wakeup", wait, blocking=wait) is None:
+                return None
+        job = json.loads(data)
+        self._command("ZADD", f"{self.prefix}leases", time.time() + JOB_LEASE_SECONDS, self._local.worker)
+        self._command("SET", f"{self.prefix}job:{job['id']}", "running", "EX", JOB_LEASE_SECONDS)
+        self._local.claimed[job["id"]] = data
+        return job["id"], job["payload"]
+
+    def finish(self, job_id: str, result: Dict[str, Any]) -> None:
+        self._conn()
+        self._command("SET", f"{self.prefix}result:{job_id}", json.dumps(result), "EX", RESULT_TTL_SECONDS)
+        self._command("DEL", f"{self.prefix}job:{job_id}")
+        data = self._local.claimed.pop(job_id, None)
+        if data is not None:
+            self._command("LREM", self._processing(self._local.worker), 0, data)
+        if not self._local.claimed:
+            self._command("ZREM", f"{self.prefix}leases", self._local.worker)
+
+    def result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        data = self._command("GET", f"{self.prefix}result:{job_id}")
+        return json.loads(data) if data is not None else None
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> Optional[JobQueue]:
+    """The configured stamping queue, or None when stamping runs inline."""
+    global _queue
+    backend = settings.stamp_queue
+    if not backend:
+        return None
+    with _queue_lock:
+        if _queue is None:
+            if backend == "sqlite":
+                _queue = SqliteJobQueue()
+            elif backend.startswith("redis://"):
+                _queue = RespJobQueue(backend)
+            else:
+                raise QueueError(f"Unknown STAMP_QUEUE backend: {backend!r}")
+        return _queue
@@ -0,0 +1,69 @@
+"""Cross-process locks for stamping.
+
+Locks are ``flock`` locks on a fixed set of striped lock files, so they work
+between threads, between the preforked workers of ``app.serve`` and between
+separate containers sharing a volume, without creating one file per key.
+"""
+import fcntl
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from ..settings import settings
+
+LOCK_STRIPES = 1024
+
+
+class LockTimeout(TimeoutError):
+    pass
+
+
+def _lock_file(key: str) -> str:
+    stripe = int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) % LOCK_STRIPES
+    lock_dir = settings.storage_dir / "locks"
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    return str(lock_dir / f"{stripe:04d}.lock")
+
+
+@contextmanager
+def file_lock(key: str, timeout: Optional[float] = None) -> Iterator[None]:
+    """Hold an exclusive lock for ``key``; waits forever unless ``timeout`` is set."""
+    fd = os.open(_lock_file(key), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise LockTimeout(f"Timed out waiting for lock {key!r}")
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def try_named_lock(name: str) -> Optional[int]:
+    """Take a dedicated (not striped) lock without waiting.
+
+    Used to elect one process for singleton background work. Returns the file
+    descriptor holding the lock, which is released by closing it or when the
+    process exits, or None when another process holds it.
+    """
+    lock_dir = settings.storage_dir / "locks"
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    fd = os.open(str(lock_dir / f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
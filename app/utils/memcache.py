@@ -0,0 +1,125 @@
+"""In-process memory tier in front of the stamped-copy cache on disk.
+
+Repeat downloads of small popular copies are answered from memory: no
+``stat``, no disk read, no thread hop. Entries are keyed by the copy's path
+and hold the body with the response headers it was first served with.
+
+The tier is bounded by a total byte budget (least recently used copies are
+evicted) and only takes copies up to ``max_item_bytes``. Each worker process
+has its own tier. Entries are dropped after ``ttl`` seconds so a copy that was
+re-stamped or collected on disk is picked up again; this worker also drops
+them right away when storage GC removes the copy or the product is uploaded
+again.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from ..settings import settings
+
+
+class CachedCopy(NamedTuple):
+    body: bytes
+    headers: List[Tuple[bytes, bytes]]
+    stored_at: float
+
+
+class MemoryCache:
+    def __init__(self, max_bytes: int, max_item_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, CachedCopy]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.max_item_bytes > 0
+
+    def accepts(self, size: int) -> bool:
+        return self.enabled and size <= min(self.max_item_bytes, self.max_bytes)
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+    def get(self, path: Path) -> Optional[CachedCopy]:
+        if not self.enabled:
+            return None
+        key = str(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.stored_at > self.ttl:
+                self._drop(key)
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry
+
+    def put(self, path: Path, body: bytes, headers: List[Tuple[bytes, bytes]]) -> None:
+        if not self.accepts(len(body)):
+            return
+        key = str(path)
+        with self._lock:
+            self._drop(key)
+            while self._entries and self._bytes + len(body) > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+                self._stats["evictions"] += 1
+            self._entries[key] = CachedCopy(body, headers, time.monotonic())
+            self._bytes += len(body)
+
+    def discard(self, path: Path) -> None:
+        with self._lock:
+            self._drop(str(path))
+
+    def discard_product(self, product_id: str) -> None:
+        """Drop every copy of a product, e.g. after its source was replaced."""
+        prefix = str(settings.storage_dir / "stamped" / product_id) + os.sep
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._drop(key)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats: Dict[str, object] = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else None
+        stats["max_bytes"] = self.max_bytes
+        stats["max_item_bytes"] = self.max_item_bytes
+        return stats
+
+
+_cache: Optional[MemoryCache] = None
+_cache_pid: Optional[int] = None
+_cache_lock = threading.Lock()
+
+
+def get_memory_cache() -> MemoryCache:
+    """The process-wide memory tier (recreated after a fork)."""
+    global _cache, _cache_pid
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            # A proxy sending files with sendfile(2) already serves from the
+            # page cache, and never hands the body to this process
+            max_bytes = 0 if settings.sendfile_header else settings.memory_cache_max_bytes
+            _cache = MemoryCache(max_bytes, settings.memory_cache_max_item_bytes, settings.memory_cache_ttl_seconds)
+            _cache_pid = os.getpid()
+        return _cache
+
+
+def current_memory_cache() -> Optional[MemoryCache]:
+    """This process's memory tier if one was created."""
+    return _cache if _cache_pid == os.getpid() else None
@@ -1,62 +1,968 @@
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from pydantic import BaseModel
+import pypdf
 from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (
+    ArrayObject,
+    ByteStringObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    EncodedStreamObject,
+    FloatObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    TextStringObject,
+)
 from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import Color
+from .deadline import check_deadline
+from .watermarks import DEFAULT_OUTPUT_PROFILE, OUTPUT_PROFILES, DiagonalStyle, FooterStyle, LogoSpec, PatternSpec
+from xml.sax.saxutils import escape
 import io
+import math
+import re
+import hashlib
+import secrets
+import shutil
+import threading
+import time
 
 
-def _footer_overlay(page_width: float, page_height: float, text: str) -> bytes:
+DEFAULT_FONT = "Helvetica"
+
+# Document Info key and catalog marker used for buyer fingerprints
+FINGERPRINT_KEY = "/GumstampFingerprint"
+MARKER_KEY = "/GumstampMarker"
+XMP_NS = "https://gumstamp.com/ns/1.0/"
+
+
+class StampResult(BaseModel):
+    """Size and timing of one stamping job."""
+
+    mode: str
+    profile: Optional[str] = None
+    pages: Optional[int] = None
+    input_bytes: int
+    output_bytes: int
+    seconds: float
+    peak_rss_bytes: Optional[int] = None
+
+# Font file path -> reportlab font name. Font files are stored under their
+# content hash (see storage.font_path) so a path never changes meaning.
+_registered_fonts: Dict[str, str] = {}
+_font_lock = threading.Lock()
+
+
+def register_font(path: Path) -> str:
+    """Register a TTF/OTF font with reportlab once per process.
+
+    reportlab parses the font file here; later canvases only subset the glyphs
+    they actually draw, so each stamped copy embeds just the characters of its
+    stamp text. Raises ValueError for fonts reportlab cannot embed (e.g. OTF
+    with CFF outlines).
+    """
+    key = str(path)
+    name = _registered_fonts.get(key)
+    if name:
+        return name
+    with _font_lock:
+        name = _registered_fonts.get(key)
+        if name:
+            return name
+        name = f"GSFont-{path.stem}"
+        try:
+            pdfmetrics.registerFont(TTFont(name, key))
+        except Exception as e:
+            raise ValueError(f"Unsupported font: {e}") from e
+        _registered_fonts[key] = name
+        return name
+
+
+def _draw_footer(
+    can: canvas.Canvas, page_width: float, page_height: float, text: str, font: str, style: FooterStyle
+) -> None:
+    can.saveState()
+    can.setFont(font, style.font_size)
+    can.setFillColor(Color(0, 0, 0, alpha=style.opacity))
+    vertical, horizontal = style.position.split("-")
+    y = style.margin if vertical == "bottom" else page_height - style.margin - style.font_size
+    if horizontal == "left":
+        can.drawString(style.margin, y, text)
+    elif horizontal == "center":
+        can.drawCentredString(page_width / 2, y, text)
+    else:
+        can.drawRightString(page_width - style.margin, y, text)
+    can.restoreState()
+
+
+def _draw_diagonal(
+    can: canvas.Canvas, page_width: float, page_height: float, text: str, font: str, style: DiagonalStyle
+) -> None:
+    can.saveState()
+    can.setFont(font, style.font_size)
+    can.setFillColor(Color(0.2, 0.2, 0.2, alpha=style.opacity))
+    can.translate(page_width / 2, page_height / 2)
+    can.rotate(style.angle)
+    can.drawCentredString(0, 0, text)
+    can.restoreState()
+
+
+def _page_overlay(
+    page_width: float,
+    page_height: float,
+    footer_text: Optional[str],
+    diagonal_text: Optional[str],
+    font: str = DEFAULT_FONT,
+    footer_style: Optional[FooterStyle] = None,
+    diagonal_style: Optional[DiagonalStyle] = None,
+) -> bytes:
+    """Footer and diagonal text drawn on one canvas, so a custom font is
+    subset and embedded once for both."""
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=(page_width, page_height))
-    can.setFont("Helvetica", 9)
-    can.setFillColor(Color(0, 0, 0, alpha=0.8))
-    margin = 24
-    can.drawRightString(page_width - margin, margin, text)
+    if footer_text:
+        _draw_footer(can, page_width, page_height, footer_text, font, footer_style or FooterStyle())
+    if diagonal_text:
+        _draw_diagonal(can, page_width, page_height, diagonal_text, font, diagonal_style or DiagonalStyle())
     can.save()
     packet.seek(0)
     return packet.read()
 
 
-def _diagonal_overlay(page_width: float, page_height: float, text: str) -> bytes:
+# Larger logos are downscaled once at upload; watermarks never need more
+LOGO_MAX_PIXELS = 1024
+
+
+def build_logo_asset(image: bytes, dest: Path) -> Tuple[int, int]:
+    """Decode a PNG/JPEG logo once and store it as a one-page PDF.
+
+    The page holds a single compressed Image XObject (JPEG data is passed
+    through unchanged unless it has to be downscaled). Stamping later copies
+    the encoded stream as-is, so the image is never decoded per buyer.
+    Raises ValueError for unsupported or corrupt images.
+    """
+    from PIL import Image
+
+    try:
+        img = Image.open(io.BytesIO(image))
+        img.load()
+    except Exception as e:
+        raise ValueError(f"Unreadable image: {e}") from e
+    if img.format not in ("PNG", "JPEG"):
+        raise ValueError("Logo must be PNG or JPEG")
+
+    source = ImageReader(io.BytesIO(image))
+    if max(img.size) > LOGO_MAX_PIXELS:
+        img.thumbnail((LOGO_MAX_PIXELS, LOGO_MAX_PIXELS))
+        source = ImageReader(img)
+    width, height = img.size
+
     packet = io.BytesIO()
-    can = canvas.Canvas(packet, pagesize=(page_width, page_height))
-    can.setFont("Helvetica", 36)
-    can.setFillColor(Color(0.2, 0.2, 0.2, alpha=0.15))
-    can.saveState()
-    can.translate(page_width / 2, page_height / 2)
-    can.rotate(45)
-    can.drawCentredString(0, 0, text)
-    can.restoreState()
+    can = canvas.Canvas(packet, pagesize=(width, height), pageCompression=1)
+    can.drawImage(source, 0, 0, width, height, mask="auto")
+    can.save()
+    tmp = dest.with_suffix(".tmp")
+    tmp.write_bytes(packet.getvalue())
+    tmp.replace(dest)
+    return width, height
+
+
+# pypdf release whose PdfWriter internals the helpers below were checked
+# against. PdfWriter has no public API to add a bare object or to rewrite and
+# merge its objects in this release, so all private access goes through
+# _add_object and _writer_objects; an upgrade fails loudly there (and in
+# tests/test_pdf.py) instead of writing a corrupt file.
+PYPDF_INTERNALS_VERSION = "4.3"
+
+
+def _check_pypdf_internals(writer: PdfWriter) -> None:
+    version = ".".join(pypdf.__version__.split(".")[:2])
+    if version != PYPDF_INTERNALS_VERSION or not isinstance(getattr(writer, "_objects", None), list):
+        raise RuntimeError(
+            f"pypdf {pypdf.__version__} is not supported by app.utils.pdf "
+            f"(checked against {PYPDF_INTERNALS_VERSION}); review _writer_objects and _add_object"
+        )
+
+
+def _add_object(writer: PdfWriter, obj) -> IndirectObject:
+    """Add ``obj`` to the writer as a new indirect object."""
+    _check_pypdf_internals(writer)
+    return writer._add_object(obj)
+
+
+def _writer_objects(writer: PdfWriter) -> list:
+    """The writer's object table: index ``i`` holds object number ``i + 1``.
+
+    Callers may replace entries in place; the list itself must not be resized.
+    """
+    _check_pypdf_internals(writer)
+    return writer._objects
+
+
+def _form_xobject(writer: PdfWriter, asset: Union[Path, BinaryIO]) -> Tuple[IndirectObject, float, float]:
+    """Wrap the first page of a prepared asset PDF as a Form XObject."""
+    page = PdfReader(asset).pages[0]
+    width, height = float(page.mediabox.width), float(page.mediabox.height)
+    form = DecodedStreamObject()
+    form.set_data(page.get_contents().get_data())
+    form.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): ArrayObject([FloatObject(0), FloatObject(0), FloatObject(width), FloatObject(height)]),
+        NameObject("/Resources"): page["/Resources"].get_object().clone(writer),
+    })
+    return _add_object(writer, form.flate_encode()), width, height
+
+
+def _logo_origin(spec: LogoSpec, box: Tuple[float, float, float, float], w: float, h: float) -> Tuple[float, float]:
+    left, bottom, page_w, page_h = box
+    if spec.position == "center":
+        return left + (page_w - w) / 2, bottom + (page_h - h) / 2
+    vertical, horizontal = spec.position.split("-")
+    x = left + spec.margin if horizontal == "left" else left + page_w - spec.margin - w
+    y = bottom + spec.margin if vertical == "bottom" else bottom + page_h - spec.margin - h
+    return x, y
+
+
+def _pattern_cell(spec: PatternSpec, font: str = DEFAULT_FONT) -> Tuple[bytes, float, float]:
+    """Render one tile of the repeated pattern; returns (pdf, width, height)."""
+    width = stringWidth(spec.text, font, spec.font_size) + spec.spacing
+    height = spec.font_size + spec.spacing
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=(width, height))
+    can.setFont(font, spec.font_size)
+    can.setFillColor(Color(0.2, 0.2, 0.2, alpha=spec.opacity))
+    can.drawString(spec.spacing / 2, spec.spacing / 2, spec.text)
     can.save()
     packet.seek(0)
-    return packet.read()
+    return packet.read(), width, height
+
+
+def _tiling_pattern(writer: PdfWriter, spec: PatternSpec, font: str = DEFAULT_FONT) -> IndirectObject:
+    """Build a PDF tiling pattern whose cell holds a single copy of the text.
+
+    The viewer does the repetition, so the cost is one small object per
+    document no matter how dense the pattern is.
+    """
+    cell, width, height = _pattern_cell(spec, font)
+    cell_page = PdfReader(io.BytesIO(cell)).pages[0]
+    theta = math.radians(spec.angle)
+    cos_t, sin_t = math.cos(theta), math.sin(theta)
+
+    pattern = DecodedStreamObject()
+    pattern.set_data(cell_page.get_contents().get_data())
+    pattern.update({
+        NameObject("/Type"): NameObject("/Pattern"),
+        NameObject("/PatternType"): NumberObject(1),
+        NameObject("/PaintType"): NumberObject(1),
+        NameObject("/TilingType"): NumberObject(1),
+        NameObject("/BBox"): ArrayObject([FloatObject(0), FloatObject(0), FloatObject(width), FloatObject(height)]),
+        NameObject("/XStep"): FloatObject(width),
+        NameObject("/YStep"): FloatObject(height),
+        NameObject("/Matrix"): ArrayObject(
+            [FloatObject(v) for v in (cos_t, sin_t, -sin_t, cos_t, 0, 0)]
+        ),
+        NameObject("/Resources"): cell_page["/Resources"].get_object().clone(writer),
+    })
+    return _add_object(writer, pattern.flate_encode())
+
+
+def _box_key(page) -> Tuple[float, float, float, float]:
+    box = page.mediabox
+    return (float(box.left), float(box.bottom), float(box.width), float(box.height))
+
+
+class _DocumentLayers:
+    """Layers drawn on top of every page of one output document.
+
+    Heavy objects (the tiling pattern, the logo image, the rendered footer)
+    are written once per document, or once per page size for the footer. Each
+    page only gains resource entries and references to two small content
+    streams that are shared between all pages with the same media box; the
+    page's own content streams are never decoded or re-encoded.
+    """
+
+    def __init__(self, writer: PdfWriter):
+        self._writer = writer
+        # Resource names are unique per document so layering onto an already
+        # stamped file (such as a product's base PDF) never shadows its layers
+        self._tag = secrets.token_hex(4)
+        self._resources: List[Tuple[str, str, IndirectObject]] = []
+        self._box_resources: List[Callable[[Tuple[float, float, float, float]], Tuple[str, str, IndirectObject]]] = []
+        self._ops: List[Callable[[Tuple[float, float, float, float]], str]] = []
+        self._head: Optional[IndirectObject] = None
+        self._tails: Dict[Tuple[float, float, float, float], IndirectObject] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._ops)
+
+    def add_pattern(self, spec: PatternSpec, font: str = DEFAULT_FONT) -> None:
+        name = f"/GSPattern{self._tag}"
+        self._resources.append(("/Pattern", name, _tiling_pattern(self._writer, spec, font)))
+        self._ops.append(
+            lambda box: f"q /Pattern cs {name} scn {box[0]:.2f} {box[1]:.2f} {box[2]:.2f} {box[3]:.2f} re f Q"
+        )
+
+    def add_logo(self, asset: Path, spec: LogoSpec) -> None:
+        name, gs_name = f"/GSLogo{self._tag}", f"/GSLogoAlpha{self._tag}"
+        form, asset_w, asset_h = _form_xobject(self._writer, asset)
+        alpha = DictionaryObject({
+            NameObject("/Type"): NameObject("/ExtGState"),
+            NameObject("/ca"): FloatObject(spec.opacity),
+            NameObject("/CA"): FloatObject(spec.opacity),
+        })
+        self._resources.append(("/XObject", name, form))
+        self._resources.append(("/ExtGState", gs_name, _add_object(self._writer, alpha)))
+
+        def op(box: Tuple[float, float, float, float]) -> str:
+            width = min(spec.width, max(box[2] - 2 * spec.margin, 1.0))
+            scale = width / asset_w
+            x, y = _logo_origin(spec, box, width, asset_h * scale)
+            return f"q {gs_name} gs {scale:.4f} 0 0 {scale:.4f} {x:.2f} {y:.2f} cm {name} Do Q"
+
+        self._ops.append(op)
+
+    def add_overlay(
+        self,
+        footer_text: Optional[str],
+        diagonal_text: Optional[str],
+        font_name: str,
+        footer_style: Optional[FooterStyle] = None,
+        diagonal_style: Optional[DiagonalStyle] = None,
+    ) -> None:
+        if not (footer_text or diagonal_text):
+            return
+        # The overlay depends only on the page size, so it is rendered once per
+        # size; that also keeps a single embedded font subset per size.
+        forms: Dict[Tuple[float, float], Tuple[str, IndirectObject]] = {}
+
+        def form(box: Tuple[float, float, float, float]) -> Tuple[str, IndirectObject]:
+            size = (box[2], box[3])
+            if size not in forms:
+                overlay = _page_overlay(
+                    size[0], size[1], footer_text, diagonal_text, font_name, footer_style, diagonal_style
+                )
+                ref, _, _ = _form_xobject(self._writer, io.BytesIO(overlay))
+                forms[size] = (f"/GSOverlay{self._tag}_{len(forms)}", ref)
+            return forms[size]
+
+        self._box_resources.append(lambda box: ("/XObject", *form(box)))
+        self._ops.append(lambda box: f"q {form(box)[0]} Do Q")
+
+    def _stream(self, data: str) -> IndirectObject:
+        stream = DecodedStreamObject()
+        stream.set_data(data.encode("latin-1"))
+        return _add_object(self._writer, stream)
+
+    def apply(self, page) -> None:
+        """Draw the layers on top of an already added writer page."""
+        key = _box_key(page)
+        # Resource dictionaries are often shared between pages (and may have
+        # been written out already when streaming), so the page gets its own
+        # shallow copies rather than mutating them in place.
+        existing = page.get("/Resources")
+        resources = DictionaryObject(existing.get_object()) if existing is not None else DictionaryObject()
+        for category, name, ref in [*self._resources, *(fn(key) for fn in self._box_resources)]:
+            entries = resources.get(category)
+            entries = DictionaryObject(entries.get_object()) if entries is not None else DictionaryObject()
+            entries[NameObject(name)] = ref
+            resources[NameObject(category)] = entries
+        page[NameObject("/Resources")] = resources
+
+        if key not in self._tails:
+            self._tails[key] = self._stream("\nQ\n" + "\n".join(op(key) for op in self._ops) + "\n")
+        if self._head is None:
+            self._head = self._stream("q\n")
 
+        contents = page.get("/Contents")
+        existing = []
+        if contents is not None:
+            obj = contents.get_object()
+            existing = list(obj) if isinstance(obj, ArrayObject) else [contents]
+        page[NameObject("/Contents")] = ArrayObject([self._head, *existing, self._tails[key]])
 
-def stamp_pdf(input_path: Path, output_path: Path, footer_text: Optional[str], diagonal_text: Optional[str]) -> None:
+
+# Only resources that are safe to share between pages are merged
+_DEDUPE_TYPES = {"/Font", "/FontDescriptor", "/ExtGState", "/Encoding", "/XObject", "/Pattern"}
+
+
+def _compress_streams(writer: PdfWriter, level: int) -> None:
+    """Flate-encode every stream that has no filter yet (XMP is left readable)."""
+    objects = _writer_objects(writer)
+    for i, obj in enumerate(objects):
+        if i % 256 == 0:
+            check_deadline()
+        if (
+            isinstance(obj, StreamObject)
+            and "/Filter" not in obj
+            and obj.get("/Type") != "/Metadata"
+        ):
+            encoded = obj.flate_encode(level=level)
+            encoded.indirect_reference = IndirectObject(i + 1, 0, writer)
+            objects[i] = encoded
+
+
+def _replace_refs(obj, mapping: Dict[int, int], writer: PdfWriter):
+    if isinstance(obj, IndirectObject):
+        if obj.pdf is writer and obj.idnum in mapping:
+            return IndirectObject(mapping[obj.idnum], 0, writer)
+        return obj
+    if isinstance(obj, DictionaryObject):
+        for key, value in list(obj.items()):
+            obj[key] = _replace_refs(value, mapping, writer)
+    elif isinstance(obj, ArrayObject):
+        for idx, value in enumerate(obj):
+            obj[idx] = _replace_refs(value, mapping, writer)
+    return obj
+
+
+def _dedupe_objects(writer: PdfWriter, passes: int = 2) -> int:
+    """Merge byte-identical streams and shared resource dictionaries.
+
+    pypdf 4.3 has no duplicate-object elimination of its own. Repeated passes
+    let parents become identical once their children have been merged.
+    Returns the number of objects removed.
+    """
+    objects = _writer_objects(writer)
+    removed = 0
+    for _ in range(passes):
+        check_deadline()
+        seen: Dict[bytes, int] = {}
+        mapping: Dict[int, int] = {}
+        for i, obj in enumerate(objects):
+            if isinstance(obj, StreamObject):
+                if obj.get("/Type") == "/Metadata":
+                    continue
+            elif not (isinstance(obj, DictionaryObject) and obj.get("/Type") in _DEDUPE_TYPES):
+                continue
+            buf = io.BytesIO()
+            obj.write_to_stream(buf)
+            digest = hashlib.sha1(buf.getvalue()).digest()
+            if digest in seen:
+                mapping[i + 1] = seen[digest]
+            else:
+                seen[digest] = i + 1
+        if not mapping:
+            break
+        for i, obj in enumerate(objects):
+            if obj is not None and (i + 1) not in mapping:
+                _replace_refs(obj, mapping, writer)
+        for idnum in mapping:
+            objects[idnum - 1] = NullObject()
+        removed += len(mapping)
+    return removed
+
+
+def _apply_profile(writer: PdfWriter, profile: str) -> None:
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile: {profile}")
+    if profile == "balanced":
+        _compress_streams(writer, level=6)
+    elif profile == "small":
+        _compress_streams(writer, level=9)
+        _dedupe_objects(writer)
+
+
+def _document_layers(
+    writer: PdfWriter,
+    pattern: Optional[PatternSpec],
+    logo: Optional[LogoSpec],
+    logo_asset: Optional[Path],
+    font_name: str,
+    footer_text: Optional[str] = None,
+    diagonal_text: Optional[str] = None,
+    footer_style: Optional[FooterStyle] = None,
+    diagonal_style: Optional[DiagonalStyle] = None,
+) -> _DocumentLayers:
+    layers = _DocumentLayers(writer)
+    layers.add_overlay(footer_text, diagonal_text, font_name, footer_style, diagonal_style)
+    if pattern:
+        layers.add_pattern(pattern, font_name)
+    if logo and logo_asset:
+        layers.add_logo(logo_asset, logo)
+    return layers
+
+
+def stamp_pdf(
+    input_path: Path,
+    output_path: Path,
+    footer_text: Optional[str],
+    diagonal_text: Optional[str],
+    pattern: Optional[PatternSpec] = None,
+    logo: Optional[LogoSpec] = None,
+    logo_asset: Optional[Path] = None,
+    font: Optional[Path] = None,
+    fingerprint: Optional[str] = None,
+    profile: str = DEFAULT_OUTPUT_PROFILE,
+    footer_style: Optional[FooterStyle] = None,
+    diagonal_style: Optional[DiagonalStyle] = None,
+) -> StampResult:
+    start = time.perf_counter()
+    font_name = register_font(font) if font else DEFAULT_FONT
     reader = PdfReader(str(input_path))
     writer = PdfWriter()
+    layers = _document_layers(
+        writer, pattern, logo, logo_asset, font_name, footer_text, diagonal_text, footer_style, diagonal_style
+    )
 
     for page in reader.pages:
-        page_width = float(page.mediabox.width)
-        page_height = float(page.mediabox.height)
-
-        overlays = []
-        if footer_text:
-            overlays.append(_footer_overlay(page_width, page_height, footer_text))
-        if diagonal_text:
-            overlays.append(_diagonal_overlay(page_width, page_height, diagonal_text))
-
-        if overlays:
-            # Merge overlay(s) with page one by one
-            base = page
-            for o in overlays:
-                overlay_reader = PdfReader(io.BytesIO(o))
-                base.merge_page(overlay_reader.pages[0])
-            writer.add_page(base)
-        else:
-            writer.add_page(page)
+        # Cooperative cancellation: stop between pages once the job's
+        # deadline has passed
+        check_deadline()
+        out_page = writer.add_page(page)
+        if layers:
+            layers.apply(out_page)
+
+    if fingerprint:
+        writer.add_metadata({FINGERPRINT_KEY: fingerprint})
+    _apply_profile(writer, profile)
+    check_deadline()
 
-    with open(output_path, "wb") as f:
+    # Write beside the destination and swap in, so readers never see a
+    # partially written copy
+    tmp = output_path.with_suffix(output_path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
         writer.write(f)
+    tmp.replace(output_path)
+
+    return StampResult(
+        mode="visible",
+        profile=profile,
+        pages=len(reader.pages),
+        input_bytes=input_path.stat().st_size,
+        output_bytes=output_path.stat().st_size,
+        seconds=time.perf_counter() - start,
+    )
+
+
+class _StreamingPdfWriter:
+    """Minimal PDF serializer that writes objects as soon as they are reachable.
+
+    Unlike PdfWriter it does not keep the document's object graph: every
+    object is written the first time a page references it and only its new
+    object number is remembered. Objects can come from any number of source
+    documents (the input reader and the scratch writer holding shared layers).
+    """
+
+    def __init__(self, fh: BinaryIO, compress_level: Optional[int]):
+        self._fh = fh
+        self._level = compress_level
+        self._offsets: Dict[int, int] = {}
+        self._numbers: Dict[Tuple[int, int, int], int] = {}
+        self._pending: List[Tuple[int, object]] = []
+        self._next = 1
+        fh.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def reserve(self) -> int:
+        num = self._next
+        self._next += 1
+        return num
+
+    def ref(self, num: int) -> IndirectObject:
+        """Reference to an object number of the output document."""
+        return IndirectObject(num, 0, self)
+
+    def alias(self, ref: IndirectObject, num: int) -> None:
+        """Map a source reference to a fixed output number without writing it."""
+        self._numbers[(id(ref.pdf), ref.idnum, ref.generation)] = num
+
+    def _number_for(self, ref: IndirectObject) -> int:
+        key = (id(ref.pdf), ref.idnum, ref.generation)
+        num = self._numbers.get(key)
+        if num is None:
+            num = self._numbers[key] = self.reserve()
+            self._pending.append((num, ref))
+        return num
+
+    def _remap(self, obj):
+        if isinstance(obj, IndirectObject):
+            return obj if obj.pdf is self else self.ref(self._number_for(obj))
+        if isinstance(obj, StreamObject):
+            # Streams must be indirect; pypdf leaves merged page contents direct
+            num = self.reserve()
+            self._pending.append((num, obj))
+            return self.ref(num)
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({k: self._remap(v) for k, v in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._remap(v) for v in obj)
+        return obj
+
+    def _copy_stream(self, obj: StreamObject) -> StreamObject:
+        if isinstance(obj, EncodedStreamObject):
+            copy = EncodedStreamObject()
+            copy._data = obj._data
+        else:
+            copy = DecodedStreamObject()
+            copy.set_data(obj.get_data())
+        for key, value in obj.items():
+            if key != "/Length":
+                copy[NameObject(key)] = self._remap(value)
+        if self._level is not None and "/Filter" not in copy and copy.get("/Type") != "/Metadata":
+            copy = copy.flate_encode(level=self._level)
+        return copy
+
+    def write(self, num: int, obj) -> None:
+        if isinstance(obj, IndirectObject):
+            obj = obj.get_object()
+        if obj is None:
+            obj = NullObject()
+        obj = self._copy_stream(obj) if isinstance(obj, StreamObject) else self._remap(obj)
+        self._offsets[num] = self._fh.tell()
+        self._fh.write(f"{num} 0 obj\n".encode())
+        obj.write_to_stream(self._fh)
+        self._fh.write(b"\nendobj\n")
+
+    def flush(self) -> None:
+        """Write every object referenced so far."""
+        while self._pending:
+            num, obj = self._pending.pop()
+            self.write(num, obj)
+
+    def close(self, root: int, info: int) -> None:
+        self.flush()
+        xref_at = self._fh.tell()
+        size = self._next
+        self._fh.write(f"xref\n0 {size}\n{0:0>10} {65535:0>5} f \n".encode())
+        for num in range(1, size):
+            self._fh.write(f"{self._offsets[num]:0>10} {0:0>5} n \n".encode())
+        self._fh.write(
+            f"trailer\n<< /Size {size} /Root {root} 0 R /Info {info} 0 R >>\n"
+            f"startxref\n{xref_at}\n%%EOF\n".encode()
+        )
+
+
+def _page_tree_nodes(reader: PdfReader) -> Iterator[IndirectObject]:
+    """Indirect references of all intermediate /Pages nodes of a document."""
+    stack = [reader.trailer["/Root"].raw_get("/Pages")]
+    while stack:
+        ref = stack.pop()
+        node = ref.get_object()
+        if not isinstance(ref, IndirectObject) or node.get("/Type") != "/Pages":
+            continue
+        yield ref
+        stack.extend(node.get("/Kids", []))
+
+
+def stamp_pdf_streaming(
+    input_path: Path,
+    output_path: Path,
+    footer_text: Optional[str],
+    diagonal_text: Optional[str],
+    pattern: Optional[PatternSpec] = None,
+    logo: Optional[LogoSpec] = None,
+    logo_asset: Optional[Path] = None,
+    font: Optional[Path] = None,
+    fingerprint: Optional[str] = None,
+    profile: str = DEFAULT_OUTPUT_PROFILE,
+    footer_style: Optional[FooterStyle] = None,
+    diagonal_style: Optional[DiagonalStyle] = None,
+) -> StampResult:
+    """Low-memory variant of stamp_pdf for very large documents.
+
+    Pages are processed one at a time; each page and everything it references
+    is written out immediately and the reader's object cache is dropped, so
+    memory stays bounded by the largest page rather than the whole document.
+    Outlines are dropped as with stamp_pdf. Output profiles map to flate
+    levels only: object deduplication needs the whole graph in memory.
+    """
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile: {profile}")
+    start = time.perf_counter()
+    font_name = register_font(font) if font else DEFAULT_FONT
+    reader = PdfReader(str(input_path))
+    # Scratch writer that owns the shared layer objects (overlays, pattern, logo)
+    shared = PdfWriter()
+    layers = _document_layers(
+        shared, pattern, logo, logo_asset, font_name, footer_text, diagonal_text, footer_style, diagonal_style
+    )
+
+    level = {"fast": None, "balanced": 6, "small": 9}[profile]
+    tmp = output_path.with_suffix(output_path.suffix + ".tmp")
+    try:
+        pages = _write_streaming(tmp, reader, layers, level, fingerprint)
+    except BaseException:
+        # Also on a deadline: never leave a half-written copy behind
+        tmp.unlink(missing_ok=True)
+        raise
+    tmp.replace(output_path)
+
+    return StampResult(
+        mode="visible",
+        profile=profile,
+        pages=pages,
+        input_bytes=input_path.stat().st_size,
+        output_bytes=output_path.stat().st_size,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def _write_streaming(
+    tmp: Path, reader: PdfReader, layers: Optional[_DocumentLayers], level: Optional[int], fingerprint: Optional[str]
+) -> int:
+    """Write the stamped document to ``tmp`` page by page; returns the page count."""
+    with open(tmp, "wb") as f:
+        out = _StreamingPdfWriter(f, level)
+        root, pages_root, info = out.reserve(), out.reserve(), out.reserve()
+        for node in _page_tree_nodes(reader):
+            out.alias(node, pages_root)
+        kids = []
+        for page in reader.pages:
+            num = out.reserve()
+            out.alias(page.indirect_reference, num)
+            kids.append(num)
+
+        for num, page in zip(kids, reader.pages):
+            check_deadline()
+            if layers:
+                layers.apply(page)
+            page[NameObject("/Parent")] = out.ref(pages_root)
+            out.write(num, page)
+            out.flush()
+            # Drop everything this page pulled into memory
+            page.clear()
+            reader.resolved_objects.clear()
+
+        out.write(pages_root, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(out.ref(k) for k in kids),
+            NameObject("/Count"): NumberObject(len(kids)),
+        }))
+        out.write(root, DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): out.ref(pages_root),
+        }))
+        info_dict = DictionaryObject({NameObject("/Producer"): TextStringObject("Gumstamp")})
+        if fingerprint:
+            info_dict[NameObject(FINGERPRINT_KEY)] = TextStringObject(fingerprint)
+        out.write(info, info_dict)
+        out.close(root, info)
+    return len(kids)
+
+
+def _startxref(path: Path) -> Tuple[int, bool]:
+    """Offset of the last cross-reference section and whether it is an XRef stream."""
+    with open(path, "rb") as f:
+        f.seek(0, io.SEEK_END)
+        f.seek(max(f.tell() - 2048, 0))
+        tail = f.read()
+        pos = tail.rfind(b"startxref")
+        if pos < 0:
+            raise ValueError("startxref not found")
+        offset = int(tail[pos + 9:].split()[0])
+        f.seek(offset)
+        head = f.read(32)
+    return offset, not head.lstrip().startswith(b"xref")
+
+
+def _xref_runs(entries: List[Tuple[int, int, int]]) -> Iterator[List[Tuple[int, int, int]]]:
+    """Group (idnum, generation, offset) entries into runs of consecutive ids."""
+    run: List[Tuple[int, int, int]] = []
+    for entry in sorted(entries):
+        if run and entry[0] != run[-1][0] + 1:
+            yield run
+            run = []
+        run.append(entry)
+    if run:
+        yield run
+
+
+def _xmp_packet(fingerprint: str, existing: Optional[bytes]) -> bytes:
+    description = (
+        f'<rdf:Description rdf:about="" xmlns:gumstamp="{XMP_NS}">'
+        f"<gumstamp:Fingerprint>{escape(fingerprint)}</gumstamp:Fingerprint>"
+        "</rdf:Description>"
+    ).encode("utf-8")
+    if existing and b"</rdf:RDF>" in existing:
+        # Keep the creator's XMP and add our description alongside it
+        head, _, tail = existing.rpartition(b"</rdf:RDF>")
+        return head + description + b"</rdf:RDF>" + tail
+    return (
+        b'<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        b'<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        b'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        + description
+        + b"</rdf:RDF></x:xmpmeta>"
+        b'<?xpacket end="w"?>'
+    )
+
+
+def fingerprint_pdf(input_path: Path, output_path: Path, fingerprint: str, marker: bool = False) -> StampResult:
+    """Write a buyer fingerprint without touching any page content.
+
+    The source is copied verbatim (sendfile/copy_file_range on Linux) and an
+    incremental update is appended that rewrites only the catalog and Info
+    dictionary and adds an XMP metadata stream, plus an optional marker
+    object referenced from the catalog. The update ends in the same kind of
+    cross-reference section as the source (table or XRef stream) and gives the
+    copy a new revision ID. Cost is independent of page count.
+    Raises ValueError for encrypted or unparseable sources.
+    """
+    start = time.perf_counter()
+    reader = PdfReader(str(input_path))
+    if reader.is_encrypted:
+        raise ValueError("Encrypted PDFs cannot be fingerprinted")
+    trailer = reader.trailer
+    root_ref = trailer.raw_get("/Root")
+    catalog = DictionaryObject(root_ref.get_object())
+    size = int(trailer["/Size"])
+    prev, xref_stream = _startxref(input_path)
+
+    def new_ref() -> IndirectObject:
+        nonlocal size
+        size += 1
+        return IndirectObject(size - 1, 0, None)
+
+    objects: List[Tuple[IndirectObject, object]] = []
+
+    info_ref = trailer.raw_get("/Info") if "/Info" in trailer else None
+    info = DictionaryObject(info_ref.get_object()) if info_ref is not None else DictionaryObject()
+    if not isinstance(info_ref, IndirectObject):
+        info_ref = new_ref()
+    info[NameObject(FINGERPRINT_KEY)] = TextStringObject(fingerprint)
+    objects.append((info_ref, info))
+
+    existing_xmp = None
+    if "/Metadata" in catalog:
+        try:
+            existing_xmp = catalog["/Metadata"].get_object().get_data()
+        except Exception:
+            existing_xmp = None
+    xmp = DecodedStreamObject()
+    xmp.set_data(_xmp_packet(fingerprint, existing_xmp))
+    xmp.update({
+        NameObject("/Type"): NameObject("/Metadata"),
+        NameObject("/Subtype"): NameObject("/XML"),
+    })
+    xmp_ref = new_ref()
+    objects.append((xmp_ref, xmp))
+    catalog[NameObject("/Metadata")] = xmp_ref
+
+    if marker:
+        marker_ref = new_ref()
+        objects.append((marker_ref, DictionaryObject({
+            NameObject("/Type"): NameObject(MARKER_KEY),
+            NameObject("/Fingerprint"): TextStringObject(fingerprint),
+        })))
+        catalog[NameObject(MARKER_KEY)] = marker_ref
+    objects.append((root_ref, catalog))
+
+    tmp = output_path.with_suffix(output_path.suffix + ".tmp")
+    shutil.copyfile(input_path, tmp)
+    with open(tmp, "ab") as f:
+        f.write(b"\n")
+        offsets = []
+        for ref, obj in objects:
+            offsets.append((ref.idnum, ref.generation, f.tell()))
+            f.write(f"{ref.idnum} {ref.generation} obj\n".encode())
+            obj.write_to_stream(f)
+            f.write(b"\nendobj\n")
+
+        new_trailer = DictionaryObject({
+            NameObject("/Root"): root_ref,
+            NameObject("/Info"): info_ref,
+            NameObject("/Prev"): NumberObject(prev),
+        })
+        # Same document, new revision: keep the permanent first half of the
+        # ID and change the second one
+        original_id = trailer.get("/ID")
+        first = original_id[0] if original_id else ByteStringObject(secrets.token_bytes(16))
+        new_trailer[NameObject("/ID")] = ArrayObject([first, ByteStringObject(secrets.token_bytes(16))])
+
+        xref_at = f.tell()
+        if xref_stream:
+            # An update must use the kind of cross-reference section the
+            # source ends with, or readers may miss the earlier sections
+            xref_ref = new_ref()
+            offsets.append((xref_ref.idnum, 0, xref_at))
+            width = max(4, (xref_at.bit_length() + 7) // 8)
+            index: List[NumberObject] = []
+            rows = []
+            for run in _xref_runs(offsets):
+                index += [NumberObject(run[0][0]), NumberObject(len(run))]
+                rows += [b"\x01" + offset.to_bytes(width, "big") + gen.to_bytes(2, "big") for _, gen, offset in run]
+            xref = DecodedStreamObject()
+            xref.set_data(b"".join(rows))
+            xref.update(new_trailer)
+            xref.update({
+                NameObject("/Type"): NameObject("/XRef"),
+                NameObject("/Size"): NumberObject(size),
+                NameObject("/W"): ArrayObject([NumberObject(1), NumberObject(width), NumberObject(2)]),
+                NameObject("/Index"): ArrayObject(index),
+            })
+            f.write(f"{xref_ref.idnum} 0 obj\n".encode())
+            xref.write_to_stream(f)
+            f.write(b"\nendobj\n")
+        else:
+            # Start with the head of the free list: readers such as pypdf take
+            # a table whose first subsection is not object 0 for a misnumbered one
+            f.write(b"xref\n0 1\n0000000000 65535 f \n")
+            for run in _xref_runs(offsets):
+                f.write(f"{run[0][0]} {len(run)}\n".encode())
+                for _, gen, offset in run:
+                    f.write(f"{offset:0>10} {gen:0>5} n \n".encode())
+            new_trailer[NameObject("/Size")] = NumberObject(size)
+            f.write(b"trailer\n")
+            new_trailer.write_to_stream(f)
+        f.write(f"\nstartxref\n{xref_at}\n%%EOF\n".encode())
+    tmp.replace(output_path)
+
+    return StampResult(
+        mode="metadata",
+        input_bytes=input_path.stat().st_size,
+        output_bytes=output_path.stat().st_size,
+        seconds=time.perf_counter() - start,
+    )
+
+
+_XMP_FINGERPRINT = re.compile(rb"<gumstamp:Fingerprint>([^<]{1,200})</gumstamp:Fingerprint>")
+_EMAIL = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+
+
+def read_fingerprint(path: Path) -> Optional[str]:
+    """The buyer fingerprint embedded by stamping, or None.
+
+    Looks at the Info dictionary, then the catalog marker object, then the
+    XMP packet, so a copy that lost one of them (for example by being
+    re-saved in another tool) can still be traced.
+    """
+    reader = PdfReader(str(path))
+    if reader.is_encrypted:
+        return None
+    info = reader.trailer.get("/Info")
+    if info is not None and FINGERPRINT_KEY in info.get_object():
+        return str(info.get_object()[FINGERPRINT_KEY])
+    catalog = reader.trailer["/Root"].get_object()
+    marker = catalog.get(MARKER_KEY)
+    if marker is not None and "/Fingerprint" in marker.get_object():
+        return str(marker.get_object()["/Fingerprint"])
+    if "/Metadata" in catalog:
+        try:
+            match = _XMP_FINGERPRINT.search(catalog["/Metadata"].get_object().get_data())
+        except Exception:
+            match = None
+        if match:
+            return match.group(1).decode("utf-8", "replace")
+    return None
+
+
+def stamped_emails(path: Path, pages: int = 2) -> List[str]:
+    """Email addresses in the text of the first and last pages (visible stamps)."""
+    reader = PdfReader(str(path))
+    if reader.is_encrypted:
+        return []
+    count = len(reader.pages)
+    found: Dict[str, None] = {}
+    for index in sorted({*range(min(pages, count)), *range(max(count - pages, 0), count)}):
+        for email in _EMAIL.findall(reader.pages[index].extract_text() or ""):
+            found.setdefault(email)
+    return list(found)
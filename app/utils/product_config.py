@@ -0,0 +1,158 @@
+"""Per-product stamping configuration, validated and cached in memory.
+
+Configs live next to the source PDF as ``source/{product_id}.json``. The store
+keeps parsed ``ProductConfig`` objects in a dict: the upload route writes
+through it, and other worker processes notice changes by the file's mtime,
+checked at most every RECHECK_SECONDS per product. A cache hit is a dict
+lookup with no file I/O.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from functools import cached_property
+from typing import Dict, Mapping, Optional, Union
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+from ..settings import settings
+from .templates import TEMPLATE_VARIABLES, CompiledTemplate, TemplateError, compile_template
+from .watermarks import (
+    DEFAULT_OUTPUT_PROFILE,
+    OUTPUT_PROFILES,
+    STAMP_MODES,
+    DiagonalStyle,
+    FooterStyle,
+    LogoSpec,
+    PatternSpec,
+)
+
+RECHECK_SECONDS = 2.0
+DEFAULT_FOOTER = "Purchased by {email}"
+
+
+class ProductConfigError(ValueError):
+    """The stored configuration for a product is unreadable or invalid."""
+
+
+class ProductConfig(BaseModel):
+    # Unknown keys are ignored so workers on an older release can read
+    # configs written by a newer one during a rolling deploy
+    model_config = ConfigDict(extra="ignore")
+
+    footer_text: Optional[str] = Field(default=None, max_length=300)
+    footer: FooterStyle = FooterStyle()
+    diagonal_text: Optional[str] = Field(default=None, max_length=200)
+    diagonal: DiagonalStyle = DiagonalStyle()
+    mode: str = Field(default="visible", pattern="^(" + "|".join(STAMP_MODES) + ")$")
+    marker: bool = False
+    profile: str = Field(default=DEFAULT_OUTPUT_PROFILE, pattern="^(" + "|".join(OUTPUT_PROFILES) + ")$")
+    pattern: Optional[PatternSpec] = None
+    logo: Optional[LogoSpec] = None
+    font: Optional[str] = Field(default=None, pattern="^[0-9a-f]{16}$")
+
+    # Templates are compiled once per loaded config, not per buyer. The upload
+    # route rejects bad placeholders; configs saved before templates existed
+    # may contain stray braces, which are kept as literal text.
+    @cached_property
+    def footer_template(self) -> CompiledTemplate:
+        return _compile_lenient(self.footer_text or DEFAULT_FOOTER)
+
+    @cached_property
+    def diagonal_template(self) -> Optional[CompiledTemplate]:
+        return _compile_lenient(self.diagonal_text) if self.diagonal_text else None
+
+    def footer_for(self, values: Mapping[str, Optional[str]]) -> str:
+        return self.footer_template.render(values)
+
+    def diagonal_for(self, values: Mapping[str, Optional[str]]) -> Optional[str]:
+        template = self.diagonal_template
+        return template.render(values) if template else None
+
+
+def _compile_lenient(text: str) -> CompiledTemplate:
+    try:
+        return compile_template(text)
+    except TemplateError:
+        pass
+    # Keep known placeholders, turn anything else into literal text
+    escaped = text.replace("{", "{{").replace("}", "}}")
+    for name in TEMPLATE_VARIABLES:
+        escaped = escaped.replace("{{" + name + "}}", "{" + name + "}")
+    return compile_template(escaped)
+
+
+class _Entry:
+    __slots__ = ("value", "mtime_ns", "checked_at")
+
+    def __init__(self, value: Union[ProductConfig, ProductConfigError], mtime_ns: Optional[int]):
+        self.value = value
+        self.mtime_ns = mtime_ns
+        self.checked_at = time.monotonic()
+
+
+class ProductConfigStore:
+    def __init__(self, recheck_seconds: float = RECHECK_SECONDS):
+        self.recheck_seconds = recheck_seconds
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def path(product_id: str) -> Path:
+        return settings.storage_dir / "source" / f"{product_id}.json"
+
+    def get(self, product_id: str) -> ProductConfig:
+        """The product's config (defaults if none was saved).
+
+        Raises ProductConfigError if the stored file is invalid, rather than
+        silently stamping with settings the creator did not choose.
+        """
+        entry = self._entries.get(product_id)
+        if entry is None or time.monotonic() - entry.checked_at >= self.recheck_seconds:
+            entry = self._refresh(product_id, entry)
+        if isinstance(entry.value, ProductConfigError):
+            raise entry.value
+        return entry.value
+
+    def _refresh(self, product_id: str, entry: Optional[_Entry]) -> _Entry:
+        path = self.path(product_id)
+        try:
+            mtime_ns: Optional[int] = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if entry is not None and entry.mtime_ns == mtime_ns:
+            entry.checked_at = time.monotonic()
+            return entry
+
+        value: Union[ProductConfig, ProductConfigError]
+        if mtime_ns is None:
+            value = ProductConfig()
+        else:
+            try:
+                value = ProductConfig.model_validate(json.loads(path.read_bytes()))
+            except (OSError, ValueError, ValidationError) as e:
+                value = ProductConfigError(f"Invalid config for product {product_id!r}: {e}")
+        entry = _Entry(value, mtime_ns)
+        with self._lock:
+            self._entries[product_id] = entry
+        return entry
+
+    def put(self, product_id: str, config: ProductConfig) -> None:
+        """Persist ``config`` atomically and make it visible in this process at once."""
+        path = self.path(product_id)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(config.model_dump_json())
+        tmp.replace(path)
+        with self._lock:
+            self._entries[product_id] = _Entry(config, path.stat().st_mtime_ns)
+
+    def invalidate(self, product_id: Optional[str] = None) -> None:
+        with self._lock:
+            if product_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(product_id, None)
+
+
+product_configs = ProductConfigStore()
@@ -0,0 +1,130 @@
+"""In-process token-bucket rate limiting for the hot endpoints.
+
+Each scope (e.g. ``download.ip``) has its own budget of ``N`` requests per
+``S`` seconds with a burst of ``N``, tracked per key (IP, token, product) in a
+bounded LRU map. A check is a dict lookup and a little arithmetic under a
+lock, so routes run it before verifying tokens or touching the disk.
+
+Limits are per process: with ``WEB_CONCURRENCY`` workers an instance admits up
+to that many times the configured budget.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from ..settings import settings
+
+# scope -> "requests/seconds"; override with RATE_LIMITS, "0" disables a scope
+DEFAULT_LIMITS = {
+    "download.token": "20/60",
+    "download.ip": "60/60",
+    "download.product": "1200/60",
+    "creator_token.ip": "120/60",
+    "creator_token.product": "1200/60",
+    # Off by default: Gumroad pings come from a few addresses and a 429 only
+    # makes Gumroad retry, while a retried sale is deduplicated cheaply by
+    # sale_id (app.utils.sales)
+    "ping.ip": "0",
+    "ping.product": "0",
+}
+# Keys tracked per scope; the least recently seen are forgotten first
+MAX_KEYS = 100_000
+
+
+def parse_limits(spec: str) -> Dict[str, Optional[Tuple[int, float]]]:
+    """Budgets from ``"download.ip=30/60,ping.ip=0"`` merged over the defaults."""
+    raw = dict(DEFAULT_LIMITS)
+    if spec.strip().lower() == "off":
+        return {scope: None for scope in raw}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        scope, _, value = item.partition("=")
+        scope = scope.strip()
+        if scope not in raw:
+            raise ValueError(f"Unknown rate limit scope: {scope!r}")
+        raw[scope] = value.strip()
+    limits: Dict[str, Optional[Tuple[int, float]]] = {}
+    for scope, value in raw.items():
+        count, _, period = value.partition("/")
+        limits[scope] = (int(count), float(period or 1)) if int(count) > 0 else None
+    return limits
+
+
+class RateLimiter:
+    """Token buckets for one scope."""
+
+    def __init__(self, limit: int, period: float, max_keys: int = MAX_KEYS):
+        self.capacity = float(limit)
+        self.rate = limit / period
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> float:
+        """Take one token for ``key``; 0.0 if allowed, else seconds until allowed."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.capacity, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return 0.0
+            return (1.0 - bucket[0]) / self.rate
+
+
+_limiters: Optional[Dict[str, Optional[RateLimiter]]] = None
+_init_lock = threading.Lock()
+
+
+def _get_limiters() -> Dict[str, Optional[RateLimiter]]:
+    global _limiters
+    if _limiters is None:
+        with _init_lock:
+            if _limiters is None:
+                _limiters = {
+                    scope: RateLimiter(*budget) if budget else None
+                    for scope, budget in parse_limits(settings.rate_limits).items()
+                }
+    return _limiters
+
+
+def check(scope: str, key: Optional[str]) -> float:
+    """Charge ``key`` against ``scope``; returns the Retry-After delay if rejected.
+
+    Rejections are counted in ``gumstamp_rate_limited_total``.
+    """
+    limiter = _get_limiters()[scope]
+    if limiter is None or not key:
+        return 0.0
+    retry_after = limiter.hit(key)
+    if retry_after:
+        from ..monitoring import BusinessMetrics
+
+        BusinessMetrics.track_rate_limited(scope)
+    return retry_after
+
+
+def reset() -> None:
+    """Forget all buckets and re-read RATE_LIMITS (used by tests)."""
+    global _limiters
+    _limiters = None
+
+
+def too_many_requests(retry_after: float):
+    """The 429 response for a rejected request."""
+    from fastapi import HTTPException
+
+    return HTTPException(
+        status_code=429,
+        detail="Too many requests",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
@@ -0,0 +1,170 @@
+"""Idempotent ingestion of Gumroad sale pings.
+
+Gumroad retries a ping until it gets a 2xx, and during launches it retries
+aggressively. Every sale is keyed by its ``sale_id``: the first ping mints the
+buyer's download token, later deliveries of the same sale get that token back
+and cause no further work.
+
+Pings are acknowledged without waiting on disk. New sales are kept in memory
+and written to the ``sales`` table in batches by a background thread, one
+transaction per batch. The table's primary key is the persistent dedupe index
+shared by every worker process, so a retry landing on another worker (or
+after a restart) is still recognised; ``INSERT OR IGNORE`` decides which
+worker's copy is the one that counts.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import structlog
+
+from ..settings import settings
+from .db import connect, register_schema
+from .tokens import sign_token
+
+logger = structlog.get_logger("gumstamp.sales")
+
+# Sale ids remembered in memory per process; older ones are looked up in SQLite
+MAX_RECENT = 100_000
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS sales (
+    sale_id TEXT PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    email TEXT NOT NULL,
+    token TEXT NOT NULL,
+    details TEXT NOT NULL,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sales_product ON sales (product_id);
+""")
+
+
+class SaleLog:
+    def __init__(self, batch_size: int, flush_seconds: float, max_recent: int = MAX_RECENT):
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.max_recent = max_recent
+        self._cond = threading.Condition()
+        self._recent: "OrderedDict[str, str]" = OrderedDict()
+        self._pending: List[Dict[str, Any]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"new": 0, "duplicate": 0, "written": 0, "batches": 0}
+
+    def _remember(self, sale_id: str, token: str) -> None:
+        self._recent[sale_id] = token
+        self._recent.move_to_end(sale_id)
+        while len(self._recent) > self.max_recent:
+            self._recent.popitem(last=False)
+
+    def ingest(self, sale_id: str, product_id: str, email: str, details: Dict[str, Any]) -> Tuple[str, bool]:
+        """Return ``(token, duplicate)`` for a ping; never blocks on a write."""
+        with self._cond:
+            token = self._recent.get(sale_id)
+            if token is None:
+                row = connect().execute("SELECT token FROM sales WHERE sale_id = ?", (sale_id,)).fetchone()
+                token = row[0] if row else None
+            if token is not None:
+                self._remember(sale_id, token)
+                self._stats["duplicate"] += 1
+                return token, True
+
+            token = sign_token({"sale_id": sale_id, "product_id": product_id, "email": email, **details})
+            self._remember(sale_id, token)
+            self._pending.append({
+                "sale_id": sale_id,
+                "product_id": product_id,
+                "email": email,
+                "token": token,
+                "details": details,
+                "received_at": time.time(),
+            })
+            self._stats["new"] += 1
+            self._ensure_thread()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+            return token, False
+
+    def _ensure_thread(self) -> None:
+        # Started lazily so importing or forking never leaves idle threads behind
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sale-log", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                # The batch is kept and retried on the next tick (e.g. database busy)
+                logger.warning("Sale batch write failed", error=str(e))
+                time.sleep(self.flush_seconds)
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """Write pending sales; returns the ones this call inserted."""
+        with self._cond:
+            batch, self._pending = self._pending[: self.batch_size], self._pending[self.batch_size:]
+        if not batch:
+            return []
+        conn = connect()
+        inserted = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for sale in batch:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO sales (sale_id, product_id, email, token, details, received_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (sale["sale_id"], sale["product_id"], sale["email"], sale["token"],
+                     json.dumps(sale["details"]), sale["received_at"]),
+                )
+                if cur.rowcount == 1:
+                    inserted.append(sale)
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            with self._cond:
+                self._pending[:0] = batch
+            raise
+        with self._cond:
+            self._stats["written"] += len(inserted)
+            self._stats["batches"] += 1
+        return inserted
+
+    def close(self) -> None:
+        """Write everything still pending (used at shutdown)."""
+        while True:
+            with self._cond:
+                if not self._pending:
+                    return
+            self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {**self._stats, "pending": len(self._pending)}
+
+
+_sale_log: Optional[SaleLog] = None
+_sale_log_pid: Optional[int] = None
+_sale_log_lock = threading.Lock()
+
+
+def get_sale_log() -> SaleLog:
+    """The process-wide sale log (recreated after a fork)."""
+    global _sale_log, _sale_log_pid
+    with _sale_log_lock:
+        if _sale_log is None or _sale_log_pid != os.getpid():
+            _sale_log = SaleLog(settings.ping_batch_size, settings.ping_flush_seconds)
+            _sale_log_pid = os.getpid()
+        return _sale_log
+
+
+def current_sale_log() -> Optional[SaleLog]:
+    """The sale log if this process has created one, for shutdown and metrics."""
+    return _sale_log if _sale_log_pid == os.getpid() else None
@@ -0,0 +1,332 @@
+"""Priority-aware execution of stamping work.
+
+Stamping requests carry a priority class:
+
+- ``interactive``: a buyer is waiting on ``/download``
+- ``prewarm``: copies stamped ahead of the first download
+- ``bulk``: backfills and batch jobs
+
+A fixed pool of threads runs jobs. Each class has its own concurrency cap
+(bulk work can never occupy every slot, so interactive latency stays flat),
+and jobs are picked by effective deadline ``enqueued_at + rank * aging``, so a
+lower class waiting longer than ``aging`` seconds per rank of difference
+overtakes newer higher-priority work and nothing starves.
+
+Within a class, jobs are shared between tenants (products) by weighted fair
+queuing: each job gets a virtual finish tag ``max(V, tenant's last tag) +
+1 / weight`` and the smallest tag runs first, so a product with a thousand
+queued copies takes turns with one that has a single buyer waiting instead of
+going first. Each tenant may also be capped in running jobs (across classes)
+and in queued jobs per class, so a product's bulk backlog never blocks its
+own buyers; submits over the queue quota raise ``QueueFull``.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from ..settings import settings
+from .deadline import StampTimeout
+
+PRIORITY_CLASSES = ("interactive", "prewarm", "bulk")
+DEFAULT_PRIORITY = "interactive"
+# Tenant of jobs submitted without one
+DEFAULT_TENANT = ""
+
+
+class QueueFull(Exception):
+    """The tenant already has its quota of queued jobs."""
+
+
+def parse_caps(spec: str, concurrency: int) -> Dict[str, int]:
+    """Per-class caps from ``"prewarm=2,bulk=1"``; unlisted classes use defaults.
+
+    By default interactive may use every slot, pre-warm half and bulk a
+    quarter (at least one each).
+    """
+    caps = {
+        "interactive": concurrency,
+        "prewarm": max(1, concurrency // 2),
+        "bulk": max(1, concurrency // 4),
+    }
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        name = name.strip()
+        if name not in caps:
+            raise ValueError(f"Unknown priority class: {name!r}")
+        caps[name] = max(1, min(concurrency, int(value)))
+    return caps
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Tenant weights from ``"product-a=2,product-b=0.5"``; others weigh 1."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        weight = float(value)
+        if weight <= 0:
+            raise ValueError(f"Weight must be positive: {item!r}")
+        weights[name.strip()] = weight
+    return weights
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "context", "future", "priority", "tenant", "enqueued_at", "start", "finish")
+
+    def __init__(self, fn, args, kwargs, priority: str, tenant: str):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        # Carry tracing/logging context into the pool thread
+        self.context = contextvars.copy_context()
+        self.future: Future = Future()
+        self.priority = priority
+        self.tenant = tenant
+        self.enqueued_at = time.monotonic()
+        # Virtual start and finish tags for fair queuing within the class
+        self.start = 0.0
+        self.finish = 0.0
+
+
+class _Tenant:
+    __slots__ = ("queues", "last_finish", "queued", "running", "completed", "rejected", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.queues: Dict[str, Deque[_Job]] = {name: deque() for name in PRIORITY_CLASSES}
+        self.last_finish: Dict[str, float] = {name: 0.0 for name in PRIORITY_CLASSES}
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class StampScheduler:
+    def __init__(
+        self,
+        concurrency: int,
+        caps: Dict[str, int],
+        aging_seconds: float,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        tenant_max_running: int = 0,
+        tenant_max_queued: int = 0,
+    ):
+        self.concurrency = concurrency
+        self.caps = caps
+        self.aging_seconds = aging_seconds
+        self.tenant_weights = tenant_weights or {}
+        # 0 means no limit
+        self.tenant_max_running = tenant_max_running
+        self.tenant_max_queued = tenant_max_queued
+        self._cond = threading.Condition()
+        # Tenants with queued or running jobs; idle ones are dropped
+        self._tenants: Dict[str, _Tenant] = {}
+        # Per-class virtual time: start tag of the job dispatched last
+        self._vtime: Dict[str, float] = {name: 0.0 for name in PRIORITY_CLASSES}
+        self._queued: Dict[str, int] = {name: 0 for name in PRIORITY_CLASSES}
+        self._rejected = 0
+        self._running: Dict[str, int] = {name: 0 for name in PRIORITY_CLASSES}
+        self._completed: Dict[str, int] = {name: 0 for name in PRIORITY_CLASSES}
+        # Jobs stopped at their stamping deadline, and jobs cancelled while queued
+        self._timeouts: Dict[str, int] = {name: 0 for name in PRIORITY_CLASSES}
+        self._cancelled: Dict[str, int] = {name: 0 for name in PRIORITY_CLASSES}
+        self._wait_total: Dict[str, float] = {name: 0.0 for name in PRIORITY_CLASSES}
+        self._wait_max: Dict[str, float] = {name: 0.0 for name in PRIORITY_CLASSES}
+        self._threads = []
+
+    def _ensure_threads(self) -> None:
+        # Started lazily so importing or forking never leaves idle threads behind
+        if self._threads:
+            return
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._work, name=f"stamp-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        priority: str = DEFAULT_PRIORITY,
+        tenant: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Future:
+        if priority not in self._queued:
+            raise ValueError(f"Unknown priority class: {priority!r}")
+        job = _Job(fn, args, kwargs, priority, tenant or DEFAULT_TENANT)
+        with self._cond:
+            state = self._tenants.get(job.tenant)
+            if state is None:
+                state = self._tenants[job.tenant] = _Tenant()
+            if self.tenant_max_queued and len(state.queues[priority]) >= self.tenant_max_queued:
+                state.rejected += 1
+                self._rejected += 1
+                raise QueueFull(f"Too many queued stamping jobs for {job.tenant!r}")
+            self._ensure_threads()
+            job.start = max(self._vtime[priority], state.last_finish[priority])
+            job.finish = job.start + 1.0 / self.tenant_weights.get(job.tenant, 1.0)
+            state.last_finish[priority] = job.finish
+            state.queues[priority].append(job)
+            state.queued += 1
+            self._queued[priority] += 1
+            self._cond.notify()
+        return job.future
+
+    async def run(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        priority: str = DEFAULT_PRIORITY,
+        tenant: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args, priority=priority, tenant=tenant, **kwargs))
+
+    def _next_job(self) -> Optional[_Job]:
+        """Next job: the class with the oldest effective deadline among those
+        below their cap, and within it the smallest finish tag among tenants
+        below their running quota."""
+        best: Optional[Tuple[float, _Job]] = None
+        for rank, name in enumerate(PRIORITY_CLASSES):
+            if not self._queued[name] or self._running[name] >= self.caps[name]:
+                continue
+            oldest = head = None
+            for state in self._tenants.values():
+                queue = state.queues[name]
+                if not queue or (self.tenant_max_running and state.running >= self.tenant_max_running):
+                    continue
+                if oldest is None or queue[0].enqueued_at < oldest:
+                    oldest = queue[0].enqueued_at
+                if head is None or queue[0].finish < head.finish:
+                    head = queue[0]
+            if head is None:
+                continue
+            deadline = oldest + rank * self.aging_seconds
+            if best is None or deadline < best[0]:
+                best = (deadline, head)
+        if best is None:
+            return None
+        job = best[1]
+        state = self._tenants[job.tenant]
+        state.queues[job.priority].popleft()
+        state.queued -= 1
+        state.running += 1
+        self._queued[job.priority] -= 1
+        self._vtime[job.priority] = max(self._vtime[job.priority], job.start)
+        return job
+
+    def _work(self) -> None:
+        from ..monitoring import BusinessMetrics
+
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.priority] += 1
+                waited = time.monotonic() - job.enqueued_at
+                self._wait_total[job.priority] += waited
+                self._wait_max[job.priority] = max(self._wait_max[job.priority], waited)
+                state = self._tenants[job.tenant]
+                state.wait_total += waited
+                state.wait_max = max(state.wait_max, waited)
+
+            BusinessMetrics.track_stamp_wait(waited, job.priority)
+            timed_out = cancelled = False
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(job.context.run(job.fn, *job.args, **job.kwargs))
+                except BaseException as e:
+                    # Callers may wrap the timeout, e.g. into an HTTP error
+                    timed_out = isinstance(e, StampTimeout) or isinstance(e.__cause__, StampTimeout)
+                    job.future.set_exception(e)
+            else:
+                cancelled = True
+
+            with self._cond:
+                self._running[job.priority] -= 1
+                self._completed[job.priority] += 1
+                self._timeouts[job.priority] += timed_out
+                self._cancelled[job.priority] += cancelled
+                state.running -= 1
+                state.completed += 1
+                if not state.queued and not state.running:
+                    # A returning tenant starts again at the class's virtual time
+                    del self._tenants[job.tenant]
+                # A freed slot may unblock a capped class
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._cond:
+            classes = {}
+            for name in PRIORITY_CLASSES:
+                heads = [s.queues[name][0].enqueued_at for s in self._tenants.values() if s.queues[name]]
+                started = self._completed[name] + self._running[name]
+                classes[name] = {
+                    "queued": self._queued[name],
+                    "running": self._running[name],
+                    "cap": self.caps[name],
+                    "completed": self._completed[name],
+                    "timeouts": self._timeouts[name],
+                    "cancelled": self._cancelled[name],
+                    "oldest_wait_seconds": round(now - min(heads), 3) if heads else 0.0,
+                    "avg_wait_seconds": round(self._wait_total[name] / started, 4) if started else 0.0,
+                    "max_wait_seconds": round(self._wait_max[name], 4),
+                }
+            # Only tenants with work in flight are tracked
+            tenants = {}
+            for tenant, state in self._tenants.items():
+                started = state.completed + state.running
+                tenants[tenant] = {
+                    "weight": self.tenant_weights.get(tenant, 1.0),
+                    "queued": state.queued,
+                    "running": state.running,
+                    "completed": state.completed,
+                    "rejected": state.rejected,
+                    "avg_wait_seconds": round(state.wait_total / started, 4) if started else 0.0,
+                    "max_wait_seconds": round(state.wait_max, 4),
+                }
+            return {
+                "concurrency": self.concurrency,
+                "aging_seconds": self.aging_seconds,
+                "classes": classes,
+                "tenant_max_running": self.tenant_max_running,
+                "tenant_max_queued": self.tenant_max_queued,
+                "quota_rejected": self._rejected,
+                "tenants": tenants,
+            }
+
+
+_scheduler: Optional[StampScheduler] = None
+_scheduler_pid: Optional[int] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> StampScheduler:
+    """The process-wide scheduler (recreated after a fork)."""
+    global _scheduler, _scheduler_pid
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler_pid != os.getpid():
+            concurrency = max(1, settings.stamp_concurrency)
+            _scheduler = StampScheduler(
+                concurrency,
+                parse_caps(settings.stamp_class_caps, concurrency),
+                settings.stamp_aging_seconds,
+                parse_weights(settings.stamp_tenant_weights),
+                settings.stamp_tenant_max_running,
+                settings.stamp_tenant_max_queued,
+            )
+            _scheduler_pid = os.getpid()
+        return _scheduler
+
+
+def current_scheduler() -> Optional[StampScheduler]:
+    """The scheduler if this process has created one, for metrics collection."""
+    return _scheduler if _scheduler_pid == os.getpid() else None
@@ -0,0 +1,81 @@
+"""Serving stamped copies without holding a worker thread per download.
+
+``StampedFileResponse`` picks the cheapest way to deliver a file:
+
+1. Proxy offload: with SENDFILE_HEADER set (``X-Accel-Redirect`` for nginx,
+   ``X-Sendfile`` for Apache/lighttpd) the response carries only headers and
+   the proxy sends the file with sendfile(2).
+2. ASGI zero-copy: servers advertising the ``http.response.zerocopysend``
+   extension are handed the open file descriptor.
+3. Otherwise the file is read off the event loop in as few thread hops as
+   possible: one for typical stamped copies, large chunks for big files.
+
+``CachedFileResponse`` answers from the memory tier (``app.utils.memcache``)
+with the headers the copy was first served with.
+"""
+import asyncio
+import os
+from pathlib import Path
+from typing import List, Tuple
+from urllib.parse import quote
+
+from starlette.responses import FileResponse, Response
+
+from ..settings import settings
+
+# Files up to this size are read in a single thread hop
+INLINE_MAX_BYTES = 4 * 1024 * 1024
+CHUNK_BYTES = 1024 * 1024
+
+
+class StampedFileResponse(FileResponse):
+    def __init__(self, path: Path, stat_result: os.stat_result, filename: str, media_type: str = "application/pdf"):
+        self.offload = settings.sendfile_header
+        # The proxy sets its own Content-Length for offloaded responses
+        super().__init__(
+            path,
+            media_type=media_type,
+            filename=filename,
+            stat_result=None if self.offload else stat_result,
+        )
+        self.size = stat_result.st_size
+        if self.offload:
+            if self.offload.lower() == "x-accel-redirect":
+                rel = Path(path).relative_to(settings.storage_dir / "stamped")
+                target = settings.sendfile_prefix.rstrip("/") + "/" + quote(rel.as_posix())
+            else:
+                target = str(path)
+            self.headers[self.offload] = target
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD" or self.offload:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.zerocopysend" in scope.get("extensions", {}):
+            f = await asyncio.to_thread(open, self.path, "rb")
+            try:
+                await send({"type": "http.response.zerocopysend", "file": f, "count": self.size, "more_body": False})
+            finally:
+                f.close()
+        elif self.size <= INLINE_MAX_BYTES:
+            body = await asyncio.to_thread(Path(self.path).read_bytes)
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+        else:
+            f = await asyncio.to_thread(open, self.path, "rb")
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(f.read, CHUNK_BYTES)
+                    more_body = len(chunk) == CHUNK_BYTES
+                    await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+                    if not more_body:
+                        break
+            finally:
+                f.close()
+        if self.background is not None:
+            await self.background()
+
+
+class CachedFileResponse(Response):
+    def __init__(self, body: bytes, headers: List[Tuple[bytes, bytes]]):
+        super().__init__(body)
+        self.raw_headers = list(headers)
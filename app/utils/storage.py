@@ -1,4 +1,7 @@
+import hashlib
+import re
 from pathlib import Path
+from typing import Optional
 from ..settings import settings
 
 
@@ -6,7 +9,34 @@ def source_pdf_path(product_id: str) -> Path:
     return settings.storage_dir / "source" / f"{product_id}.pdf"
 
 
-def stamped_pdf_path(product_id: str, key: str) -> Path:
-    out_dir = settings.storage_dir / "stamped" / product_id
-    out_dir.mkdir(parents=True, exist_ok=True)
-    return out_dir / f"{key}.pdf"
+def logo_asset_path(product_id: str) -> Path:
+    """Pre-encoded brand image (one-page PDF) shared by every stamped copy."""
+    return settings.storage_dir / "source" / f"{product_id}.logo.pdf"
+
+
+def font_path(font_id: str) -> Path:
+    """Uploaded brand font, stored under its content hash and shared by products."""
+    return settings.storage_dir / "fonts" / f"{font_id}.ttf"
+
+
+def copy_key(email: str, sale_id: Optional[str] = None) -> str:
+    """File name stem of a buyer's stamped copy: the sanitized sale id, else email."""
+    val = sale_id if isinstance(sale_id, str) and sale_id else email
+    base = re.sub(r"[^A-Za-z0-9._-]", "_", val)[:120]
+    return base or hashlib.sha1(val.encode()).hexdigest()[:12]
+
+
+def stamped_pdf_path(product_id: str, key: str, root: Optional[Path] = None) -> Path:
+    """Where a buyer's copy lives: ``{root}/{product_id}/{shard}/{key}.pdf``.
+
+    Copies fan out over 256 hash-prefix directories per product, so a
+    bestseller's copies never pile up in one directory. ``root`` defaults to
+    STORAGE_DIR/stamped (the offline CLI writes the same layout elsewhere).
+    """
+    shard = hashlib.sha1(key.encode("utf-8")).hexdigest()[:2]
+    return (root or settings.storage_dir / "stamped") / product_id / shard / f"{key}.pdf"
+
+
+def base_pdf_path(product_id: str) -> Path:
+    """Source with the product's buyer-independent layers already applied."""
+    return settings.storage_dir / "source" / f"{product_id}.base.pdf"
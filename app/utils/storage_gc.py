@@ -0,0 +1,237 @@
+"""Incremental garbage collection of STORAGE_DIR.
+
+A single collector per node (elected with a dedicated lock, so only one of
+the preforked workers runs it) walks the stamped and source trees a little
+at a time: each slice stops after ``slice_ms`` milliseconds and the walk
+resumes where it left off on the next tick, so there is never a blocking
+full scan. It removes:
+
+- ``orphaned``: copies and base/logo assets of products whose source is gone
+- ``stale``: copies older than their product's source or config, which
+  would otherwise keep being served after a re-upload
+- ``temp``: half-written files (``*.tmp``, ``*.partial``, base builds) left
+  by crashed jobs, once they are older than ``temp_max_age``
+- ``evicted``: when disk usage is above ``disk_target_percent`` (below the
+  90% at which ``/health`` turns unhealthy), the least recently stamped
+  copies, which are re-stamped on their next download
+
+Copies are removed under the same per-copy lock ``render_copy`` takes, and
+skipped if it is busy; the collector's own memory tier forgets them too.
+"""
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from ..settings import settings
+from . import cache_index
+from .locks import LockTimeout, file_lock, try_named_lock
+from .memcache import get_memory_cache
+from .product_config import ProductConfigStore
+from .storage import source_pdf_path
+
+GC_REASONS = ("orphaned", "stale", "temp", "evicted")
+TEMP_SUFFIXES = (".tmp", ".partial", ".building.pdf")
+# Assets stored next to a product's source PDF
+SOURCE_ASSET_SUFFIXES = (".base.pdf", ".logo.pdf")
+# Copies evicted per query while disk usage is above target
+EVICT_BATCH = 100
+
+
+def _walk(root: Path) -> Iterator[os.DirEntry]:
+    """Files below ``root``, one directory listing at a time."""
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                listing = list(entries)
+        except OSError:
+            continue
+        for entry in listing:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(Path(entry.path))
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+class StorageCollector:
+    def __init__(self, slice_ms: float, interval: float, disk_target_percent: float, temp_max_age: float):
+        self.slice_seconds = slice_ms / 1000
+        self.interval = interval
+        self.disk_target_percent = disk_target_percent
+        self.temp_max_age = temp_max_age
+        self._walker: Optional[Iterator[os.DirEntry]] = None
+        self._pass_started = 0.0
+        self._lock = threading.Lock()
+        self._stats: Dict[str, object] = {
+            "leader": False,
+            "passes": 0,
+            "last_pass_seconds": None,
+            "removed": {reason: 0 for reason in GC_REASONS},
+            "reclaimed_bytes": {reason: 0 for reason in GC_REASONS},
+        }
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _new_walk(self) -> Iterator[os.DirEntry]:
+        self._pass_started = time.monotonic()
+        yield from _walk(settings.storage_dir / "stamped")
+        yield from _walk(settings.storage_dir / "source")
+
+    def _product_newest(self, product_id: str, cache: Dict[str, Optional[float]]) -> Optional[float]:
+        """Newest mtime of a product's source and config, None if it has no source."""
+        if product_id not in cache:
+            try:
+                newest = source_pdf_path(product_id).stat().st_mtime
+            except FileNotFoundError:
+                newest = None
+            if newest is not None:
+                try:
+                    newest = max(newest, ProductConfigStore.path(product_id).stat().st_mtime)
+                except FileNotFoundError:
+                    pass
+            cache[product_id] = newest
+        return cache[product_id]
+
+    def _verdict(self, entry: os.DirEntry, now: float, products: Dict[str, Optional[float]]) -> Optional[str]:
+        stat = entry.stat(follow_symlinks=False)
+        path = Path(entry.path)
+        if entry.name.endswith(TEMP_SUFFIXES):
+            return "temp" if now - stat.st_mtime > self.temp_max_age else None
+        if not entry.name.endswith(".pdf"):
+            return None
+        stamped_root = settings.storage_dir / "stamped"
+        if path.is_relative_to(stamped_root):
+            newest = self._product_newest(path.relative_to(stamped_root).parts[0], products)
+            if newest is None:
+                return "orphaned"
+            return "stale" if stat.st_mtime < newest else None
+        for suffix in SOURCE_ASSET_SUFFIXES:
+            if entry.name.endswith(suffix):
+                product_id = entry.name[: -len(suffix)]
+                return "orphaned" if self._product_newest(product_id, products) is None else None
+        return None
+
+    def _remove(self, path: Path, size: int, reason: str) -> bool:
+        try:
+            if reason == "temp":
+                path.unlink()
+            else:
+                with file_lock(str(path), timeout=0):
+                    path.unlink()
+        except (LockTimeout, FileNotFoundError):
+            return False
+        get_memory_cache().discard(path)
+        with self._lock:
+            self._stats["removed"][reason] += 1
+            self._stats["reclaimed_bytes"][reason] += size
+        from ..monitoring import BusinessMetrics
+
+        BusinessMetrics.track_gc_reclaimed(reason, size)
+        return True
+
+    def run_slice(self) -> None:
+        """Do at most ``slice_ms`` of collection work."""
+        deadline = time.monotonic() + self.slice_seconds
+        now = time.time()
+        products: Dict[str, Optional[float]] = {}
+        forgotten: List[Path] = []
+        if self._walker is None:
+            self._walker = self._new_walk()
+        while time.monotonic() < deadline:
+            entry = next(self._walker, None)
+            if entry is None:
+                with self._lock:
+                    self._stats["passes"] += 1
+                    self._stats["last_pass_seconds"] = round(time.monotonic() - self._pass_started, 3)
+                self._walker = None
+                break
+            try:
+                reason = self._verdict(entry, now, products)
+                if reason and self._remove(Path(entry.path), entry.stat(follow_symlinks=False).st_size, reason):
+                    forgotten.append(Path(entry.path))
+            except OSError:
+                continue
+
+        # Copies whose lock is busy stay indexed (they are still on disk) and
+        # are stepped over for the rest of this slice
+        busy = 0
+        while time.monotonic() < deadline and self.disk_percent() > self.disk_target_percent:
+            oldest = cache_index.oldest_stamped(EVICT_BATCH, offset=busy)
+            if not oldest:
+                break
+            evicted = []
+            for path, size in oldest:
+                if time.monotonic() >= deadline:
+                    break
+                if self._remove(path, size, "evicted") or not path.exists():
+                    evicted.append(path)
+                else:
+                    busy += 1
+            cache_index.forget_stamped(evicted)
+        if forgotten:
+            cache_index.forget_stamped(forgotten)
+
+    @staticmethod
+    def disk_percent() -> float:
+        usage = shutil.disk_usage(settings.storage_dir)
+        return usage.used / usage.total * 100 if usage.total else 0.0
+
+    def _run(self) -> None:
+        # One collector per node: the others keep trying in case it exits
+        fd = None
+        while not self._stop.is_set():
+            if fd is None:
+                fd = try_named_lock("storage-gc")
+                with self._lock:
+                    self._stats["leader"] = fd is not None
+            if fd is not None:
+                try:
+                    self.run_slice()
+                except Exception:
+                    # Never let the collector take the thread down
+                    self._walker = None
+            self._stop.wait(self.interval)
+        if fd is not None:
+            os.close(fd)
+
+    def start(self) -> None:
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="storage-gc", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats = {
+                **self._stats,
+                "removed": dict(self._stats["removed"]),
+                "reclaimed_bytes": dict(self._stats["reclaimed_bytes"]),
+            }
+        stats["disk_percent"] = round(self.disk_percent(), 2)
+        stats["disk_target_percent"] = self.disk_target_percent
+        return stats
+
+
+_collector: Optional[StorageCollector] = None
+_collector_pid: Optional[int] = None
+_collector_lock = threading.Lock()
+
+
+def get_collector() -> StorageCollector:
+    """The process-wide collector (recreated after a fork)."""
+    global _collector, _collector_pid
+    with _collector_lock:
+        if _collector is None or _collector_pid != os.getpid():
+            _collector = StorageCollector(
+                settings.gc_slice_ms,
+                settings.gc_interval_seconds,
+                settings.gc_disk_target_percent,
+                settings.gc_temp_max_age_seconds,
+            )
+            _collector_pid = os.getpid()
+        return _collector
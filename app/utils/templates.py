@@ -0,0 +1,55 @@
+"""Footer/diagonal text templates with per-buyer variables.
+
+Templates use ``str.format`` placeholder syntax (``{email}``; ``{{`` and ``}}``
+for literal braces). ``compile_template`` validates them once, when a product
+config is saved or loaded, and splits them into literal segments, so
+rendering for a buyer is a single join.
+"""
+from string import Formatter
+from typing import Mapping, Optional, Tuple
+
+# Variables available to templates. Missing values render as empty strings.
+TEMPLATE_VARIABLES = ("email", "date", "sale_id", "full_name", "price")
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class CompiledTemplate:
+    __slots__ = ("source", "_parts", "variables")
+
+    def __init__(self, source: str, parts: Tuple[Tuple[str, Optional[str]], ...]):
+        self.source = source
+        self._parts = parts
+        self.variables = frozenset(name for _, name in parts if name)
+
+    def render(self, values: Mapping[str, Optional[str]]) -> str:
+        out = []
+        for literal, name in self._parts:
+            out.append(literal)
+            if name:
+                out.append(values.get(name) or "")
+        return "".join(out)
+
+
+def compile_template(source: str) -> CompiledTemplate:
+    """Parse and validate ``source``; raises TemplateError for bad placeholders."""
+    parts = []
+    try:
+        parsed = list(Formatter().parse(source))
+    except ValueError as e:
+        raise TemplateError(f"Malformed template: {e}") from e
+    for literal, name, spec, conversion in parsed:
+        if name is not None:
+            if name not in TEMPLATE_VARIABLES:
+                allowed = ", ".join("{" + v + "}" for v in TEMPLATE_VARIABLES)
+                raise TemplateError(f"Unknown placeholder {{{name}}}; use {allowed}")
+            if spec or conversion:
+                raise TemplateError(f"Formatting options are not supported in {{{name}}}")
+        # Adjacent literals are merged so rendering touches as few parts as possible
+        if parts and parts[-1][1] is None:
+            parts[-1] = (parts[-1][0] + literal, name)
+        else:
+            parts.append((literal, name))
+    return CompiledTemplate(source, tuple(parts))
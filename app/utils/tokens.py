@@ -1,10 +1,20 @@
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from functools import lru_cache
 from typing import Optional, Dict, Any
 from ..settings import settings
+import hashlib
+import hmac
+import time
+
+
+@lru_cache(maxsize=4)
+def _serializer_for(secret_key: str) -> URLSafeTimedSerializer:
+    # Key derivation and signer setup are done once, not per token
+    return URLSafeTimedSerializer(secret_key=secret_key, salt="gumstamp")
 
 
 def _serializer() -> URLSafeTimedSerializer:
-    return URLSafeTimedSerializer(secret_key=settings.secret_key, salt="gumstamp")
+    return _serializer_for(settings.secret_key)
 
 
 def sign_token(data: Dict[str, Any]) -> str:
@@ -18,3 +28,37 @@ def verify_token(token: str, max_age: int = 60 * 60 * 24 * 14) -> Optional[Dict[
         return s.loads(token, max_age=max_age)
     except (BadSignature, SignatureExpired):
         return None
+
+
+# Optional sale fields carried in download tokens for footer templates
+SALE_DETAIL_FIELDS = ("full_name", "price", "date")
+
+
+def sale_details(
+    full_name: Optional[str] = None,
+    price_cents: Optional[int] = None,
+    currency: Optional[str] = None,
+    sold_at: Optional[str] = None,
+) -> Dict[str, str]:
+    """Template fields for a token payload.
+
+    ``price_cents`` is in the smallest currency unit, as Gumroad sends it.
+    ``sold_at`` is an ISO timestamp; the date defaults to today (UTC).
+    """
+    details = {"date": (sold_at or "")[:10] or time.strftime("%Y-%m-%d", time.gmtime())}
+    if full_name:
+        details["full_name"] = full_name[:120]
+    if price_cents is not None:
+        amount = f"{price_cents / 100:.2f}"
+        details["price"] = f"{amount} {currency.upper()}" if currency else amount
+    return details
+
+
+def buyer_fingerprint(product_id: str, email: str, sale_id: Optional[str] = None) -> str:
+    """Opaque, stable identifier for one buyer's copy of a product.
+
+    Keyed with the secret so it can be embedded in delivered files without
+    revealing the buyer's email.
+    """
+    msg = "\x1f".join([product_id, email, sale_id or ""]).encode("utf-8")
+    return hmac.new(settings.secret_key.encode("utf-8"), msg, hashlib.sha256).hexdigest()[:20]
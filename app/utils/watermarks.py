@@ -0,0 +1,62 @@
+"""Watermark settings shared by the creator routes and the PDF renderer.
+
+Kept free of pypdf/reportlab imports so routes can validate settings without
+loading the PDF stack (see app.startup).
+"""
+from pydantic import BaseModel, Field
+
+# "visible" merges footer/watermark overlays into every page; "metadata" only
+# writes the buyer fingerprint into document metadata (no page rewriting).
+STAMP_MODES = ("visible", "metadata")
+
+# Output profiles for visible stamps: "fast" writes streams as produced,
+# "balanced" flate-compresses uncompressed streams, "small" also uses maximum
+# compression and merges duplicate fonts, images and graphics states.
+OUTPUT_PROFILES = ("fast", "balanced", "small")
+DEFAULT_OUTPUT_PROFILE = "balanced"
+
+
+FOOTER_POSITIONS = ("bottom-left", "bottom-center", "bottom-right", "top-left", "top-center", "top-right")
+
+
+class FooterStyle(BaseModel):
+    """Placement and look of the per-buyer footer line."""
+
+    position: str = Field(default="bottom-right", pattern="^(" + "|".join(FOOTER_POSITIONS) + ")$")
+    font_size: float = Field(default=9.0, ge=4, le=72)
+    opacity: float = Field(default=0.8, gt=0, le=1)
+    margin: float = Field(default=24.0, ge=0, le=500)
+
+
+class DiagonalStyle(BaseModel):
+    """Look of the single centred diagonal text."""
+
+    font_size: float = Field(default=36.0, ge=4, le=200)
+    opacity: float = Field(default=0.15, gt=0, le=1)
+    angle: float = Field(default=45.0, ge=-360, le=360)
+
+
+class PatternSpec(BaseModel):
+    """Repeated diagonal text watermark, configured per product."""
+
+    text: str = Field(..., min_length=1, max_length=200)
+    spacing: float = Field(default=96.0, ge=0, le=1000, description="Gap between repetitions (pt)")
+    angle: float = Field(default=45.0, ge=-360, le=360, description="Rotation in degrees")
+    opacity: float = Field(default=0.12, gt=0, le=1)
+    font_size: float = Field(default=24.0, ge=4, le=200)
+
+
+LOGO_POSITIONS = ("center", "top-left", "top-right", "bottom-left", "bottom-right")
+
+
+class LogoSpec(BaseModel):
+    """Brand image watermark placement, configured per product.
+
+    The image itself is prepared once at upload (see pdf.build_logo_asset) and
+    stored next to the source PDF.
+    """
+
+    position: str = Field(default="center", pattern="^(" + "|".join(LOGO_POSITIONS) + ")$")
+    width: float = Field(default=160.0, gt=0, le=2000, description="Rendered width (pt)")
+    opacity: float = Field(default=0.2, gt=0, le=1)
+    margin: float = Field(default=24.0, ge=0, le=500)
@@ -0,0 +1,109 @@
+"""
+Stamping worker: ``python -m app.worker``.
+
+Pulls jobs from the queue configured by STAMP_QUEUE and renders buyer copies,
+so CPU-heavy stamping can run on different nodes from the API. Workers need
+the same SECRET_KEY and access to the same STORAGE_DIR (source files and
+stamped copies) as the web tier. Run one worker per core; SIGTERM lets the
+current job finish before exiting.
+"""
+import argparse
+import logging
+import signal
+import sqlite3
+import sys
+import time
+
+import structlog
+
+from . import startup
+from .monitoring import BusinessMetrics, init_backends, setup_logging
+from .stamping import run_job
+from .utils.jobqueue import QueueError, get_queue
+
+# Back-off after queue errors, doubling up to the maximum
+ERROR_BACKOFF_SECONDS = 1.0
+MAX_ERROR_BACKOFF_SECONDS = 30.0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.worker", description="Run a Gumstamp stamping worker")
+    parser.add_argument("--poll", type=float, default=5.0, help="seconds to wait for a job before checking for shutdown")
+    parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    setup_logging()
+    logger = structlog.get_logger("gumstamp.worker")
+    queue = get_queue()
+    if queue is None:
+        print("STAMP_QUEUE is not set; nothing to consume", file=sys.stderr)
+        return 2
+
+    init_backends()
+    startup.preload(startup.PDF_MODULES)
+
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    def _back_off(seconds: float) -> None:
+        # Sleep in short steps so SIGTERM still stops the worker promptly
+        until = time.monotonic() + seconds
+        while not stopping and time.monotonic() < until:
+            time.sleep(min(0.5, until - time.monotonic()))
+
+    logger.info("Worker started", queue=type(queue).__name__)
+    backoff = ERROR_BACKOFF_SECONDS
+    while not stopping:
+        try:
+            job = queue.claim(timeout=args.poll)
+        except (QueueError, sqlite3.OperationalError) as e:
+            logger.warning("Claiming a job failed", error=str(e), retry_in=backoff)
+            _back_off(backoff)
+            backoff = min(backoff * 2, MAX_ERROR_BACKOFF_SECONDS)
+            continue
+        backoff = ERROR_BACKOFF_SECONDS
+        if job is None:
+            if args.once:
+                break
+            continue
+        job_id, payload = job
+        result = run_job(payload)
+        try:
+            queue.finish(job_id, result)
+        except (QueueError, sqlite3.OperationalError) as e:
+            # The job stays leased and runs again once the lease expires
+            logger.warning("Recording a job result failed", job_id=job_id, error=str(e))
+            _back_off(backoff)
+            backoff = min(backoff * 2, MAX_ERROR_BACKOFF_SECONDS)
+            continue
+
+        if result.get("stamped"):
+            BusinessMetrics.track_pdf_processing(result["seconds"], True, "fingerprint" if result["mode"] == "metadata" else "stamp")
+            BusinessMetrics.track_stamp_output(result["output_bytes"], result["mode"], result["profile"])
+            if result.get("peak_rss_bytes"):
+                BusinessMetrics.track_stamp_memory(result["peak_rss_bytes"], True)
+        elif not result["ok"]:
+            BusinessMetrics.track_pdf_processing(0, False, "stamp")
+        logger.info(
+            "Job finished",
+            job_id=job_id,
+            product_id=payload.get("product_id"),
+            ok=result["ok"],
+            stamped=result.get("stamped", False),
+            error=result.get("error"),
+            stamp_seconds=result.get("seconds"),
+        )
+
+    logger.info("Worker stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,3 +10,9 @@ from pathlib import Path
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
+
+# Keep the state database, lock files and stamped copies out of the checkout
+import os
+import tempfile
+
+os.environ.setdefault("STORAGE_DIR", tempfile.mkdtemp(prefix="gumstamp-test-"))
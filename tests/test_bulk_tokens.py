@@ -0,0 +1,34 @@
+import csv
+import io
+from app.routes.creator import _bulk_tokens
+from app.utils.buyers import read_buyers
+from app.utils.tokens import verify_token
+
+
+def _result(data: bytes, product_id=None, prestamp=False):
+    return list(csv.DictReader(io.StringIO("".join(_bulk_tokens(read_buyers(data), product_id, prestamp)))))
+
+
+def test_csv_rows_get_tokens_and_errors_per_line():
+    rows = _result(b"email,sale_id,full_name\na@b.c,s1,Ann\nnot-an-email,s2,\nc@d.e,,\n", product_id="book")
+    assert [r["line"] for r in rows] == ["2", "3", "4"]
+    assert rows[1]["error"] == "Invalid email" and rows[1]["token"] == ""
+    payload = verify_token(rows[0]["token"])
+    assert payload["product_id"] == "book" and payload["sale_id"] == "s1" and payload["full_name"] == "Ann"
+    assert rows[2]["download_url"].endswith(rows[2]["token"])
+
+
+def test_ndjson_rows_may_name_their_own_product():
+    rows = _result(b'{"product_id": "a", "email": "x@y.z"}\n\nnot json\n{"email": "q@y.z"}\n')
+    assert [(r["line"], r["product_id"], r["error"]) for r in rows] == [
+        ("1", "a", ""),
+        ("3", "", "Invalid JSON"),
+        ("4", "", "Invalid row"),
+    ]
+
+
+def test_prestamp_outcome_is_reported_per_row():
+    assert _result(b"email\na@b.c\n", product_id="book")[0]["prestamped"] == ""
+    # No source uploaded: nothing to stamp ahead, the creator is told so
+    rows = _result(b"email\na@b.c\nnot-an-email\n", product_id="no-such-source", prestamp=True)
+    assert [r["prestamped"] for r in rows] == ["false", ""]
@@ -0,0 +1,80 @@
+import io
+from pypdf import PdfReader
+from reportlab.pdfgen import canvas
+from app.cli import main
+from app.utils.product_config import ProductConfig, product_configs
+from app.utils.storage import stamped_pdf_path
+from app.utils.watermarks import PatternSpec
+
+
+def _pdf(path):
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet)
+    can.drawString(100, 750, path.stem)
+    can.save()
+    path.write_bytes(packet.getvalue())
+
+
+def test_stamp_command_uses_pool_and_resumes(tmp_path, capsys):
+    sources = tmp_path / "src"
+    sources.mkdir()
+    for product_id in ("cli-a", "cli-b"):
+        _pdf(sources / f"{product_id}.pdf")
+    product_configs.put("cli-a", ProductConfig(footer_text="For {full_name}", pattern=PatternSpec(text="A")))
+    buyers = tmp_path / "buyers.csv"
+    buyers.write_text("product_id,email,sale_id,full_name\ncli-a,a@b.c,s1,Ann\n,b@b.c,,\nnope,c@b.c,,\n")
+    out = tmp_path / "out"
+
+    assert main(["stamp", str(sources), str(buyers), str(out), "--jobs", "2"]) == 1  # one rejected row
+    assert "Unknown product 'nope'" in capsys.readouterr().err
+    copies = sorted(f"{p.parts[-3]}/{p.name}" for p in out.glob("cli-*/*/*.pdf"))
+    assert copies == ["cli-a/b_b.c.pdf", "cli-a/s1.pdf", "cli-b/b_b.c.pdf"]
+    assert "For Ann" in PdfReader(str(stamped_pdf_path("cli-a", "s1", root=out))).pages[0].extract_text()
+
+    # A second run skips everything that already exists
+    main(["stamp", str(sources), str(buyers), str(out)])
+    assert "0 copies to stamp, 3 already present" in capsys.readouterr().err
+
+
+def test_trace_resolves_leaked_copy_from_metadata_or_content(tmp_path, capsys):
+    import json
+    from pypdf import PdfWriter
+    from app.stamping import render_copy
+    from app.utils.storage import source_pdf_path
+
+    source = source_pdf_path("cli-trace")
+    source.parent.mkdir(parents=True, exist_ok=True)
+    _pdf(source)
+    for mode in ("visible", "metadata"):
+        product_configs.put("cli-trace", ProductConfig(mode=mode, marker=True))
+        out = stamped_pdf_path("cli-trace", mode)
+        render_copy(source, out, "cli-trace", f"{mode}@example.com", sale_id=mode)
+        assert main(["trace", str(out)]) == 0
+        found = json.loads(capsys.readouterr().out)
+        assert found["found_in"] == "metadata" and found["copies"][0]["email"] == f"{mode}@example.com"
+
+    # Re-saved without metadata: the visible footer still identifies the buyer
+    stripped = tmp_path / "stripped.pdf"
+    writer = PdfWriter()
+    writer.append(str(stamped_pdf_path("cli-trace", "visible")))
+    writer.write(str(stripped))
+    assert main(["trace", str(stripped)]) == 0
+    found = json.loads(capsys.readouterr().out)
+    assert found["fingerprint"] is None and found["found_in"] == "content"
+    assert found["copies"][0]["sale_id"] == "visible"
+
+
+def test_migrate_stamped_moves_flat_copies_into_shards(capsys):
+    from app.settings import settings
+    from app.utils import cache_index
+
+    legacy = settings.storage_dir / "stamped" / "cli-migrate" / "buyer_x.com.pdf"
+    legacy.parent.mkdir(parents=True, exist_ok=True)
+    _pdf(legacy)
+    cache_index.record_stamped(legacy, "cli-migrate", legacy.stat().st_size, 0.0)
+
+    assert main(["migrate-stamped"]) == 0
+    new = stamped_pdf_path("cli-migrate", "buyer_x.com")
+    assert new.exists() and not legacy.exists()
+    assert cache_index.lookup_stamped(new) is not None and cache_index.lookup_stamped(legacy) is None
+    assert "Moved 1 copies" in capsys.readouterr().err
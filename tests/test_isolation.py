@@ -0,0 +1,31 @@
+from pathlib import Path
+import time
+import pytest
+from app.utils import isolation
+from app.utils.deadline import StampTimeout
+from app.utils.isolation import MemoryLimitExceeded, run_isolated
+
+
+def _allocate(megabytes: int) -> int:
+    return len(bytearray(megabytes * 1024 * 1024))
+
+
+def test_run_isolated_reports_peak_rss():
+    value, peak = run_isolated(_allocate, 8)
+    assert value == 8 * 1024 * 1024
+    assert peak > 8 * 1024 * 1024
+
+
+def test_run_isolated_enforces_memory_limit():
+    with pytest.raises(MemoryLimitExceeded):
+        run_isolated(_allocate, 256, memory_limit=32 * 1024 * 1024)
+
+
+def test_run_isolated_kills_hung_jobs(monkeypatch):
+    monkeypatch.setattr(isolation, "KILL_GRACE_SECONDS", 0.1)
+    start = time.monotonic()
+    # Sleeping never reaches a deadline check, so only the kill stops it
+    with pytest.raises(StampTimeout) as info:
+        run_isolated(time.sleep, 30, timeout=0.2)
+    assert info.value.killed
+    assert time.monotonic() - start < 10
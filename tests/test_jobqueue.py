@@ -0,0 +1,165 @@
+import socketserver
+import threading
+import pytest
+from app.utils.jobqueue import RespJobQueue, SqliteJobQueue
+
+
+def test_sqlite_queue_dedupes_and_round_trips(tmp_path):
+    queue = SqliteJobQueue()
+    job_id = f"job-{tmp_path.name}"
+    queue.enqueue(job_id, {"n": 1})
+    queue.enqueue(job_id, {"n": 1})
+
+    claimed = []
+    while (job := queue.claim(timeout=0)) is not None:
+        claimed.append(job)
+    assert claimed.count((job_id, {"n": 1})) == 1
+
+    assert queue.result(job_id) is None
+    queue.finish(job_id, {"ok": True})
+    assert queue.wait(job_id, timeout=1) == {"ok": True}
+
+    # A finished job can be queued again (e.g. after its output was removed)
+    queue.enqueue(job_id, {"n": 2})
+    assert queue.result(job_id) is None
+    assert queue.claim(timeout=0) == (job_id, {"n": 2})
+
+
+class _RespStandIn(socketserver.StreamRequestHandler):
+    """Just enough of the Redis protocol for RespJobQueue."""
+
+    store: dict = {}
+
+    def _reply(self, value):
+        if value is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(value, int):
+            self.wfile.write(b":%d\r\n" % value)
+        elif isinstance(value, list):
+            self.wfile.write(b"*%d\r\n" % len(value))
+            for item in value:
+                self.wfile.write(b"$%d\r\n%s\r\n" % (len(item), item))
+        elif value == "OK":
+            self.wfile.write(b"+OK\r\n")
+        else:
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+
+    def handle(self):
+        store = self.store
+        while line := self.rfile.readline():
+            args = []
+            for _ in range(int(line[1:])):
+                size = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(size + 2)[:-2])
+            cmd = args[0].upper()
+            if cmd == b"SET":
+                if b"NX" in args and args[1] in store:
+                    self._reply(None)
+                    continue
+                store[args[1]] = args[2]
+                self._reply("OK")
+            elif cmd == b"GET":
+                self._reply(store.get(args[1]))
+            elif cmd == b"DEL":
+                self._reply(int(store.pop(args[1], None) is not None))
+            elif cmd == b"LPUSH":
+                store.setdefault(args[1], []).insert(0, args[2])
+                self._reply(len(store[args[1]]))
+            elif cmd == b"RPUSH":
+                store.setdefault(args[1], []).append(args[2])
+                self._reply(len(store[args[1]]))
+            elif cmd == b"LTRIM":
+                store[args[1]] = store.get(args[1], [])[int(args[2]) : int(args[3]) + 1]
+                self._reply("OK")
+            elif cmd == b"LREM":
+                items = store.get(args[1], [])
+                store[args[1]] = [item for item in items if item != args[3]]
+                self._reply(len(items) - len(store[args[1]]))
+            elif cmd == b"RPOPLPUSH":
+                items = store.get(args[1])
+                item = items.pop() if items else None
+                if item is not None:
+                    store.setdefault(args[2], []).insert(0, item)
+                self._reply(item)
+            elif cmd == b"ZADD":
+                store.setdefault(args[1], {})[args[3]] = float(args[2])
+                self._reply(1)
+            elif cmd == b"ZREM":
+                self._reply(int(store.get(args[1], {}).pop(args[2], None) is not None))
+            elif cmd == b"ZRANGEBYSCORE":
+                scores = store.get(args[1], {})
+                self._reply(sorted((m for m, score in scores.items() if score <= float(args[3])), key=scores.get))
+            elif cmd == b"LINDEX":
+                items = store.get(args[1])
+                self._reply(items[int(args[2])] if items else None)
+            elif cmd == b"RPOP":
+                items = store.get(args[1])
+                self._reply(items.pop() if items else None)
+            elif cmd == b"BRPOP":
+                key = next((k for k in args[1:-1] if store.get(k)), None)
+                self._reply([key, store[key].pop()] if key else None)
+
+
+@pytest.fixture
+def resp_server():
+    _RespStandIn.store = {}
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _RespStandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"redis://127.0.0.1:{server.server_address[1]}/0"
+    server.shutdown()
+    server.server_close()
+
+
+def test_resp_queue_round_trip(resp_server):
+    queue = RespJobQueue(resp_server)
+    queue.enqueue("a", {"n": 1})
+    queue.enqueue("a", {"n": 1})
+    assert queue.claim(timeout=1) == ("a", {"n": 1})
+    assert queue.claim(timeout=1) is None
+
+    queue.finish("a", {"ok": True, "stamped": True})
+    assert queue.wait("a", timeout=1) == {"ok": True, "stamped": True}
+
+
+def test_resp_queue_claims_by_priority_and_promotes(resp_server):
+    queue = RespJobQueue(resp_server)
+    queue.enqueue("bulk", {}, "bulk")
+    queue.enqueue("late", {}, "bulk")
+    queue.enqueue("buyer", {}, "interactive")
+    # A buyer now waiting on a backfilled copy promotes it
+    queue.enqueue("late", {}, "interactive")
+    assert [queue.claim(timeout=1)[0] for _ in range(3)] == ["buyer", "late", "bulk"]
+
+
+def test_resp_queue_requeues_jobs_of_expired_leases(resp_server):
+    dead = RespJobQueue(resp_server)
+    dead.enqueue("a", {"n": 1})
+    assert dead.claim(timeout=1) == ("a", {"n": 1})
+    # Retries are ignored while the job is leased
+    dead.enqueue("a", {"n": 1})
+    other = RespJobQueue(resp_server)
+    other._conn()
+    other._local.worker = "other"
+    assert other.claim(timeout=1) is None
+
+    # The first worker died: its lease runs out
+    leases = _RespStandIn.store[b"gumstamp:leases"]
+    leases.update(dict.fromkeys(leases, 0.0))
+    assert other.claim(timeout=1) == ("a", {"n": 1})
+    other.finish("a", {"ok": True})
+    assert _RespStandIn.store[b"gumstamp:leases"] == {}
+    assert not _RespStandIn.store[b"gumstamp:processing:other"]
+
+
+def test_sqlite_queue_claims_by_priority_and_promotes(tmp_path):
+    queue = SqliteJobQueue()
+    while queue.claim(timeout=0) is not None:
+        pass
+    queue.enqueue(f"bulk-{tmp_path.name}", {}, "bulk")
+    queue.enqueue(f"late-{tmp_path.name}", {}, "bulk")
+    queue.enqueue(f"buyer-{tmp_path.name}", {}, "interactive")
+    queue.enqueue(f"late-{tmp_path.name}", {}, "interactive")
+    claimed = [queue.claim(timeout=0)[0].split("-")[0] for _ in range(3)]
+    # The promoted job keeps its original place in line
+    assert claimed == ["late", "buyer", "bulk"]
@@ -0,0 +1,34 @@
+import time
+from app.utils.memcache import MemoryCache
+from app.utils.storage import stamped_pdf_path
+
+
+def test_lru_eviction_within_byte_budget():
+    cache = MemoryCache(max_bytes=100, max_item_bytes=60, ttl=60)
+    a, b, c = (stamped_pdf_path("mem", key) for key in "abc")
+    cache.put(a, b"a" * 40, [])
+    cache.put(b, b"b" * 40, [])
+    assert cache.get(a).body == b"a" * 40  # a is now most recently used
+    cache.put(c, b"c" * 40, [])
+    assert cache.get(b) is None and cache.get(c) is not None
+    cache.put(stamped_pdf_path("mem", "big"), b"x" * 61, [])  # above the item limit
+
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["bytes"] == 80
+    assert stats["evictions"] == 1 and stats["hits"] == 2 and stats["misses"] == 1
+    assert stats["hit_rate"] == round(2 / 3, 4)
+
+
+def test_entries_expire_and_are_discarded_per_product():
+    cache = MemoryCache(max_bytes=1000, max_item_bytes=1000, ttl=0.05)
+    cache.put(stamped_pdf_path("mem-a", "buyer"), b"x", [])
+    time.sleep(0.1)
+    assert cache.get(stamped_pdf_path("mem-a", "buyer")) is None
+    assert cache.stats()["expired"] == 1
+
+    cache.ttl = 60
+    cache.put(stamped_pdf_path("mem-a", "buyer"), b"x", [])
+    cache.put(stamped_pdf_path("mem-ab", "buyer"), b"y", [])
+    cache.discard_product("mem-a")
+    assert cache.get(stamped_pdf_path("mem-a", "buyer")) is None
+    assert cache.get(stamped_pdf_path("mem-ab", "buyer")) is not None
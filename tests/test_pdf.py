@@ -21,3 +21,198 @@ def test_stamp_pdf(tmp_path: Path):
     stamp_pdf(inp, out, footer_text="Purchased by test@example.com", diagonal_text="TEST")
     assert out.exists()
     assert out.stat().st_size > 0
+
+
+def test_stamp_pdf_pattern_cost_independent_of_density(tmp_path: Path):
+    from app.utils.watermarks import PatternSpec
+
+    inp = _make_pdf(tmp_path)
+    sizes = []
+    for spacing in (4, 400):
+        out = tmp_path / f"pattern_{spacing}.pdf"
+        stamp_pdf(inp, out, footer_text=None, diagonal_text=None,
+                  pattern=PatternSpec(text="CONFIDENTIAL", spacing=spacing))
+        sizes.append(out.stat().st_size)
+    assert abs(sizes[0] - sizes[1]) < 16
+
+
+def test_stamp_pdf_logo_embedded_once(tmp_path: Path):
+    from PIL import Image
+    from pypdf import PdfReader
+    from app.utils.pdf import build_logo_asset
+    from app.utils.watermarks import LogoSpec
+
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet)
+    for _ in range(5):
+        can.drawString(100, 750, "Page")
+        can.showPage()
+    can.save()
+    inp = tmp_path / "multi.pdf"
+    inp.write_bytes(packet.getvalue())
+
+    img = io.BytesIO()
+    Image.new("RGBA", (64, 32), (200, 0, 0, 128)).save(img, "PNG")
+    asset = tmp_path / "logo.pdf"
+    build_logo_asset(img.getvalue(), asset)
+
+    out = tmp_path / "out.pdf"
+    stamp_pdf(inp, out, footer_text=None, diagonal_text=None,
+              logo=LogoSpec(position="top-right"), logo_asset=asset)
+    refs = {
+        xobjects.raw_get(name).idnum
+        for xobjects in (page["/Resources"]["/XObject"] for page in PdfReader(str(out)).pages)
+        for name in xobjects
+        if name.startswith("/GSLogo")
+    }
+    assert len(refs) == 1
+
+
+def test_stamp_pdf_custom_font_registered_once(tmp_path: Path):
+    import reportlab
+    from app.utils.pdf import register_font
+
+    font = Path(reportlab.__file__).parent / "fonts" / "Vera.ttf"
+    assert register_font(font) == register_font(font)
+
+    inp = _make_pdf(tmp_path)
+    out = tmp_path / "out.pdf"
+    stamp_pdf(inp, out, footer_text="Purchased by test@example.com", diagonal_text=None, font=font)
+    # Only the glyphs of the stamp text are embedded, not the whole font file
+    assert out.stat().st_size < font.stat().st_size
+
+
+def test_fingerprint_pdf_metadata_only(tmp_path: Path):
+    from pypdf import PdfReader
+    from app.utils.pdf import fingerprint_pdf
+
+    inp = _make_pdf(tmp_path)
+    out = tmp_path / "fp.pdf"
+    fingerprint_pdf(inp, out, "fp-123", marker=True)
+
+    # Original bytes are preserved; only an incremental update is appended
+    assert out.read_bytes().startswith(inp.read_bytes())
+    reader = PdfReader(str(out))
+    assert reader.metadata["/GumstampFingerprint"] == "fp-123"
+    assert reader.trailer["/Root"]["/GumstampMarker"]["/Fingerprint"] == "fp-123"
+    assert b"fp-123" in reader.trailer["/Root"]["/Metadata"].get_object().get_data()
+    assert reader.pages[0].extract_text().strip() == "Hello PDF"
+
+
+def _make_xref_stream_pdf(tmp_path: Path) -> Path:
+    """A one-page PDF whose cross-reference section is an XRef stream, as pdfTeX writes."""
+    content = b"BT /F1 12 Tf 100 750 Td (Hello PDF) Tj ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R"
+        b" /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = io.BytesIO()
+    out.write(b"%PDF-1.5\n")
+    offsets = []
+    for num, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (num, body))
+    xref_at = out.tell()
+    offsets.append(xref_at)
+    rows = b"\x00\x00\x00\x00\xff\xff" + b"".join(b"\x01" + o.to_bytes(4, "big") + b"\x00" for o in offsets)
+    out.write(b"6 0 obj\n<< /Type /XRef /Size 7 /W [1 4 1] /Root 1 0 R"
+              b" /ID [<00112233445566778899aabbccddeeff> <00112233445566778899aabbccddeeff>]"
+              b" /Length %d >>\nstream\n%s\nendstream\nendobj\n" % (len(rows), rows))
+    out.write(b"startxref\n%d\n%%%%EOF\n" % xref_at)
+    p = tmp_path / "xref_stream.pdf"
+    p.write_bytes(out.getvalue())
+    return p
+
+
+def test_fingerprint_pdf_keeps_xref_kind_and_document_id(tmp_path: Path):
+    from pypdf import PdfReader
+    from app.utils.pdf import fingerprint_pdf
+
+    for inp in (_make_pdf(tmp_path), _make_xref_stream_pdf(tmp_path)):
+        out = tmp_path / "fp.pdf"
+        fingerprint_pdf(inp, out, "fp-123")
+        source_id = PdfReader(str(inp)).trailer["/ID"]
+        reader = PdfReader(str(out), strict=True)
+        assert reader.metadata["/GumstampFingerprint"] == "fp-123"
+        assert reader.pages[0].extract_text().strip() == "Hello PDF"
+        # Same document, new revision
+        assert reader.trailer["/ID"][0] == source_id[0]
+        assert reader.trailer["/ID"][1] != source_id[1]
+        update = out.read_bytes()[inp.stat().st_size:]
+        assert (b"/Type /XRef" in update) == (inp.name == "xref_stream.pdf")
+
+
+def test_stamp_pdf_output_profiles(tmp_path: Path):
+    inp = _make_pdf(tmp_path)
+    results = {}
+    for profile in ("fast", "small"):
+        out = tmp_path / f"{profile}.pdf"
+        results[profile] = stamp_pdf(inp, out, footer_text="Purchased by test@example.com",
+                                     diagonal_text="TEST", profile=profile)
+        assert results[profile].output_bytes == out.stat().st_size
+    assert results["small"].output_bytes < results["fast"].output_bytes
+
+
+def test_stamp_pdf_streaming_matches_pages(tmp_path: Path):
+    from pypdf import PdfReader
+    from app.utils.pdf import stamp_pdf_streaming
+
+    inp = _make_pdf(tmp_path)
+    out = tmp_path / "streamed.pdf"
+    result = stamp_pdf_streaming(inp, out, footer_text="Purchased by test@example.com",
+                                 diagonal_text="TEST", fingerprint="fp-1")
+    reader = PdfReader(str(out))
+    assert result.pages == len(reader.pages) == 1
+    assert "Purchased by test@example.com" in reader.pages[0].extract_text()
+    assert reader.metadata["/GumstampFingerprint"] == "fp-1"
+
+
+def test_stamp_pdf_footer_position(tmp_path: Path):
+    from pypdf import PdfReader
+    from app.utils.watermarks import FooterStyle
+
+    inp = _make_pdf(tmp_path)
+    positions = {}
+    for position in ("top-left", "bottom-right"):
+        out = tmp_path / f"{position}.pdf"
+        stamp_pdf(inp, out, footer_text="Buyer", diagonal_text=None,
+                  footer_style=FooterStyle(position=position, font_size=12))
+        found = []
+        PdfReader(str(out)).pages[0].extract_text(
+            visitor_text=lambda text, cm, tm, font, size: found.append((tm[4], tm[5])) if "Buyer" in text else None
+        )
+        positions[position] = found[0]
+    assert positions["top-left"][1] > 700 and positions["top-left"][0] < 50
+    assert positions["bottom-right"][1] < 50 and positions["bottom-right"][0] > 400
+
+
+def test_stamping_stops_between_pages_at_the_deadline(tmp_path: Path):
+    import pytest
+    from app.utils.deadline import StampTimeout, stamp_deadline
+    from app.utils.pdf import stamp_pdf_streaming
+
+    inp = _make_pdf(tmp_path)
+    for stamp in (stamp_pdf, stamp_pdf_streaming):
+        out = tmp_path / f"{stamp.__name__}.pdf"
+        with stamp_deadline(1e-9), pytest.raises(StampTimeout):
+            stamp(inp, out, footer_text="Purchased by test@example.com", diagonal_text=None)
+        assert not out.exists() and not out.with_suffix(".pdf.tmp").exists()
+
+
+def test_pypdf_internals_match_pinned_release():
+    # app.utils.pdf reaches into PdfWriter internals that pypdf has no public
+    # API for. After a pypdf upgrade, check _add_object/_writer_objects (and
+    # PdfWriter.compress_identical_objects) before bumping the version here.
+    import pypdf
+    from pypdf import PdfWriter
+    from app.utils.pdf import PYPDF_INTERNALS_VERSION, _add_object, _writer_objects
+    from pypdf.generic import NumberObject
+
+    assert pypdf.__version__.startswith(PYPDF_INTERNALS_VERSION + ".")
+    writer = PdfWriter()
+    ref = _add_object(writer, NumberObject(7))
+    assert _writer_objects(writer)[ref.idnum - 1] == 7
@@ -0,0 +1,43 @@
+import json
+import os
+import pytest
+from app.utils.product_config import ProductConfig, ProductConfigError, ProductConfigStore
+from app.utils.watermarks import FooterStyle
+
+
+def test_missing_config_uses_defaults():
+    cfg = ProductConfigStore().get("no-such-product")
+    assert cfg.mode == "visible"
+    assert cfg.footer_for({"email": "a@b.c"}) == "Purchased by a@b.c"
+
+
+def test_write_through_and_mtime_invalidation():
+    store = ProductConfigStore(recheck_seconds=0)
+    store.put("cfg-a", ProductConfig(footer_text="For {email}", footer=FooterStyle(position="top-center")))
+    cfg = store.get("cfg-a")
+    assert cfg.footer.position == "top-center"
+    assert cfg.footer_for({"email": "a@b.c"}) == "For a@b.c"
+
+    # Another process rewrites the file: picked up by mtime
+    path = store.path("cfg-a")
+    path.write_text(json.dumps({"footer_text": "Copy of {email}", "mode": "metadata"}))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert store.get("cfg-a").mode == "metadata"
+
+
+def test_legacy_config_files_still_load():
+    store = ProductConfigStore()
+    store.path("cfg-legacy").write_text(json.dumps({
+        "footer_text": "Purchased by {email}", "mode": "visible", "marker": False, "profile": "small",
+        "pattern": {"text": "X", "spacing": 96, "angle": 45, "opacity": 0.12, "font_size": 24},
+    }))
+    cfg = store.get("cfg-legacy")
+    assert cfg.profile == "small" and cfg.pattern.text == "X"
+
+
+def test_invalid_config_raises_instead_of_falling_back():
+    store = ProductConfigStore()
+    store.path("cfg-bad").write_text(json.dumps({"mode": "loud"}))
+    with pytest.raises(ProductConfigError):
+        store.get("cfg-bad")
@@ -0,0 +1,34 @@
+import time
+import pytest
+from app.utils.ratelimit import RateLimiter, parse_limits
+
+
+def test_bucket_allows_burst_then_rejects_until_refilled():
+    limiter = RateLimiter(3, 0.3)
+    assert [limiter.hit("ip") for _ in range(3)] == [0.0, 0.0, 0.0]
+    retry_after = limiter.hit("ip")
+    assert 0 < retry_after <= 0.1
+    # Other keys have their own budget
+    assert limiter.hit("other") == 0.0
+    time.sleep(retry_after + 0.01)
+    assert limiter.hit("ip") == 0.0
+
+
+def test_tracked_keys_are_bounded():
+    limiter = RateLimiter(1, 60, max_keys=10)
+    for i in range(100):
+        limiter.hit(f"key-{i}")
+    assert len(limiter._buckets) == 10
+
+
+def test_parse_limits_overrides_and_disables():
+    limits = parse_limits("download.ip=30/10, download.product=0, ping.ip=600/60")
+    assert limits["download.ip"] == (30, 10.0)
+    assert limits["download.product"] is None
+    assert limits["ping.ip"] == (600, 60.0)
+    # Gumroad pings are deduplicated rather than limited by default
+    assert limits["ping.product"] is None
+    assert limits["download.token"] == (20, 60.0)
+    assert all(v is None for v in parse_limits("off").values())
+    with pytest.raises(ValueError):
+        parse_limits("upload.ip=1/1")
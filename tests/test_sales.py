@@ -0,0 +1,34 @@
+from app.utils.db import connect
+from app.utils.sales import SaleLog
+from app.utils.tokens import verify_token
+
+
+def _count(sale_id: str) -> int:
+    return connect().execute("SELECT COUNT(*) FROM sales WHERE sale_id = ?", (sale_id,)).fetchone()[0]
+
+
+def test_retries_get_the_same_token_and_are_written_once():
+    log = SaleLog(batch_size=50, flush_seconds=60)
+    token, duplicate = log.ingest("sale-1", "prod", "a@b.c", {"full_name": "Ann"})
+    assert not duplicate
+    assert verify_token(token)["full_name"] == "Ann"
+    assert log.ingest("sale-1", "prod", "a@b.c", {}) == (token, True)
+    assert _count("sale-1") == 0  # acknowledged before it was written
+
+    assert [sale["sale_id"] for sale in log.flush()] == ["sale-1"]
+    assert _count("sale-1") == 1
+    log.close()
+    assert log.stats()["duplicate"] == 1
+
+
+def test_other_workers_see_written_sales_and_never_double_insert():
+    first, second = SaleLog(batch_size=50, flush_seconds=60), SaleLog(batch_size=50, flush_seconds=60)
+    token, _ = first.ingest("sale-2", "prod", "a@b.c", {})
+    # Both workers received the sale before either flushed
+    second.ingest("sale-2", "prod", "a@b.c", {})
+    assert len(first.flush()) == 1
+    assert second.flush() == []
+    assert _count("sale-2") == 1
+
+    # A later retry on a fresh worker is answered from the persistent index
+    assert SaleLog(batch_size=50, flush_seconds=60).ingest("sale-2", "prod", "a@b.c", {}) == (token, True)
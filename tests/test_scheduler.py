@@ -0,0 +1,90 @@
+import threading
+import time
+import pytest
+from app.utils.scheduler import QueueFull, StampScheduler, parse_caps, parse_weights
+
+
+def test_parse_caps_defaults_and_overrides():
+    assert parse_caps("", 8) == {"interactive": 8, "prewarm": 4, "bulk": 2}
+    assert parse_caps("bulk=3", 8)["bulk"] == 3
+    with pytest.raises(ValueError):
+        parse_caps("urgent=1", 8)
+
+
+def test_interactive_work_is_not_queued_behind_bulk():
+    scheduler = StampScheduler(2, {"interactive": 2, "prewarm": 1, "bulk": 1}, aging_seconds=60)
+    release = threading.Event()
+    bulk = [scheduler.submit(release.wait, priority="bulk") for _ in range(50)]
+
+    # Bulk holds at most its cap, so a slot stays free for buyers
+    start = time.monotonic()
+    assert scheduler.submit(lambda: "ok", priority="interactive").result(timeout=2) == "ok"
+    assert time.monotonic() - start < 1
+
+    stats = scheduler.stats()["classes"]
+    assert stats["bulk"]["running"] == 1 and stats["bulk"]["queued"] == 49
+    release.set()
+    for f in bulk:
+        f.result(timeout=5)
+
+
+def test_aging_lets_old_low_priority_jobs_overtake():
+    scheduler = StampScheduler(1, {"interactive": 1, "prewarm": 1, "bulk": 1}, aging_seconds=0.05)
+    gate = threading.Event()
+    order = []
+    blocker = scheduler.submit(gate.wait, priority="interactive")
+    scheduler.submit(order.append, "bulk", priority="bulk")
+    time.sleep(0.2)  # the bulk job has now aged past two classes
+    last = scheduler.submit(order.append, "interactive", priority="interactive")
+    gate.set()
+    blocker.result(timeout=2)
+    last.result(timeout=2)
+    assert order == ["bulk", "interactive"]
+
+
+def _drain_order(scheduler, submissions):
+    """Run ``(tenant, label)`` submissions queued behind a blocker; returns labels in run order."""
+    gate = threading.Event()
+    order = []
+    blocker = scheduler.submit(gate.wait)
+    jobs = [scheduler.submit(order.append, label, tenant=tenant) for tenant, label in submissions]
+    gate.set()
+    blocker.result(timeout=2)
+    for job in jobs:
+        job.result(timeout=2)
+    return order
+
+
+def test_products_take_turns_by_weight():
+    caps = {"interactive": 1, "prewarm": 1, "bulk": 1}
+    # A backlog from one product does not delay another product's single job
+    order = _drain_order(StampScheduler(1, caps, 60), [("big", "big")] * 20 + [("small", "small")])
+    assert order.index("small") <= 1
+
+    weighted = StampScheduler(1, caps, 60, tenant_weights=parse_weights("heavy=2"))
+    order = _drain_order(weighted, [("light", "light")] * 6 + [("heavy", "heavy")] * 6)
+    assert order[:6].count("heavy") == 4
+    with pytest.raises(ValueError):
+        parse_weights("x=0")
+
+
+def test_per_product_quotas():
+    scheduler = StampScheduler(
+        2, {"interactive": 2, "prewarm": 1, "bulk": 1}, 60, tenant_max_running=1, tenant_max_queued=2
+    )
+    release, started = threading.Event(), threading.Event()
+    jobs = [scheduler.submit(lambda: started.set() or release.wait(), tenant="hot")]
+    assert started.wait(timeout=2)
+    jobs += [scheduler.submit(release.wait, tenant="hot") for _ in range(2)]
+    with pytest.raises(QueueFull):
+        scheduler.submit(release.wait, tenant="hot")
+    # Queue quotas are per class, and other products still get the free slot
+    jobs.append(scheduler.submit(release.wait, priority="bulk", tenant="hot"))
+    assert scheduler.submit(lambda: "ok", tenant="cold").result(timeout=2) == "ok"
+
+    stats = scheduler.stats()
+    assert stats["tenants"]["hot"]["running"] == 1 and stats["tenants"]["hot"]["queued"] == 3
+    assert stats["tenants"]["hot"]["rejected"] == 1 and stats["quota_rejected"] == 1
+    release.set()
+    for job in jobs:
+        job.result(timeout=5)
@@ -0,0 +1,37 @@
+import asyncio
+from app.settings import settings
+from app.utils.sendfile import StampedFileResponse
+
+
+def _serve(response, method="GET"):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response({"type": "http", "method": method, "extensions": {}}, None, send))
+    return messages
+
+
+def _stamped_file(name: str, data: bytes):
+    path = settings.storage_dir / "stamped" / "prod" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def test_serves_small_files_in_one_body_message():
+    path = _stamped_file("a.pdf", b"%PDF-1.4 test")
+    start, body = _serve(StampedFileResponse(path, path.stat(), filename=path.name))
+    assert (b"content-length", b"13") in start["headers"]
+    assert body["body"] == b"%PDF-1.4 test" and not body["more_body"]
+
+
+def test_offloads_to_proxy_when_configured(monkeypatch):
+    monkeypatch.setattr(settings, "sendfile_header", "X-Accel-Redirect")
+    path = _stamped_file("b c.pdf", b"%PDF-1.4 test")
+    start, body = _serve(StampedFileResponse(path, path.stat(), filename=path.name))
+    headers = dict(start["headers"])
+    assert headers[b"x-accel-redirect"] == b"/_stamped/prod/b%20c.pdf"
+    assert b"content-length" not in headers
+    assert body["body"] == b""
@@ -0,0 +1,21 @@
+import asyncio
+from app.serve import ForwardedFor
+
+
+def _client(trusted: str, peer: str, forwarded: str):
+    seen = {}
+
+    async def app(scope, receive, send):
+        seen.update(scope)
+
+    scope = {"type": "http", "client": (peer, 5000), "headers": [(b"x-forwarded-for", forwarded.encode())]}
+    asyncio.run(ForwardedFor(app, trusted)(scope, None, None))
+    return seen["client"][0]
+
+
+def test_client_cannot_pick_its_own_forwarded_address():
+    # The proxy appends the address it saw; the spoofed entry is ignored
+    assert _client("*", "10.1.2.3", "1.2.3.4, 203.0.113.9") == "203.0.113.9"
+    assert _client("10.0.0.0/8", "10.1.2.3", "1.2.3.4, 203.0.113.9, 10.4.5.6") == "203.0.113.9"
+    # Untrusted peers are taken as they connected
+    assert _client("127.0.0.1", "198.51.100.7", "1.2.3.4") == "198.51.100.7"
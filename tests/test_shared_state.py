@@ -0,0 +1,31 @@
+import pytest
+from app.utils import cache_index, gumroad
+from app.utils.locks import LockTimeout, file_lock
+
+
+def test_file_lock_excludes_other_holders():
+    with file_lock("stamped/p/a.pdf"):
+        # flock locks belong to the open file, so a second open conflicts
+        # just as a lock held by another worker process would
+        with pytest.raises(LockTimeout):
+            with file_lock("stamped/p/a.pdf", timeout=0.1):
+                pass
+    with file_lock("stamped/p/a.pdf", timeout=0.1):
+        pass
+
+
+def test_stamped_index_round_trip(tmp_path):
+    path = tmp_path / "copy.pdf"
+    cache_index.record_stamped(path, "prod", 1234, 1.5)
+    entry = cache_index.lookup_stamped(path)
+    assert entry["product_id"] == "prod" and entry["size"] == 1234
+    assert cache_index.stamped_totals()["files"] >= 1
+
+
+def test_license_cache_skips_repeat_verification(monkeypatch, tmp_path):
+    calls = []
+    monkeypatch.setattr(gumroad, "verify_license", lambda key, permalink: calls.append(key) or {"success": True})
+    key = f"key-{tmp_path.name}"
+    assert gumroad.verify_license_cached(key, "perma")
+    assert gumroad.verify_license_cached(key, "perma")
+    assert calls == [key]
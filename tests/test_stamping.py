@@ -0,0 +1,79 @@
+import io
+import os
+import time
+import pytest
+from pypdf import PdfReader
+from reportlab.pdfgen import canvas
+from app.settings import settings
+from app.stamping import ensure_base, prestamp, render_copy
+from app.utils.product_config import ProductConfig, product_configs
+from app.utils.storage import source_pdf_path, stamped_pdf_path
+from app.utils.watermarks import PatternSpec
+
+
+def _write_source(product_id: str, pages: int = 2):
+    path = source_pdf_path(product_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet)
+    for i in range(pages):
+        can.drawString(100, 750, f"Page {i}")
+        can.showPage()
+    can.save()
+    path.write_bytes(packet.getvalue())
+    return path
+
+
+def test_copies_are_stamped_from_prebuilt_base():
+    source = _write_source("base-a")
+    product_configs.put("base-a", ProductConfig(
+        footer_text="Sold to {email}", diagonal_text="CONFIDENTIAL", pattern=PatternSpec(text="ACME"),
+    ))
+    base = ensure_base("base-a", source)
+    assert base is not None and base.exists()
+    built_at = base.stat().st_mtime_ns
+
+    out = stamped_pdf_path("base-a", "buyer")
+    render_copy(source, out, "base-a", "buyer@example.com")
+    text = PdfReader(str(out)).pages[1].extract_text()
+    assert "Sold to buyer@example.com" in text and "CONFIDENTIAL" in text
+    # The base was reused rather than rebuilt for the copy
+    assert base.stat().st_mtime_ns == built_at
+
+    # A newer source makes the base stale
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert ensure_base("base-a", source).stat().st_mtime_ns == stat.st_mtime_ns + 1_000_000
+
+
+def test_base_of_missing_source_raises_file_not_found():
+    source = _write_source("base-c", pages=1)
+    product_configs.put("base-c", ProductConfig(diagonal_text="CONFIDENTIAL"))
+    source.unlink()
+    with pytest.raises(FileNotFoundError):
+        ensure_base("base-c", source)
+
+
+def test_no_base_without_buyer_independent_layers():
+    source = _write_source("base-b", pages=1)
+    product_configs.put("base-b", ProductConfig(diagonal_text="For {email}"))
+    assert ensure_base("base-b", source) is None
+
+    out = stamped_pdf_path("base-b", "buyer")
+    render_copy(source, out, "base-b", "z@example.com")
+    assert "For z@example.com" in PdfReader(str(out)).pages[0].extract_text()
+    assert not (settings.storage_dir / "source" / "base-b.base.pdf").exists()
+
+
+def test_prestamp_stamps_in_the_background_once():
+    _write_source("pre-a")
+    product_configs.put("pre-a", ProductConfig(footer_text="Sold to {email}"))
+    out = stamped_pdf_path("pre-a", "s-1")
+    assert prestamp("pre-a", "buyer@example.com", "s-1")
+    deadline = time.monotonic() + 10
+    while not out.exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert "Sold to buyer@example.com" in PdfReader(str(out)).pages[0].extract_text()
+    # Nothing to do once the copy exists, or for an unknown product
+    assert not prestamp("pre-a", "buyer@example.com", "s-1")
+    assert not prestamp("pre-missing", "buyer@example.com")
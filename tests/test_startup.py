@@ -0,0 +1,9 @@
+from app import startup
+
+
+def test_startup_report_records_imports_and_phases():
+    startup.mark("test_phase")
+    startup.timed_import("json")
+    report = startup.get_startup_report()
+    assert "test_phase" in report["phases_ms"]
+    assert any(item["module"] == "json" for item in report["imports"])
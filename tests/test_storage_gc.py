@@ -0,0 +1,79 @@
+import os
+import time
+from app.utils import cache_index
+from app.utils.storage import source_pdf_path, stamped_pdf_path
+from app.utils.storage_gc import StorageCollector
+
+
+def _file(path, age: float = 0, size: int = 10):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    if age:
+        then = time.time() - age
+        os.utime(path, (then, then))
+    return path
+
+
+def _full_pass(collector: StorageCollector):
+    passes = collector.stats()["passes"]
+    while collector.stats()["passes"] == passes:
+        collector.run_slice()
+
+
+def test_removes_orphaned_stale_and_temp_files_incrementally():
+    _file(source_pdf_path("gc-live"))
+    fresh = _file(stamped_pdf_path("gc-live", "fresh"))
+    stale = _file(stamped_pdf_path("gc-live", "stale"), age=600)
+    orphan = _file(stamped_pdf_path("gc-gone", "buyer"))
+    orphan_base = _file(source_pdf_path("gc-gone").with_suffix(".base.pdf"))
+    old_tmp = _file(stamped_pdf_path("gc-live", "crashed").with_suffix(".pdf.tmp"), age=600)
+    new_tmp = _file(stamped_pdf_path("gc-live", "running").with_suffix(".pdf.tmp"))
+
+    # A tiny time slice still makes progress and finishes the pass eventually
+    collector = StorageCollector(slice_ms=0.01, interval=0, disk_target_percent=100, temp_max_age=60)
+    _full_pass(collector)
+
+    assert fresh.exists() and new_tmp.exists()
+    assert not any(p.exists() for p in (stale, orphan, orphan_base, old_tmp))
+    stats = collector.stats()
+    assert stats["removed"]["stale"] >= 1 and stats["removed"]["temp"] >= 1
+    assert stats["reclaimed_bytes"]["orphaned"] >= 20
+
+
+def test_evicts_oldest_copies_above_disk_target():
+    _file(source_pdf_path("gc-evict"))
+    copy = _file(stamped_pdf_path("gc-evict", "buyer"), size=100)
+    cache_index.record_stamped(copy, "gc-evict", 100, 0.0)
+
+    collector = StorageCollector(slice_ms=200, interval=0, disk_target_percent=-1, temp_max_age=60)
+    collector.run_slice()
+    assert not copy.exists()
+    assert cache_index.lookup_stamped(copy) is None
+    assert collector.stats()["removed"]["evicted"] >= 1
+
+
+def test_busy_copies_stay_indexed_until_they_can_be_evicted():
+    import threading
+    from app.utils.locks import file_lock
+
+    _file(source_pdf_path("gc-busy"))
+    copy = _file(stamped_pdf_path("gc-busy", "buyer"), size=100)
+    cache_index.record_stamped(copy, "gc-busy", 100, 0.0)
+    held, release = threading.Event(), threading.Event()
+
+    def _hold():
+        with file_lock(str(copy)):
+            held.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=_hold)
+    holder.start()
+    held.wait(5)
+    collector = StorageCollector(slice_ms=200, interval=0, disk_target_percent=-1, temp_max_age=60)
+    collector.run_slice()
+    release.set()
+    holder.join()
+    # Still on disk, so still indexed and evicted by a later slice
+    assert copy.exists() and cache_index.lookup_stamped(copy) is not None
+    collector.run_slice()
+    assert not copy.exists() and cache_index.lookup_stamped(copy) is None
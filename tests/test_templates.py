@@ -0,0 +1,24 @@
+import pytest
+from app.utils.product_config import ProductConfig
+from app.utils.templates import TemplateError, compile_template
+
+
+def test_renders_all_variables_and_escaped_braces():
+    template = compile_template("{full_name} <{email}> {{order}} {sale_id} {price} {date}")
+    values = {"email": "a@b.c", "full_name": "Ada", "sale_id": "s1", "price": "9.00 USD", "date": "2024-05-01"}
+    assert template.render(values) == "Ada <a@b.c> {order} s1 9.00 USD 2024-05-01"
+    assert template.render({"email": "a@b.c"}) == " <a@b.c> {order}   "
+
+
+@pytest.mark.parametrize("source", ["{name}", "{email!r}", "{email:>9}", "{0}", "{", "{email.x}"])
+def test_rejects_unknown_or_formatted_placeholders(source):
+    with pytest.raises(TemplateError):
+        compile_template(source)
+
+
+def test_saved_configs_with_stray_braces_keep_rendering():
+    cfg = ProductConfig(footer_text="By {email} {name}")
+    assert cfg.footer_for({"email": "a@b.c"}) == "By a@b.c {name}"
+    # The default upload template no longer ships a literal {date}
+    cfg = ProductConfig(footer_text="Purchased by {email} on {date}")
+    assert cfg.footer_for({"email": "a@b.c", "date": "2024-05-01"}) == "Purchased by a@b.c on 2024-05-01"